@@ -11,12 +11,23 @@ import base64
 import re
 import threading
 import asyncio
+import queue
+import socket
+import bisect
+import math
+import time
+import functools
 import zipfile
 import httpx
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Optional, List, Dict
-from contextlib import asynccontextmanager
+from collections import Counter, OrderedDict, deque
+from typing import Any, Optional, List, Dict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager, aclosing
+from dataclasses import dataclass, field
+from json.decoder import scanstring as json_scanstring
+from json.encoder import encode_basestring_ascii
 
 from fastapi import FastAPI, HTTPException, Depends, Response, Request, BackgroundTasks
 from fastapi.staticfiles import StaticFiles
@@ -24,6 +35,10 @@ from fastapi.responses import FileResponse, StreamingResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from jose import JWTError, jwt
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # python-multipart < 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
 
 # Local imports
 from sandbox import run_sandboxed_python, generate_html_preview, ExecutionResult
@@ -36,18 +51,102 @@ try:
 except ImportError:
     CHROMA_AVAILABLE = False
 
+# Optional HTTP/2 support for TLS backends (pip install h2)
+try:
+    import h2  # noqa: F401
+    H2_AVAILABLE = True
+except ImportError:
+    H2_AVAILABLE = False
+
+# Optional Redis for the cross-host generation registry (pip install redis)
+try:
+    import redis.asyncio as aioredis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
 # =============================================================================
 # Configuration
 # =============================================================================
 
 OLLAMA_URL = os.environ.get("OLLAMA_URL", "http://localhost:11434")
 VLLM_URL = os.environ.get("VLLM_URL", "http://localhost:8000")  # vLLM OpenAI-compatible server
+# Comma-separated endpoint lists for load balancing; default to the single URL above
+OLLAMA_URLS = [u.strip() for u in os.environ.get("OLLAMA_URLS", OLLAMA_URL).split(",") if u.strip()]
+VLLM_URLS = [u.strip() for u in os.environ.get("VLLM_URLS", VLLM_URL).split(",") if u.strip()]
+BACKEND_EJECT_FAILURES = int(os.environ.get("BACKEND_EJECT_FAILURES", "3"))
+BACKEND_EJECT_SECONDS = float(os.environ.get("BACKEND_EJECT_SECONDS", "30"))
 VLLM_ENABLED = os.environ.get("VLLM_ENABLED", "false").lower() == "true"
+OLLAMA_TIMEOUT = float(os.environ.get("OLLAMA_TIMEOUT", "600"))
+VLLM_TIMEOUT = float(os.environ.get("VLLM_TIMEOUT", "600"))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.environ.get("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP2_ENABLED = os.environ.get("HTTP2_ENABLED", "true").lower() == "true"
+MODEL_CATALOG_REFRESH_SECONDS = float(os.environ.get("MODEL_CATALOG_REFRESH_SECONDS", "60"))
+MODEL_CATALOG_TTL_SECONDS = float(os.environ.get("MODEL_CATALOG_TTL_SECONDS", "30"))
 DATA_DIR = os.environ.get("DATA_DIR", os.path.dirname(os.path.abspath(__file__)))
 DB_PATH = os.path.join(DATA_DIR, "users.db")
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "8"))
+DB_BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_MMAP_SIZE = int(os.environ.get("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+CPU_EXECUTOR_WORKERS = int(os.environ.get("CPU_EXECUTOR_WORKERS", "2"))
+IO_EXECUTOR_WORKERS = int(os.environ.get("IO_EXECUTOR_WORKERS", "4"))  # Journal and attachment file I/O
 CHROMA_PATH = os.path.join(DATA_DIR, "chroma_db")
 STREAM_CACHE_DIR = os.path.join(DATA_DIR, "stream_cache")
+STREAM_JOURNAL_FSYNC_SECONDS = float(os.environ.get("STREAM_JOURNAL_FSYNC_SECONDS", "1"))
+STREAM_JOURNAL_RETENTION_HOURS = float(os.environ.get("STREAM_JOURNAL_RETENTION_HOURS", "24"))
+SSE_REPLAY_BUFFER_EVENTS = int(os.environ.get("SSE_REPLAY_BUFFER_EVENTS", "512"))
+SSE_REPLAY_LINGER_SECONDS = float(os.environ.get("SSE_REPLAY_LINGER_SECONDS", "60"))
+SSE_COALESCE_BYTES = int(os.environ.get("SSE_COALESCE_BYTES", "1024"))  # Flush a merged delta frame at this size
+SSE_COALESCE_MS = float(os.environ.get("SSE_COALESCE_MS", "20"))  # ...or after this long; 0 sends every delta at once
+SSE_JOURNAL_POLL_SECONDS = 0.25
+SSE_JOURNAL_STALL_SECONDS = float(os.environ.get("SSE_JOURNAL_STALL_SECONDS", "120"))
+MAX_GENERATIONS_PER_USER = int(os.environ.get("MAX_GENERATIONS_PER_USER", "2"))
+GENERATION_REGISTRY = os.environ.get("GENERATION_REGISTRY", "sqlite").lower()  # sqlite | redis
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+GENERATION_HEARTBEAT_SECONDS = float(os.environ.get("GENERATION_HEARTBEAT_SECONDS", "5"))
+GENERATION_STALE_SECONDS = float(os.environ.get("GENERATION_STALE_SECONDS", "30"))
+GENERATION_STOP_POLL_SECONDS = float(os.environ.get("GENERATION_STOP_POLL_SECONDS", "0.5"))
+OLLAMA_MAX_STREAMS = int(os.environ.get("OLLAMA_MAX_STREAMS", "4"))
+VLLM_MAX_STREAMS = int(os.environ.get("VLLM_MAX_STREAMS", "32"))
+ADMISSION_MODEL_LIMITS = json.loads(os.environ.get("ADMISSION_MODEL_LIMITS", "{}"))  # {"model": max_streams}
+ADMISSION_MAX_QUEUE = int(os.environ.get("ADMISSION_MAX_QUEUE", "64"))
+ADMISSION_INITIAL_STREAM_SECONDS = 30.0
+PROMPT_DEFAULT_CONTEXT_TOKENS = int(os.environ.get("PROMPT_DEFAULT_CONTEXT_TOKENS", "8192"))  # Models without context_length
+PROMPT_RESPONSE_RESERVE_TOKENS = int(os.environ.get("PROMPT_RESPONSE_RESERVE_TOKENS", "2048"))  # Left free for the reply
+PROMPT_MAX_MESSAGE_SHARE = 0.5  # Older messages are truncated to at most this share of the budget
+PROMPT_MESSAGE_OVERHEAD_TOKENS = 4  # Role/turn framing per message
+PROMPT_HISTORY_PAGE = 50
+PROMPT_ASSEMBLY = os.environ.get("PROMPT_ASSEMBLY", "stable")  # "stable" (KV-cache friendly prefix) or "sliding"
+PROMPT_PINNED_MESSAGES = int(os.environ.get("PROMPT_PINNED_MESSAGES", "2"))  # Early turns kept at the head in stable mode
+PROMPT_COMPACT_FILL = 0.5  # Share of the budget the history window restarts at after compaction
+OLLAMA_KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "30m")  # How long Ollama keeps a model loaded
+SUMMARY_MODEL = os.environ.get("SUMMARY_MODEL", "qwen2.5-coder:7b")  # Empty disables session summaries
+SUMMARY_THRESHOLD_TOKENS = int(os.environ.get("SUMMARY_THRESHOLD_TOKENS", "2000"))  # Unsummarised turns before condensing
+SUMMARY_INPUT_TOKENS = 6000  # Transcript tokens per summariser call
+SUMMARY_MAX_TOKENS = 600
+# Opt-in response cache: comma-separated models ("*" for all); empty disables it
+RESPONSE_CACHE_MODELS = {m.strip() for m in os.environ.get("RESPONSE_CACHE_MODELS", "").split(",") if m.strip()}
+RESPONSE_CACHE_TTL_SECONDS = float(os.environ.get("RESPONSE_CACHE_TTL_SECONDS", "3600"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+RESPONSE_CACHE_SIMILARITY = float(os.environ.get("RESPONSE_CACHE_SIMILARITY", "0.95"))  # Cosine; 0 or 1 = exact only
+RESPONSE_CACHE_TAIL_MESSAGES = int(os.environ.get("RESPONSE_CACHE_TAIL_MESSAGES", "1"))  # Trailing messages matched by similarity
+RESPONSE_CACHE_SCOPE = os.environ.get("RESPONSE_CACHE_SCOPE", "user")  # "user" or "global" (shared across users)
+RESPONSE_CACHE_CHUNK_CHARS = 256  # Size of the content events a cache hit is replayed in
+TROUBLESHOOT_CACHE_TTL_SECONDS = float(os.environ.get("TROUBLESHOOT_CACHE_TTL_SECONDS", "900"))  # 0 disables
+TROUBLESHOOT_CACHE_MAX_ENTRIES = int(os.environ.get("TROUBLESHOOT_CACHE_MAX_ENTRIES", "512"))
+TROUBLESHOOT_CONTEXT_CHARS = 5000  # Context the prompts actually use (e.g. raw_html), also the cache key's cut-off
+TROUBLESHOOT_BATCH_MAX_ITEMS = int(os.environ.get("TROUBLESHOOT_BATCH_MAX_ITEMS", "1000"))
+TROUBLESHOOT_BATCH_CONCURRENCY = int(os.environ.get("TROUBLESHOOT_BATCH_CONCURRENCY", "4"))  # Upstream calls per batch
+TROUBLESHOOT_BATCH_SIZE = int(os.environ.get("TROUBLESHOOT_BATCH_SIZE", "16"))  # Prompts per vLLM batched request
+ARTIFACT_ZIP_BATCH_SIZE = int(os.environ.get("ARTIFACT_ZIP_BATCH_SIZE", "100"))  # Artifacts read and zipped per step
+ZIP_EXECUTOR_WORKERS = int(os.environ.get("ZIP_EXECUTOR_WORKERS", "2"))  # Concurrent ZIP export batches being compressed
+ARTIFACT_ZIP_LENGTH_TTL_SECONDS = 3600  # Remember compressed archive lengths (for Range) this long
 UPLOADS_DIR = os.path.join(DATA_DIR, "uploads")
+ATTACHMENT_TEMP_DIR = os.path.join(UPLOADS_DIR, "tmp")  # In-progress uploads (same filesystem as the store)
+ATTACHMENT_MAX_BYTES = int(os.environ.get("ATTACHMENT_MAX_BYTES", str(20 * 1024 * 1024)))
 IMAGE_RETENTION_DAYS = int(os.environ.get("IMAGE_RETENTION_DAYS", "1"))  # Auto-delete after 1 day
 DEFAULT_MODEL = os.environ.get("DEFAULT_MODEL", "qwen3-coder:30b")
 VISION_MODELS = ["deepseek-ocr", "qwen3-vl", "llava", "moondream", "bakllava", "llava-phi", "granite3.2-vision", "minicpm-v"]
@@ -62,6 +161,7 @@ MODEL_METADATA = {
         "category": "coding",
         "description": "Technical proposal writing, methodology, architecture diagrams",
         "tender_stages": ["compose-technical"],
+        "context_length": 32768,
         "tags": ["code", "technical", "heavy"]
     },
     "qwen2.5-coder:7b": {
@@ -71,6 +171,7 @@ MODEL_METADATA = {
         "category": "coding",
         "description": "Browser automation, portal navigation, form filling, data extraction",
         "tender_stages": ["scout", "submit", "extract"],
+        "context_length": 32768,
         "tags": ["fast", "tools", "browser"]
     },
     "gemma2:9b": {
@@ -80,6 +181,7 @@ MODEL_METADATA = {
         "category": "analysis",
         "description": "Tender qualification, compliance scoring, structured analysis",
         "tender_stages": ["analyze", "review"],
+        "context_length": 8192,
         "tags": ["analysis", "structured", "reasoning"]
     },
     "mistral-nemo": {
@@ -89,6 +191,7 @@ MODEL_METADATA = {
         "category": "writing",
         "description": "Formal bid documents, executive summaries, cover letters",
         "tender_stages": ["compose-formal", "review"],
+        "context_length": 32768,
         "tags": ["formal", "concise", "professional"]
     },
     "deepseek-ocr": {
@@ -98,6 +201,7 @@ MODEL_METADATA = {
         "category": "vision",
         "description": "Scanned document OCR, image-based tender extraction",
         "tender_stages": ["extract-vision"],
+        "context_length": 8192,
         "tags": ["vision", "ocr", "documents"]
     },
     "guardpoint": {
@@ -107,6 +211,7 @@ MODEL_METADATA = {
         "category": "specialist",
         "description": "Healthcare/medical tender analysis, clinical reasoning",
         "tender_stages": ["analyze-medical"],
+        "context_length": 16384,
         "tags": ["medical", "specialist", "reasoning"]
     },
     "translategemma": {
@@ -116,6 +221,7 @@ MODEL_METADATA = {
         "category": "translation",
         "description": "Multi-language tender document translation",
         "tender_stages": ["translate"],
+        "context_length": 8192,
         "tags": ["translation", "multilingual"]
     }
 }
@@ -129,10 +235,7 @@ ACCESS_TOKEN_EXPIRE_DAYS = 7
 Path(STREAM_CACHE_DIR).mkdir(exist_ok=True)
 Path(DATA_DIR).mkdir(exist_ok=True)
 Path(UPLOADS_DIR).mkdir(exist_ok=True)
-
-# Active generations tracking for stop functionality
-# Key: "{user_id}_{session_id}", Value: {"cancel": asyncio.Event, "content": str, "msg_id": int}
-active_generations: Dict[str, dict] = {}
+Path(ATTACHMENT_TEMP_DIR).mkdir(exist_ok=True)
 
 # =============================================================================
 # Pydantic Models
@@ -155,6 +258,8 @@ class ChatRequest(BaseModel):
     model: str
     session_id: Optional[int] = None
     images: Optional[List[str]] = None  # Base64 encoded images
+    attachment_ids: Optional[List[int]] = None  # Images uploaded via POST /api/attachments
+    use_cache: bool = True  # Set False to bypass the response cache (e.g. regenerate)
 
 
 class SessionCreate(BaseModel):
@@ -166,7 +271,8 @@ class SessionUpdate(BaseModel):
 
 
 class StopRequest(BaseModel):
-    session_id: int
+    session_id: Optional[int] = None
+    generation_id: Optional[str] = None
 
 
 class ContinueRequest(BaseModel):
@@ -202,6 +308,15 @@ class TroubleshootRequest(BaseModel):
     context: Optional[Dict] = None  # Additional context (e.g., raw_html, partial_data)
 
 
+class TroubleshootBatchItem(TroubleshootRequest):
+    id: Optional[str] = None  # Caller's reference, echoed back with the item's result
+
+
+class TroubleshootBatchRequest(BaseModel):
+    items: List[TroubleshootBatchItem]
+    concurrency: Optional[int] = None  # Defaults to TROUBLESHOOT_BATCH_CONCURRENCY
+
+
 class TroubleshootResult(BaseModel):
     """Result from troubleshooting attempt."""
     success: bool
@@ -226,13 +341,151 @@ SYSTEM_PROMPT_PRESETS = [
 # Database Functions
 # =============================================================================
 
+class SQLitePool:
+    """
+    Bounded pool of long-lived SQLite connections.
+
+    Connections are opened lazily (up to max_size), tuned once with WAL-mode
+    pragmas, and handed out exclusively for the duration of a `with` block.
+    Each connection keeps its own prepared-statement cache, so reusing them
+    avoids both the connect cost and re-parsing the same SQL on every call.
+    """
+
+    def __init__(self, path: str, max_size: int = 8, timeout: float = 30.0,
+                 busy_timeout_ms: int = 5000, mmap_size: int = 268435456,
+                 cached_statements: int = 256):
+        self.path = path
+        self.max_size = max_size
+        self.timeout = timeout
+        self.busy_timeout_ms = busy_timeout_ms
+        self.mmap_size = mmap_size
+        self.cached_statements = cached_statements
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._in_use = 0
+        self._peak_in_use = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.busy_timeout_ms / 1000,
+            check_same_thread=False,  # Safe: a connection is only used by one holder at a time
+            cached_statements=self.cached_statements
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        conn.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def _checkout(self) -> sqlite3.Connection:
+        start = time.perf_counter()
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = None
+            with self._lock:
+                if self._created < self.max_size:
+                    self._created += 1
+                    create = True
+                else:
+                    create = False
+            if create:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise RuntimeError(f"Timed out after {self.timeout}s waiting for a database connection")
+
+        waited = time.perf_counter() - start
+        with self._lock:
+            self._in_use += 1
+            self._peak_in_use = max(self._peak_in_use, self._in_use)
+            self._checkouts += 1
+            if waited > 0.001:
+                self._waits += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        return conn
+
+    def _checkin(self, conn: sqlite3.Connection):
+        with self._lock:
+            self._in_use -= 1
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection; commit on success, roll back on error."""
+        conn = self._checkout()
+        try:
+            yield conn
+            if conn.in_transaction:
+                conn.commit()
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            self._checkin(conn)
+
+    def close(self):
+        """Close all idle connections (call on shutdown)."""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": self._created,
+                "max_size": self.max_size,
+                "in_use": self._in_use,
+                "idle": self._idle.qsize(),
+                "peak_in_use": self._peak_in_use,
+                "checkouts": self._checkouts,
+                "waits": self._waits,
+                "wait_avg_ms": round(self._wait_total / self._checkouts * 1000, 3) if self._checkouts else 0.0,
+                "wait_max_ms": round(self._wait_max * 1000, 3)
+            }
+
+
+db_pool = SQLitePool(
+    DB_PATH,
+    max_size=DB_POOL_SIZE,
+    busy_timeout_ms=DB_BUSY_TIMEOUT_MS,
+    mmap_size=DB_MMAP_SIZE
+)
+
+
 def get_db():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """Borrow a pooled connection: `with get_db() as conn: ...` (commits on exit)."""
+    return db_pool.connection()
+
 
 def init_db():
-    conn = get_db()
+    with get_db() as conn:
+        _init_schema(conn)
+
+
+def _init_schema(conn):
     c = conn.cursor()
 
     # Users table
@@ -247,14 +500,17 @@ def init_db():
                   name TEXT NOT NULL DEFAULT 'New Chat',
                   created_at TEXT NOT NULL,
                   updated_at TEXT NOT NULL,
+                  message_count INTEGER NOT NULL DEFAULT 0,
+                  preview TEXT,
+                  last_message_at TEXT,
+                  prompt_window_start INTEGER,
                   FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE)''')
-    c.execute('''CREATE INDEX IF NOT EXISTS idx_sessions_user
-                 ON chat_sessions(user_id, updated_at DESC)''')
 
     # Chat history table (with session support)
     c.execute('''CREATE TABLE IF NOT EXISTS chat_history
                  (id INTEGER PRIMARY KEY, user_id INTEGER, role TEXT, content TEXT,
                   model TEXT, created_at TEXT, session_id INTEGER, is_partial INTEGER DEFAULT 0,
+                  token_count INTEGER,
                   FOREIGN KEY (session_id) REFERENCES chat_sessions(id) ON DELETE CASCADE)''')
 
     # Artifacts table (legacy - session-bound)
@@ -267,6 +523,8 @@ def init_db():
                   title TEXT,
                   content TEXT NOT NULL,
                   created_at TEXT NOT NULL,
+                  content_hash TEXT,
+                  message_id INTEGER,
                   FOREIGN KEY (session_id) REFERENCES chat_sessions(id) ON DELETE CASCADE)''')
     c.execute('''CREATE INDEX IF NOT EXISTS idx_artifacts_session
                  ON artifacts(session_id)''')
@@ -281,12 +539,22 @@ def init_db():
                   content TEXT NOT NULL,
                   source_session_id INTEGER,
                   created_at TEXT NOT NULL,
+                  content_hash TEXT,
                   FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE)''')
     c.execute('''CREATE INDEX IF NOT EXISTS idx_user_artifacts_user
                  ON user_artifacts(user_id, created_at DESC)''')
     c.execute('''CREATE INDEX IF NOT EXISTS idx_user_artifacts_type
                  ON user_artifacts(user_id, type)''')
 
+    # Artifact content, stored once per distinct text and referenced by
+    # content_hash from artifacts and user_artifacts (whose own content
+    # column is left empty)
+    c.execute('''CREATE TABLE IF NOT EXISTS artifact_blobs
+                 (hash TEXT PRIMARY KEY,
+                  content TEXT NOT NULL,
+                  size INTEGER NOT NULL,
+                  created_at TEXT NOT NULL)''')
+
     # Usage log table
     c.execute('''CREATE TABLE IF NOT EXISTS usage_log
                  (id INTEGER PRIMARY KEY, user_id INTEGER, model TEXT,
@@ -303,6 +571,7 @@ def init_db():
                   file_size INTEGER,
                   created_at TEXT NOT NULL,
                   expires_at TEXT NOT NULL,
+                  content_hash TEXT,
                   FOREIGN KEY (message_id) REFERENCES chat_history(id) ON DELETE SET NULL,
                   FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE)''')
     c.execute('''CREATE INDEX IF NOT EXISTS idx_attachments_message
@@ -310,6 +579,16 @@ def init_db():
     c.execute('''CREATE INDEX IF NOT EXISTS idx_attachments_expires
                  ON message_attachments(expires_at)''')
 
+    # Attachment files, stored once per distinct content under
+    # UPLOADS_DIR/<filename> and shared by every attachment with that hash
+    c.execute('''CREATE TABLE IF NOT EXISTS attachment_blobs
+                 (hash TEXT PRIMARY KEY,
+                  filename TEXT NOT NULL,
+                  mime_type TEXT,
+                  size INTEGER NOT NULL,
+                  refcount INTEGER NOT NULL DEFAULT 0,
+                  created_at TEXT NOT NULL)''')
+
     # Code executions table
     c.execute('''CREATE TABLE IF NOT EXISTS code_executions
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -341,11 +620,37 @@ def init_db():
                   updated_at TEXT NOT NULL,
                   FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE)''')
 
+    # Running generations, shared by all workers (see SQLiteGenerationRegistry)
+    c.execute('''CREATE TABLE IF NOT EXISTS generations
+                 (generation_id TEXT PRIMARY KEY,
+                  user_id INTEGER NOT NULL,
+                  session_id INTEGER NOT NULL,
+                  worker_id TEXT NOT NULL,
+                  model TEXT,
+                  backend TEXT,
+                  stop_requested INTEGER NOT NULL DEFAULT 0,
+                  started_at TEXT NOT NULL,
+                  heartbeat_at REAL NOT NULL)''')
+    c.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_generations_session
+                 ON generations(user_id, session_id)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_generations_worker
+                 ON generations(worker_id, stop_requested)''')
+
+    # Rolling summary of the turns before a session's prompt window
+    c.execute('''CREATE TABLE IF NOT EXISTS session_summaries
+                 (session_id INTEGER PRIMARY KEY,
+                  user_id INTEGER NOT NULL,
+                  through_id INTEGER NOT NULL,
+                  content TEXT NOT NULL,
+                  model TEXT,
+                  source_tokens INTEGER NOT NULL DEFAULT 0,
+                  created_at TEXT NOT NULL,
+                  FOREIGN KEY (session_id) REFERENCES chat_sessions(id) ON DELETE CASCADE)''')
+
     conn.commit()
 
     # Run migrations for existing data
     migrate_db(conn)
-    conn.close()
 
 
 def migrate_db(conn):
@@ -382,6 +687,25 @@ def migrate_db(conn):
 
         conn.commit()
 
+    # Migration: estimated token count stored with each message (NULL: estimate on read)
+    c.execute("PRAGMA table_info(chat_history)")
+    if 'token_count' not in [col[1] for col in c.fetchall()]:
+        c.execute("ALTER TABLE chat_history ADD COLUMN token_count INTEGER")
+
+    # Migration: attachments reference content-addressed files (attachment_blobs)
+    c.execute("PRAGMA table_info(message_attachments)")
+    if 'content_hash' not in [col[1] for col in c.fetchall()]:
+        c.execute("ALTER TABLE message_attachments ADD COLUMN content_hash TEXT")
+
+    # Migration: artifact content moves to artifact_blobs, referenced by hash
+    c.execute("PRAGMA table_info(artifacts)")
+    if 'content_hash' not in [col[1] for col in c.fetchall()]:
+        c.execute("ALTER TABLE artifacts ADD COLUMN content_hash TEXT")
+        c.execute("ALTER TABLE artifacts ADD COLUMN message_id INTEGER")
+    c.execute("PRAGMA table_info(user_artifacts)")
+    if 'content_hash' not in [col[1] for col in c.fetchall()]:
+        c.execute("ALTER TABLE user_artifacts ADD COLUMN content_hash TEXT")
+
     # Migration: Copy artifacts to user_artifacts and rename explanation -> document
     c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='user_artifacts'")
     if c.fetchone():
@@ -390,60 +714,166 @@ def migrate_db(conn):
         if c.fetchone()[0] == 0:
             # Copy existing artifacts to user_artifacts, renaming explanation -> document
             c.execute("""
-                INSERT INTO user_artifacts (user_id, type, language, title, content, source_session_id, created_at)
+                INSERT INTO user_artifacts (user_id, type, language, title, content, content_hash,
+                                            source_session_id, created_at)
                 SELECT user_id,
                        CASE WHEN type = 'explanation' THEN 'document' ELSE type END,
-                       language, title, content, session_id, created_at
+                       language, title, content, content_hash, session_id, created_at
                 FROM artifacts
             """)
             conn.commit()
 
+    # Backfill: move any inline artifact content into artifact_blobs
+    now = datetime.now().isoformat()
+    for table in ("artifacts", "user_artifacts"):
+        c.execute(f"SELECT id, content FROM {table} WHERE content_hash IS NULL")
+        rows = [(row[0], row[1], artifact_content_hash(row[1])) for row in c.fetchall()]
+        if rows:
+            c.executemany(
+                "INSERT OR IGNORE INTO artifact_blobs (hash, content, size, created_at) VALUES (?, ?, ?, ?)",
+                [(digest, content, len(content.encode("utf-8")), now) for _, content, digest in rows]
+            )
+            c.executemany(
+                f"UPDATE {table} SET content_hash = ?, content = '' WHERE id = ?",
+                [(digest, row_id) for row_id, _, digest in rows]
+            )
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_artifacts_hash
+                 ON artifacts(content_hash)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_artifacts_message
+                 ON artifacts(message_id)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_user_artifacts_hash
+                 ON user_artifacts(content_hash)''')
+    conn.commit()
+
     # Update any remaining 'explanation' types to 'document' in both tables
     c.execute("UPDATE artifacts SET type = 'document' WHERE type = 'explanation'")
     c.execute("UPDATE user_artifacts SET type = 'document' WHERE type = 'explanation'")
     conn.commit()
 
+    # Per-session history lookups (listing stats, history pages)
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_history_session
+                 ON chat_history(session_id, id)''')
+
+    # Migration: denormalized session stats so listing is a single query
+    c.execute("PRAGMA table_info(chat_sessions)")
+    session_columns = [col[1] for col in c.fetchall()]
+    if 'message_count' not in session_columns:
+        c.execute("ALTER TABLE chat_sessions ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0")
+        c.execute("ALTER TABLE chat_sessions ADD COLUMN preview TEXT")
+        c.execute("ALTER TABLE chat_sessions ADD COLUMN last_message_at TEXT")
+        # Backfill from existing history
+        refresh_session_stats(c)
+    if 'prompt_window_start' not in session_columns:
+        # First message of the stable prompt window (see build_chat_prompt)
+        c.execute("ALTER TABLE chat_sessions ADD COLUMN prompt_window_start INTEGER")
+
+    # Keyset pagination indexes. The sessions index covers every listed
+    # column so a sidebar page never touches the table rows.
+    c.execute("DROP INDEX IF EXISTS idx_sessions_user")
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_sessions_user_cursor
+                 ON chat_sessions(user_id, updated_at DESC, id DESC, name, created_at,
+                                  message_count, last_message_at, preview)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_history_user
+                 ON chat_history(user_id, id)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_history_user_session
+                 ON chat_history(user_id, session_id, id)''')
+    conn.commit()
 
-def register_user(username: str, password: str) -> tuple[bool, str]:
-    conn = get_db()
-    c = conn.cursor()
+
+def encode_cursor(data: dict) -> str:
+    """Opaque pagination token (url-safe base64 JSON)."""
+    raw = json.dumps(data, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(token: str) -> dict:
+    """Inverse of encode_cursor; raises ValueError on a malformed token."""
     try:
-        password_hash = bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
-        c.execute("INSERT INTO users (username, password_hash, created_at) VALUES (?, ?, ?)",
-                  (username, password_hash, datetime.now().isoformat()))
-        conn.commit()
-        return True, "Registration successful"
-    except sqlite3.IntegrityError:
-        return False, "Username already exists"
-    finally:
-        conn.close()
+        data = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(data, dict):
+        raise ValueError("Invalid cursor")
+    return data
+
+
+def make_session_preview(content: str) -> str:
+    """Sidebar preview text for a session's first user message."""
+    return content[:100] + "..." if len(content) > 100 else content
+
+
+def refresh_session_stats(c, user_id: int = None, session_id: int = None):
+    """Recompute message_count/preview/last_message_at from chat_history.
+
+    Used to backfill and after bulk deletes; save_message maintains the
+    columns incrementally on the hot path.
+    """
+    where, params = "", ()
+    if session_id:
+        where, params = " WHERE id = ?", (session_id,)
+    elif user_id:
+        where, params = " WHERE user_id = ?", (user_id,)
+    c.execute(
+        """UPDATE chat_sessions SET
+               message_count = (SELECT COUNT(*) FROM chat_history h WHERE h.session_id = chat_sessions.id),
+               last_message_at = (SELECT MAX(created_at) FROM chat_history h WHERE h.session_id = chat_sessions.id),
+               preview = (SELECT CASE WHEN length(h.content) > 100 THEN substr(h.content, 1, 100) || '...' ELSE h.content END
+                          FROM chat_history h
+                          WHERE h.session_id = chat_sessions.id AND h.role = 'user'
+                          ORDER BY h.id ASC LIMIT 1)""" + where,
+        params
+    )
+
+
+def hash_password(password: str) -> str:
+    """bcrypt-hash a password (CPU-bound, ~250ms)."""
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+
+def check_password(password: str, password_hash: str) -> bool:
+    """Verify a password against its bcrypt hash (CPU-bound, ~250ms)."""
+    return bcrypt.checkpw(password.encode(), password_hash.encode())
+
+def insert_user(username: str, password_hash: str) -> tuple[bool, str]:
+    with get_db() as conn:
+        c = conn.cursor()
+        try:
+            c.execute("INSERT INTO users (username, password_hash, created_at) VALUES (?, ?, ?)",
+                      (username, password_hash, datetime.now().isoformat()))
+            return True, "Registration successful"
+        except sqlite3.IntegrityError:
+            return False, "Username already exists"
+
+def get_user_credentials(username: str) -> Optional[dict]:
+    """Get id and password hash for a username."""
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("SELECT id, password_hash FROM users WHERE username = ?", (username,))
+        result = c.fetchone()
+    return dict(result) if result else None
+
+def register_user(username: str, password: str) -> tuple[bool, str]:
+    return insert_user(username, hash_password(password))
 
 def verify_user(username: str, password: str) -> Optional[int]:
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT id, password_hash FROM users WHERE username = ?", (username,))
-    result = c.fetchone()
-    conn.close()
-    if result and bcrypt.checkpw(password.encode(), result["password_hash"].encode()):
+    result = get_user_credentials(username)
+    if result and check_password(password, result["password_hash"]):
         return result["id"]
     return None
 
 def get_username(user_id: int) -> Optional[str]:
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT username FROM users WHERE id = ?", (user_id,))
-    result = c.fetchone()
-    conn.close()
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("SELECT username FROM users WHERE id = ?", (user_id,))
+        result = c.fetchone()
     return result["username"] if result else None
 
 
 def get_user_settings(user_id: int) -> dict:
     """Get user settings, returning defaults if none exist."""
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT system_prompt, system_prompt_enabled, model_prompts FROM user_settings WHERE user_id = ?", (user_id,))
-    result = c.fetchone()
-    conn.close()
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("SELECT system_prompt, system_prompt_enabled, model_prompts FROM user_settings WHERE user_id = ?", (user_id,))
+        result = c.fetchone()
 
     if result:
         return {
@@ -462,8 +892,6 @@ def get_user_settings(user_id: int) -> dict:
 
 def update_user_settings(user_id: int, settings: dict) -> bool:
     """Upsert user settings."""
-    conn = get_db()
-    c = conn.cursor()
     now = datetime.now().isoformat()
 
     # Enforce 4000 char limit on system prompt
@@ -480,24 +908,22 @@ def update_user_settings(user_id: int, settings: dict) -> bool:
     model_prompts_json = json.dumps(model_prompts) if model_prompts else None
 
     try:
-        # Try insert first
-        c.execute(
-            """INSERT INTO user_settings (user_id, system_prompt, system_prompt_enabled, model_prompts, created_at, updated_at)
-               VALUES (?, ?, ?, ?, ?, ?)
-               ON CONFLICT(user_id) DO UPDATE SET
-               system_prompt = excluded.system_prompt,
-               system_prompt_enabled = excluded.system_prompt_enabled,
-               model_prompts = excluded.model_prompts,
-               updated_at = excluded.updated_at""",
-            (user_id, system_prompt, 1 if settings.get("system_prompt_enabled", True) else 0, model_prompts_json, now, now)
-        )
-        conn.commit()
+        with get_db() as conn:
+            # Try insert first
+            conn.execute(
+                """INSERT INTO user_settings (user_id, system_prompt, system_prompt_enabled, model_prompts, created_at, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?)
+                   ON CONFLICT(user_id) DO UPDATE SET
+                   system_prompt = excluded.system_prompt,
+                   system_prompt_enabled = excluded.system_prompt_enabled,
+                   model_prompts = excluded.model_prompts,
+                   updated_at = excluded.updated_at""",
+                (user_id, system_prompt, 1 if settings.get("system_prompt_enabled", True) else 0, model_prompts_json, now, now)
+            )
         return True
     except Exception as e:
         print(f"Error updating user settings: {e}")
         return False
-    finally:
-        conn.close()
 
 
 def get_system_prompt_for_model(user_id: int, model: str) -> Optional[str]:
@@ -517,12 +943,9 @@ def get_system_prompt_for_model(user_id: int, model: str) -> Optional[str]:
 
 
 def log_usage(user_id: int, model: str, tokens_in: int, tokens_out: int):
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("INSERT INTO usage_log (user_id, model, tokens_in, tokens_out, created_at) VALUES (?, ?, ?, ?, ?)",
-              (user_id, model, tokens_in, tokens_out, datetime.now().isoformat()))
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        conn.execute("INSERT INTO usage_log (user_id, model, tokens_in, tokens_out, created_at) VALUES (?, ?, ?, ?, ?)",
+                     (user_id, model, tokens_in, tokens_out, datetime.now().isoformat()))
 
 def generate_session_title(content: str, max_length: int = 50) -> str:
     """Generate a session title from the first user message."""
@@ -559,75 +982,227 @@ def generate_session_title(content: str, max_length: int = 50) -> str:
 import uuid
 import hashlib
 
-def save_attachment(user_id: int, base64_data: str, message_id: int = None) -> dict:
-    """Save a base64 image to disk and record in DB. Returns attachment info."""
-    try:
-        # Decode base64
-        image_data = base64.b64decode(base64_data)
-
-        # Detect mime type from magic bytes
-        mime_type = "image/png"  # default
-        if image_data[:3] == b'\xff\xd8\xff':
-            mime_type = "image/jpeg"
-        elif image_data[:8] == b'\x89PNG\r\n\x1a\n':
-            mime_type = "image/png"
-        elif image_data[:6] in (b'GIF87a', b'GIF89a'):
-            mime_type = "image/gif"
-        elif image_data[:4] == b'RIFF' and image_data[8:12] == b'WEBP':
-            mime_type = "image/webp"
-
-        # Generate unique filename
-        file_hash = hashlib.md5(image_data[:1024]).hexdigest()[:8]
-        ext = mime_type.split("/")[1]
-        filename = f"{user_id}_{uuid.uuid4().hex[:8]}_{file_hash}.{ext}"
-
-        # Save to disk
-        filepath = os.path.join(UPLOADS_DIR, filename)
-        with open(filepath, "wb") as f:
-            f.write(image_data)
-
-        # Record in database
-        now = datetime.now()
-        expires_at = now + timedelta(days=IMAGE_RETENTION_DAYS)
-
-        conn = get_db()
+
+class AttachmentRejected(Exception):
+    """An upload was refused (too large, not an image, malformed)."""
+
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+    def to_http(self) -> HTTPException:
+        return HTTPException(status_code=self.status_code, detail=str(self))
+
+
+def detect_image_mime(head: bytes) -> Optional[str]:
+    """Image type from the leading magic bytes, or None if not recognised."""
+    if head[:3] == b'\xff\xd8\xff':
+        return "image/jpeg"
+    if head[:8] == b'\x89PNG\r\n\x1a\n':
+        return "image/png"
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return "image/gif"
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return "image/webp"
+    return None
+
+
+def attachment_blob_filename(digest: str, mime_type: str) -> str:
+    """Path of a blob under UPLOADS_DIR, sharded by hash prefix: ab/cd/abcd....png"""
+    return os.path.join(digest[:2], digest[2:4], f"{digest}.{mime_type.split('/')[1]}")
+
+
+class AttachmentWriter:
+    """
+    Takes an attachment's bytes a chunk at a time, hashing them (SHA-256)
+    and writing them to a temp file under ATTACHMENT_TEMP_DIR as they
+    arrive, so an upload is never held in memory. commit() files the result
+    in the content-addressed store; abort() throws it away.
+    """
+
+    def __init__(self, max_bytes: int = ATTACHMENT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.hasher = hashlib.sha256()
+        self.size = 0
+        self.head = b""
+        self.temp_path = os.path.join(ATTACHMENT_TEMP_DIR, f"{uuid.uuid4().hex}.part")
+        self._file = open(self.temp_path, "wb")
+
+    def write(self, data: bytes):
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            raise AttachmentRejected(f"Attachment exceeds {self.max_bytes} bytes", status_code=413)
+        if len(self.head) < 16:
+            self.head += data[:16 - len(self.head)]
+        self.hasher.update(data)
+        self._file.write(data)
+
+    def commit(self, user_id: int, message_id: int = None, default_mime: str = None) -> dict:
+        self._file.close()
+        mime_type = detect_image_mime(self.head) or default_mime
+        if mime_type is None:
+            self.abort()
+            raise AttachmentRejected("Unsupported image type", status_code=415)
+        return store_attachment(user_id, self.temp_path, self.hasher.hexdigest(), self.size, mime_type, message_id)
+
+    def abort(self):
+        self._file.close()
+        try:
+            os.remove(self.temp_path)
+        except FileNotFoundError:
+            pass
+
+
+def store_attachment(user_id: int, temp_path: str, digest: str, size: int, mime_type: str,
+                     message_id: int = None) -> dict:
+    """
+    File a hashed upload in the attachment store and record an attachment
+    for it. Identical bytes are stored once: a repeat upload only takes
+    another reference (attachment_blobs.refcount) and drops its temp file.
+    The file is moved into place while the write transaction is held, as
+    cleanup_expired_attachments unlinks under it too, so the two never
+    interleave.
+    """
+    filename = attachment_blob_filename(digest, mime_type)
+    filepath = os.path.join(UPLOADS_DIR, filename)
+    now = datetime.now()
+    expires_at = now + timedelta(days=IMAGE_RETENTION_DAYS)
+
+    with get_db() as conn:
         c = conn.cursor()
+        c.execute(
+            """INSERT INTO attachment_blobs (hash, filename, mime_type, size, refcount, created_at)
+               VALUES (?, ?, ?, ?, 1, ?)
+               ON CONFLICT(hash) DO UPDATE SET refcount = refcount + 1""",
+            (digest, filename, mime_type, size, now.isoformat())
+        )
+        if os.path.exists(filepath):
+            os.remove(temp_path)
+        else:
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            os.replace(temp_path, filepath)
         c.execute(
             """INSERT INTO message_attachments
-               (message_id, user_id, filename, mime_type, file_size, created_at, expires_at)
-               VALUES (?, ?, ?, ?, ?, ?, ?)""",
-            (message_id, user_id, filename, mime_type, len(image_data),
+               (message_id, user_id, filename, mime_type, file_size, content_hash, created_at, expires_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+            (message_id, user_id, filename, mime_type, size, digest,
              now.isoformat(), expires_at.isoformat())
         )
         attachment_id = c.lastrowid
-        conn.commit()
-        conn.close()
 
-        return {
-            "id": attachment_id,
-            "filename": filename,
-            "mime_type": mime_type,
-            "size": len(image_data),
-            "expires_at": expires_at.isoformat()
-        }
+    return {
+        "id": attachment_id,
+        "filename": filename,
+        "mime_type": mime_type,
+        "size": size,
+        "expires_at": expires_at.isoformat()
+    }
+
+
+def save_attachment(user_id: int, base64_data: str, message_id: int = None) -> dict:
+    """Save a base64 image to the attachment store and record in DB. Returns attachment info."""
+    writer = None
+    try:
+        writer = AttachmentWriter()
+        writer.write(base64.b64decode(base64_data))
+        return writer.commit(user_id, message_id, default_mime="image/png")
     except Exception as e:
+        if writer:
+            writer.abort()
         print(f"Error saving attachment: {e}")
         return None
 
 
-def get_attachment(attachment_id: int, user_id: int = None):
-    """Get attachment info by ID, optionally verify user ownership."""
-    conn = get_db()
-    c = conn.cursor()
+def read_attachment_base64(attachment: dict) -> str:
+    """An attachment's file as base64, for backends that take images inline."""
+    with open(os.path.join(UPLOADS_DIR, attachment["filename"]), "rb") as f:
+        return base64.b64encode(f.read()).decode("ascii")
 
-    if user_id:
-        c.execute("SELECT * FROM message_attachments WHERE id = ? AND user_id = ?",
-                  (attachment_id, user_id))
-    else:
-        c.execute("SELECT * FROM message_attachments WHERE id = ?", (attachment_id,))
 
-    row = c.fetchone()
-    conn.close()
+class MultipartUpload:
+    """
+    Streaming multipart/form-data parser for an upload's "file" field.
+
+    feed() takes the request body as it arrives; the file part's data goes
+    straight into an AttachmentWriter and every other part is ignored.
+    finish() commits the file to the attachment store.
+    """
+
+    def __init__(self, boundary: bytes, max_bytes: int = ATTACHMENT_MAX_BYTES):
+        self.writer: Optional[AttachmentWriter] = None
+        self.max_bytes = max_bytes
+        # Room for the multipart framing and small form fields around the file
+        self.max_body = max_bytes + 64 * 1024
+        self.received = 0
+        self._target: Optional[AttachmentWriter] = None
+        self._headers: Dict[bytes, bytes] = {}
+        self._field = b""
+        self._value = b""
+        self.parser = MultipartParser(boundary, {
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+        })
+
+    def _on_part_begin(self):
+        self._headers = {}
+
+    def _on_header_field(self, data: bytes, start: int, end: int):
+        self._field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int):
+        self._value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[self._field.lower()] = self._value
+        self._field = self._value = b""
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        if options.get(b"name") == b"file" and self.writer is None:
+            self.writer = self._target = AttachmentWriter(self.max_bytes)
+
+    def _on_part_data(self, data: bytes, start: int, end: int):
+        if self._target is not None:
+            self._target.write(data[start:end])
+
+    def _on_part_end(self):
+        self._target = None
+
+    def feed(self, chunk: bytes):
+        self.received += len(chunk)
+        if self.received > self.max_body:
+            raise AttachmentRejected(f"Upload exceeds {self.max_body} bytes", status_code=413)
+        self.parser.write(chunk)
+
+    def finish(self, user_id: int) -> dict:
+        self.parser.finalize()
+        if self.writer is None:
+            raise AttachmentRejected('No "file" part in upload')
+        writer, self.writer = self.writer, None
+        return writer.commit(user_id)
+
+    def close(self):
+        """Discard an upload that was not committed."""
+        if self.writer is not None:
+            self.writer.abort()
+            self.writer = None
+
+
+def get_attachment(attachment_id: int, user_id: int = None):
+    """Get attachment info by ID, optionally verify user ownership."""
+    with get_db() as conn:
+        c = conn.cursor()
+        if user_id:
+            c.execute("SELECT * FROM message_attachments WHERE id = ? AND user_id = ?",
+                      (attachment_id, user_id))
+        else:
+            c.execute("SELECT * FROM message_attachments WHERE id = ?", (attachment_id,))
+        row = c.fetchone()
 
     if not row:
         return None
@@ -642,155 +1217,252 @@ def get_attachment(attachment_id: int, user_id: int = None):
 
 def get_message_attachments(message_id: int) -> list:
     """Get all attachments for a message."""
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        """SELECT id, filename, mime_type, file_size, created_at, expires_at
-           FROM message_attachments
-           WHERE message_id = ? AND expires_at > ?""",
-        (message_id, datetime.now().isoformat())
-    )
-    rows = c.fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+    return get_attachments_for_messages([message_id]).get(message_id, [])
+
+
+# Stay well under SQLite's bound-parameter limit for IN (...) lists
+ATTACHMENT_BATCH_SIZE = 500
+
+
+def get_attachments_for_messages(message_ids: List[int], conn: sqlite3.Connection = None) -> Dict[int, List[dict]]:
+    """
+    Get non-expired attachments for many messages at once.
 
+    Runs one IN-query per ATTACHMENT_BATCH_SIZE ids and groups the rows in
+    memory, returning {message_id: [attachment, ...]} (messages without
+    attachments are omitted). Pass `conn` to reuse an already borrowed
+    connection.
+    """
+    if not message_ids:
+        return {}
+    if conn is None:
+        with get_db() as conn:
+            return get_attachments_for_messages(message_ids, conn)
 
-def link_attachment_to_message(attachment_id: int, message_id: int):
-    """Link an attachment to a message after the message is created."""
-    conn = get_db()
+    now = datetime.now().isoformat()
+    ids = list(dict.fromkeys(message_ids))
+    grouped: Dict[int, List[dict]] = {}
     c = conn.cursor()
-    c.execute("UPDATE message_attachments SET message_id = ? WHERE id = ?",
-              (message_id, attachment_id))
-    conn.commit()
-    conn.close()
+    for start in range(0, len(ids), ATTACHMENT_BATCH_SIZE):
+        batch = ids[start:start + ATTACHMENT_BATCH_SIZE]
+        placeholders = ",".join("?" * len(batch))
+        c.execute(
+            f"""SELECT id, message_id, filename, mime_type, file_size, created_at, expires_at
+                FROM message_attachments
+                WHERE message_id IN ({placeholders}) AND expires_at > ?
+                ORDER BY id""",
+            (*batch, now)
+        )
+        for row in c.fetchall():
+            grouped.setdefault(row["message_id"], []).append(dict(row))
+    return grouped
+
+
+def attachment_api_info(attachment: dict) -> dict:
+    """Client-facing representation of an attachment row."""
+    return {
+        "id": attachment["id"],
+        "url": f"/api/attachments/{attachment['id']}",
+        "download_url": f"/api/attachments/{attachment['id']}/download",
+        "mime_type": attachment["mime_type"],
+        "expires_at": attachment["expires_at"]
+    }
+
+
+def link_attachments_to_message(c, user_id: int, message_id: int, attachment_ids: List[int]):
+    """
+    Link the user's unlinked attachments to a message, in the caller's
+    transaction. An attachment that is gone or already on another message
+    (a concurrent send claimed it first) raises AttachmentRejected, so the
+    caller's transaction rolls back.
+    """
+    for attachment_id in attachment_ids:
+        c.execute("UPDATE message_attachments SET message_id = ? WHERE id = ? AND user_id = ? AND message_id IS NULL",
+                  (message_id, attachment_id, user_id))
+        if c.rowcount != 1:
+            raise AttachmentRejected(f"Attachment {attachment_id} not found or already sent", status_code=409)
 
 
 def cleanup_expired_attachments():
-    """Delete expired attachments from disk and database."""
-    conn = get_db()
-    c = conn.cursor()
+    """
+    Delete expired attachments from the database, and from disk each
+    blob whose last reference went with them (older attachments own their
+    file outright). Stale temp files from abandoned uploads go too.
+    """
+    now = datetime.now()
+    with get_db() as conn:
+        c = conn.cursor()
 
-    # Find expired attachments
-    c.execute("SELECT id, filename FROM message_attachments WHERE expires_at < ?",
-              (datetime.now().isoformat(),))
-    expired = c.fetchall()
+        # Find and drop expired attachments
+        c.execute("SELECT filename, content_hash FROM message_attachments WHERE expires_at < ?",
+                  (now.isoformat(),))
+        expired = c.fetchall()
+        c.execute("DELETE FROM message_attachments WHERE expires_at < ?",
+                  (now.isoformat(),))
+
+        # Release their blob references
+        released = Counter(row["content_hash"] for row in expired if row["content_hash"])
+        c.executemany("UPDATE attachment_blobs SET refcount = refcount - ? WHERE hash = ?",
+                      [(count, digest) for digest, count in released.items()])
+        c.execute("SELECT hash, filename FROM attachment_blobs WHERE refcount <= 0")
+        unreferenced = c.fetchall()
+        c.executemany("DELETE FROM attachment_blobs WHERE hash = ?", [(row["hash"],) for row in unreferenced])
+
+        # Unlink while the transaction is held, so no upload can re-reference a blob mid-delete
+        filenames = [row["filename"] for row in expired if not row["content_hash"]]
+        filenames += [row["filename"] for row in unreferenced]
+        for filename in filenames:
+            filepath = os.path.join(UPLOADS_DIR, filename)
+            try:
+                if os.path.exists(filepath):
+                    os.remove(filepath)
+            except Exception as e:
+                print(f"Error deleting file {filepath}: {e}")
 
-    deleted_count = 0
-    for row in expired:
-        # Delete file
-        filepath = os.path.join(UPLOADS_DIR, row["filename"])
+    cutoff = now.timestamp() - 3600
+    for entry in os.scandir(ATTACHMENT_TEMP_DIR):
         try:
-            if os.path.exists(filepath):
-                os.remove(filepath)
-            deleted_count += 1
-        except Exception as e:
-            print(f"Error deleting file {filepath}: {e}")
-
-    # Delete from database
-    c.execute("DELETE FROM message_attachments WHERE expires_at < ?",
-              (datetime.now().isoformat(),))
-    conn.commit()
-    conn.close()
+            if entry.name.endswith(".part") and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except OSError:
+            pass
 
+    deleted_count = len(expired)
     if deleted_count > 0:
-        print(f"Cleaned up {deleted_count} expired attachments")
+        print(f"Cleaned up {deleted_count} expired attachments ({len(unreferenced)} files released)")
 
     return deleted_count
 
 
-def save_message(user_id: int, role: str, content: str, model: str, session_id: int = None, is_partial: bool = False):
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "INSERT INTO chat_history (user_id, role, content, model, created_at, session_id, is_partial) VALUES (?, ?, ?, ?, ?, ?, ?)",
-        (user_id, role, content, model, datetime.now().isoformat(), session_id, 1 if is_partial else 0)
-    )
-    msg_id = c.lastrowid
+def save_message(user_id: int, role: str, content: str, model: str, session_id: int = None, is_partial: bool = False,
+                 attachment_ids: List[int] = None):
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute(
+            """INSERT INTO chat_history (user_id, role, content, model, created_at, session_id, is_partial, token_count)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+            (user_id, role, content, model, datetime.now().isoformat(), session_id, 1 if is_partial else 0,
+             estimate_tokens(content))
+        )
+        msg_id = c.lastrowid
+        if attachment_ids:
+            link_attachments_to_message(c, user_id, msg_id, attachment_ids)
 
-    # Update session's updated_at timestamp
-    if session_id:
-        c.execute("UPDATE chat_sessions SET updated_at = ? WHERE id = ?",
-                  (datetime.now().isoformat(), session_id))
-
-        # Auto-title session from first user message
-        if role == "user":
-            c.execute("SELECT name, (SELECT COUNT(*) FROM chat_history WHERE session_id = ?) as msg_count FROM chat_sessions WHERE id = ?",
-                      (session_id, session_id))
-            row = c.fetchone()
-            if row and row["name"] == "New Chat" and row["msg_count"] == 1:
-                new_title = generate_session_title(content)
-                c.execute("UPDATE chat_sessions SET name = ? WHERE id = ?", (new_title, session_id))
+        # Update session's timestamps and denormalized listing stats
+        if session_id:
+            now = datetime.now().isoformat()
+            c.execute(
+                """UPDATE chat_sessions SET
+                   updated_at = ?, last_message_at = ?, message_count = message_count + 1,
+                   preview = COALESCE(preview, ?)
+                   WHERE id = ?""",
+                (now, now, make_session_preview(content) if role == "user" else None, session_id)
+            )
+
+            # Auto-title session from first user message
+            if role == "user":
+                c.execute("SELECT name, message_count FROM chat_sessions WHERE id = ?", (session_id,))
+                row = c.fetchone()
+                if row and row["name"] == "New Chat" and row["message_count"] == 1:
+                    new_title = generate_session_title(content)
+                    c.execute("UPDATE chat_sessions SET name = ? WHERE id = ?", (new_title, session_id))
 
-    conn.commit()
-    conn.close()
     return msg_id
 
 
 def update_message(msg_id: int, content: str, is_partial: bool = False):
     """Update an existing message's content."""
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("UPDATE chat_history SET content = ?, is_partial = ? WHERE id = ?",
-              (content, 1 if is_partial else 0, msg_id))
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        conn.execute("UPDATE chat_history SET content = ?, is_partial = ?, token_count = ? WHERE id = ?",
+                     (content, 1 if is_partial else 0, estimate_tokens(content), msg_id))
+        # A summary that covers the edited message is stale
+        conn.execute(
+            """DELETE FROM session_summaries WHERE through_id >= ?
+               AND session_id = (SELECT session_id FROM chat_history WHERE id = ?)""",
+            (msg_id, msg_id)
+        )
 
 
-def load_chat_history(user_id: int, limit: int = 50, session_id: int = None, include_attachments: bool = False) -> List[dict]:
-    conn = get_db()
-    c = conn.cursor()
+def load_chat_history(user_id: int, limit: int = 50, session_id: int = None, include_attachments: bool = False,
+                      before_id: int = None, after_id: int = None) -> List[dict]:
+    return load_chat_history_page(user_id, limit, session_id, include_attachments, before_id, after_id)[0]
+
+
+def load_chat_history_page(user_id: int, limit: int = 50, session_id: int = None, include_attachments: bool = False,
+                           before_id: int = None, after_id: int = None) -> tuple[List[dict], bool]:
+    """
+    Keyset page of chat history, returned oldest-first.
+
+    By default (or with before_id) returns the newest `limit` messages older
+    than before_id; with only after_id returns the oldest `limit` messages
+    newer than after_id. has_more refers to the scan direction.
+    """
+    conditions = ["user_id = ?"]
+    params: list = [user_id]
     if session_id:
+        conditions.append("session_id = ?")
+        params.append(session_id)
+    if before_id is not None:
+        conditions.append("id < ?")
+        params.append(before_id)
+    if after_id is not None:
+        conditions.append("id > ?")
+        params.append(after_id)
+    newest_first = after_id is None or before_id is not None
+
+    with get_db() as conn:
+        c = conn.cursor()
         c.execute(
-            "SELECT id, role, content, model, is_partial FROM chat_history WHERE user_id = ? AND session_id = ? ORDER BY id DESC LIMIT ?",
-            (user_id, session_id, limit)
-        )
-    else:
-        c.execute(
-            "SELECT id, role, content, model, is_partial FROM chat_history WHERE user_id = ? ORDER BY id DESC LIMIT ?",
-            (user_id, limit)
+            f"""SELECT id, role, content, model, is_partial, token_count FROM chat_history
+                WHERE {" AND ".join(conditions)}
+                ORDER BY id {"DESC" if newest_first else "ASC"} LIMIT ?""",
+            (*params, limit + 1)  # +1 to check if there are more
         )
-    rows = c.fetchall()
+        rows = c.fetchall()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if newest_first:
+            rows.reverse()
+
+        # Include attachments if requested (one batched query for the page)
+        attachments = get_attachments_for_messages([r["id"] for r in rows], conn) if include_attachments else {}
 
     messages = []
-    for r in reversed(rows):
+    for r in rows:
         msg = {
             "id": r["id"],
             "role": r["role"],
             "content": r["content"],
             "model": r["model"],
-            "is_partial": bool(r["is_partial"])
+            "is_partial": bool(r["is_partial"]),
+            "tokens": r["token_count"] if r["token_count"] is not None else estimate_tokens(r["content"])
         }
-
-        # Include attachments if requested
-        if include_attachments:
-            attachments = get_message_attachments(r["id"])
-            if attachments:
-                msg["attachments"] = [{
-                    "id": a["id"],
-                    "url": f"/api/attachments/{a['id']}",
-                    "download_url": f"/api/attachments/{a['id']}/download",
-                    "mime_type": a["mime_type"],
-                    "expires_at": a["expires_at"]
-                } for a in attachments]
-
+        if r["id"] in attachments:
+            msg["attachments"] = [attachment_api_info(a) for a in attachments[r["id"]]]
         messages.append(msg)
 
-    conn.close()
-    return messages
+    return messages, has_more
 
 
 def clear_chat_history(user_id: int, session_id: int = None):
-    conn = get_db()
-    c = conn.cursor()
-    if session_id:
-        c.execute("DELETE FROM chat_history WHERE user_id = ? AND session_id = ?", (user_id, session_id))
-        # Also delete artifacts for this session
-        c.execute("DELETE FROM artifacts WHERE user_id = ? AND session_id = ?", (user_id, session_id))
-    else:
-        c.execute("DELETE FROM chat_history WHERE user_id = ?", (user_id,))
-        c.execute("DELETE FROM artifacts WHERE user_id = ?", (user_id,))
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        c = conn.cursor()
+        if session_id:
+            c.execute("DELETE FROM chat_history WHERE user_id = ? AND session_id = ?", (user_id, session_id))
+            # Also delete artifacts and the summary for this session
+            c.execute("SELECT content_hash FROM artifacts WHERE user_id = ? AND session_id = ?", (user_id, session_id))
+            hashes = [row[0] for row in c.fetchall()]
+            c.execute("DELETE FROM artifacts WHERE user_id = ? AND session_id = ?", (user_id, session_id))
+            prune_artifact_blobs(c, hashes)
+            c.execute("DELETE FROM session_summaries WHERE user_id = ? AND session_id = ?", (user_id, session_id))
+        else:
+            c.execute("DELETE FROM chat_history WHERE user_id = ?", (user_id,))
+            c.execute("SELECT content_hash FROM artifacts WHERE user_id = ?", (user_id,))
+            hashes = [row[0] for row in c.fetchall()]
+            c.execute("DELETE FROM artifacts WHERE user_id = ?", (user_id,))
+            prune_artifact_blobs(c, hashes)
+            c.execute("DELETE FROM session_summaries WHERE user_id = ?", (user_id,))
+        refresh_session_stats(c, user_id=user_id, session_id=session_id)
     # Also clear from Chroma
     if CHROMA_AVAILABLE:
         try:
@@ -805,75 +1477,64 @@ def clear_chat_history(user_id: int, session_id: int = None):
 
 def create_session(user_id: int, name: str = "New Chat") -> int:
     """Create a new chat session and return its ID."""
-    conn = get_db()
-    c = conn.cursor()
     now = datetime.now().isoformat()
-    c.execute(
-        "INSERT INTO chat_sessions (user_id, name, created_at, updated_at) VALUES (?, ?, ?, ?)",
-        (user_id, name, now, now)
-    )
-    session_id = c.lastrowid
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute(
+            "INSERT INTO chat_sessions (user_id, name, created_at, updated_at) VALUES (?, ?, ?, ?)",
+            (user_id, name, now, now)
+        )
+        session_id = c.lastrowid
     return session_id
 
 
-def get_sessions(user_id: int, limit: int = 20, offset: int = 0) -> tuple[List[dict], bool]:
-    """Get user's sessions with preview, ordered by most recent."""
-    conn = get_db()
-    c = conn.cursor()
-
-    # Get sessions
-    c.execute(
-        """SELECT id, name, created_at, updated_at
-           FROM chat_sessions
-           WHERE user_id = ?
-           ORDER BY updated_at DESC
-           LIMIT ? OFFSET ?""",
-        (user_id, limit + 1, offset)  # +1 to check if there are more
-    )
-    rows = c.fetchall()
-    has_more = len(rows) > limit
-    sessions = []
+def get_sessions(user_id: int, limit: int = 20, offset: int = 0,
+                 before: tuple = None) -> tuple[List[dict], bool]:
+    """
+    Get user's sessions with preview, ordered by most recent.
 
-    for row in rows[:limit]:
-        # Get first message as preview
+    `before` is an (updated_at, id) keyset cursor: only sessions strictly
+    after it in (updated_at DESC, id DESC) order are returned. `offset` is
+    kept for older clients.
+    """
+    keyset, params = "", ()
+    if before:
+        keyset, params = " AND (updated_at, id) < (?, ?)", tuple(before)
+    with get_db() as conn:
+        c = conn.cursor()
         c.execute(
-            """SELECT content FROM chat_history
-               WHERE session_id = ? AND role = 'user'
-               ORDER BY id ASC LIMIT 1""",
-            (row["id"],)
+            f"""SELECT id, name, created_at, updated_at, message_count, preview, last_message_at
+                FROM chat_sessions
+                WHERE user_id = ?{keyset}
+                ORDER BY updated_at DESC, id DESC
+                LIMIT ? OFFSET ?""",
+            (user_id, *params, limit + 1, offset)  # +1 to check if there are more
         )
-        preview_row = c.fetchone()
-        preview = preview_row["content"][:100] + "..." if preview_row and len(preview_row["content"]) > 100 else (preview_row["content"] if preview_row else "")
+        rows = c.fetchall()
 
-        # Get message count
-        c.execute("SELECT COUNT(*) as count FROM chat_history WHERE session_id = ?", (row["id"],))
-        count = c.fetchone()["count"]
-
-        sessions.append({
-            "id": row["id"],
-            "name": row["name"],
-            "preview": preview,
-            "message_count": count,
-            "created_at": row["created_at"],
-            "updated_at": row["updated_at"]
-        })
+    has_more = len(rows) > limit
+    sessions = [{
+        "id": row["id"],
+        "name": row["name"],
+        "preview": row["preview"] or "",
+        "message_count": row["message_count"],
+        "created_at": row["created_at"],
+        "updated_at": row["updated_at"],
+        "last_message_at": row["last_message_at"]
+    } for row in rows[:limit]]
 
-    conn.close()
     return sessions, has_more
 
 
 def get_session(user_id: int, session_id: int) -> Optional[dict]:
     """Get a specific session."""
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "SELECT id, name, created_at, updated_at FROM chat_sessions WHERE id = ? AND user_id = ?",
-        (session_id, user_id)
-    )
-    row = c.fetchone()
-    conn.close()
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute(
+            "SELECT id, name, created_at, updated_at FROM chat_sessions WHERE id = ? AND user_id = ?",
+            (session_id, user_id)
+        )
+        row = c.fetchone()
     if row:
         return {
             "id": row["id"],
@@ -886,46 +1547,78 @@ def get_session(user_id: int, session_id: int) -> Optional[dict]:
 
 def rename_session(user_id: int, session_id: int, new_name: str) -> bool:
     """Rename a session."""
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "UPDATE chat_sessions SET name = ?, updated_at = ? WHERE id = ? AND user_id = ?",
-        (new_name, datetime.now().isoformat(), session_id, user_id)
-    )
-    updated = c.rowcount > 0
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute(
+            "UPDATE chat_sessions SET name = ?, updated_at = ? WHERE id = ? AND user_id = ?",
+            (new_name, datetime.now().isoformat(), session_id, user_id)
+        )
+        updated = c.rowcount > 0
     return updated
 
 
 def delete_session(user_id: int, session_id: int) -> bool:
     """Delete a session and all its messages and artifacts."""
-    conn = get_db()
-    c = conn.cursor()
+    with get_db() as conn:
+        c = conn.cursor()
 
-    # Delete artifacts first
-    c.execute("DELETE FROM artifacts WHERE session_id = ? AND user_id = ?", (session_id, user_id))
-    # Delete messages
-    c.execute("DELETE FROM chat_history WHERE session_id = ? AND user_id = ?", (session_id, user_id))
-    # Delete session
-    c.execute("DELETE FROM chat_sessions WHERE id = ? AND user_id = ?", (session_id, user_id))
-    deleted = c.rowcount > 0
+        # Delete artifacts first (user-level copies keep their blobs)
+        c.execute("SELECT content_hash FROM artifacts WHERE session_id = ? AND user_id = ?", (session_id, user_id))
+        hashes = [row[0] for row in c.fetchall()]
+        c.execute("DELETE FROM artifacts WHERE session_id = ? AND user_id = ?", (session_id, user_id))
+        prune_artifact_blobs(c, hashes)
+        # Delete messages and their summary
+        c.execute("DELETE FROM chat_history WHERE session_id = ? AND user_id = ?", (session_id, user_id))
+        c.execute("DELETE FROM session_summaries WHERE session_id = ? AND user_id = ?", (session_id, user_id))
+        # Delete session
+        c.execute("DELETE FROM chat_sessions WHERE id = ? AND user_id = ?", (session_id, user_id))
+        deleted = c.rowcount > 0
 
-    conn.commit()
-    conn.close()
     return deleted
 
 
+def get_prompt_window(session_id: int) -> Optional[int]:
+    """Id of the first message in the session's stable prompt window, if compacted."""
+    with get_db() as conn:
+        row = conn.execute("SELECT prompt_window_start FROM chat_sessions WHERE id = ?", (session_id,)).fetchone()
+    return row["prompt_window_start"] if row else None
+
+
+def set_prompt_window(session_id: int, message_id: int):
+    with get_db() as conn:
+        conn.execute("UPDATE chat_sessions SET prompt_window_start = ? WHERE id = ?", (message_id, session_id))
+
+
+def get_session_summary(session_id: int) -> Optional[dict]:
+    with get_db() as conn:
+        row = conn.execute(
+            "SELECT through_id, content, model, source_tokens, created_at FROM session_summaries WHERE session_id = ?",
+            (session_id,)
+        ).fetchone()
+    return dict(row) if row else None
+
+
+def save_session_summary(session_id: int, user_id: int, through_id: int, content: str,
+                         model: str, source_tokens: int):
+    with get_db() as conn:
+        # Only if the session still exists (it may have been deleted while summarising)
+        conn.execute(
+            """INSERT OR REPLACE INTO session_summaries
+               (session_id, user_id, through_id, content, model, source_tokens, created_at)
+               SELECT id, ?, ?, ?, ?, ?, ? FROM chat_sessions WHERE id = ? AND user_id = ?""",
+            (user_id, through_id, content, model, source_tokens, datetime.now().isoformat(), session_id, user_id)
+        )
+
+
 def get_or_create_active_session(user_id: int) -> int:
     """Get most recent session or create a new one."""
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "SELECT id FROM chat_sessions WHERE user_id = ? ORDER BY updated_at DESC LIMIT 1",
-        (user_id,)
-    )
-    row = c.fetchone()
-    conn.close()
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute(
+            "SELECT id FROM chat_sessions WHERE user_id = ? ORDER BY updated_at DESC LIMIT 1",
+            (user_id,)
+        )
+        row = c.fetchone()
 
     if row:
         return row["id"]
@@ -936,46 +1629,84 @@ def get_or_create_active_session(user_id: int) -> int:
 # Artifact Functions
 # =============================================================================
 
-def save_artifact(session_id: int, user_id: int, artifact_type: str, content: str,
-                  language: str = None, title: str = None) -> int:
-    """Save an artifact to both session-bound and user-level tables."""
-    now = datetime.now().isoformat()
-    conn = get_db()
-    c = conn.cursor()
+def artifact_content_hash(content: str) -> str:
+    """SHA-256 of an artifact's text: its key in artifact_blobs."""
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
 
-    # Save to session-bound artifacts (legacy)
-    c.execute(
-        """INSERT INTO artifacts (session_id, user_id, type, language, title, content, created_at)
-           VALUES (?, ?, ?, ?, ?, ?, ?)""",
-        (session_id, user_id, artifact_type, language, title, content, now)
-    )
-    artifact_id = c.lastrowid
 
-    # Also save to user-level persistent artifacts
-    c.execute(
-        """INSERT INTO user_artifacts (user_id, type, language, title, content, source_session_id, created_at)
-           VALUES (?, ?, ?, ?, ?, ?, ?)""",
-        (user_id, artifact_type, language, title, content, session_id, now)
+def prune_artifact_blobs(c: sqlite3.Cursor, hashes: List[str]):
+    """Drop blobs among `hashes` that no artifact row references any more."""
+    c.executemany(
+        """DELETE FROM artifact_blobs WHERE hash = ?
+           AND NOT EXISTS (SELECT 1 FROM artifacts WHERE content_hash = ?)
+           AND NOT EXISTS (SELECT 1 FROM user_artifacts WHERE content_hash = ?)""",
+        [(digest, digest, digest) for digest in set(hashes) if digest]
     )
 
-    conn.commit()
-    conn.close()
-    return artifact_id
+
+def save_artifacts(session_id: int, user_id: int, artifacts: List[dict], message_id: int = None) -> List[dict]:
+    """
+    Save a reply's artifacts to both session-bound and user-level tables.
+
+    Everything goes in one transaction. Each distinct text is stored once
+    in artifact_blobs and referenced by hash; artifacts the message already
+    has (a continued reply finds its prefix's again) or repeats within the
+    reply are skipped. Returns the artifacts actually inserted.
+    """
+    pending = {}
+    for artifact in artifacts:
+        digest = artifact_content_hash(artifact["content"])
+        pending.setdefault((artifact["type"], digest), artifact)
+    if not pending:
+        return []
+
+    now = datetime.now().isoformat()
+    with get_db() as conn:
+        c = conn.cursor()
+        if message_id is not None:
+            c.execute("SELECT type, content_hash FROM artifacts WHERE message_id = ? AND user_id = ?",
+                      (message_id, user_id))
+            for row in c.fetchall():
+                pending.pop((row["type"], row["content_hash"]), None)
+        if not pending:
+            return []
+
+        c.executemany(
+            "INSERT OR IGNORE INTO artifact_blobs (hash, content, size, created_at) VALUES (?, ?, ?, ?)",
+            [(digest, a["content"], len(a["content"].encode("utf-8")), now) for (_, digest), a in pending.items()]
+        )
+        # Session-bound artifacts (legacy)
+        c.executemany(
+            """INSERT INTO artifacts (session_id, user_id, message_id, type, language, title,
+                                      content, content_hash, created_at)
+               VALUES (?, ?, ?, ?, ?, ?, '', ?, ?)""",
+            [(session_id, user_id, message_id, a["type"], a["language"], a["title"], digest, now)
+             for (_, digest), a in pending.items()]
+        )
+        # User-level persistent artifacts
+        c.executemany(
+            """INSERT INTO user_artifacts (user_id, type, language, title, content, content_hash,
+                                           source_session_id, created_at)
+               VALUES (?, ?, ?, ?, '', ?, ?, ?)""",
+            [(user_id, a["type"], a["language"], a["title"], digest, session_id, now)
+             for (_, digest), a in pending.items()]
+        )
+
+    return list(pending.values())
 
 
 def get_artifacts(session_id: int, user_id: int) -> dict:
     """Get artifacts for a session, grouped by type."""
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        """SELECT id, type, language, title, content, created_at
-           FROM artifacts
-           WHERE session_id = ? AND user_id = ?
-           ORDER BY created_at ASC""",
-        (session_id, user_id)
-    )
-    rows = c.fetchall()
-    conn.close()
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute(
+            """SELECT a.id, a.type, a.language, a.title, COALESCE(b.content, a.content) AS content, a.created_at
+               FROM artifacts a LEFT JOIN artifact_blobs b ON b.hash = a.content_hash
+               WHERE a.session_id = ? AND a.user_id = ?
+               ORDER BY a.created_at ASC""",
+            (session_id, user_id)
+        )
+        rows = c.fetchall()
 
     grouped = {"code": [], "thought": [], "document": []}
     for row in rows:
@@ -998,27 +1729,28 @@ def get_artifacts(session_id: int, user_id: int) -> dict:
 
 def get_user_artifacts(user_id: int, artifact_type: str = None) -> dict:
     """Get all persistent artifacts for a user, optionally filtered by type."""
-    conn = get_db()
-    c = conn.cursor()
+    with get_db() as conn:
+        c = conn.cursor()
 
-    if artifact_type:
-        c.execute(
-            """SELECT id, type, language, title, content, source_session_id, created_at
-               FROM user_artifacts
-               WHERE user_id = ? AND type = ?
-               ORDER BY created_at DESC""",
-            (user_id, artifact_type)
-        )
-    else:
-        c.execute(
-            """SELECT id, type, language, title, content, source_session_id, created_at
-               FROM user_artifacts
-               WHERE user_id = ?
-               ORDER BY created_at DESC""",
-            (user_id,)
-        )
-    rows = c.fetchall()
-    conn.close()
+        if artifact_type:
+            c.execute(
+                """SELECT a.id, a.type, a.language, a.title, COALESCE(b.content, a.content) AS content,
+                          a.source_session_id, a.created_at
+                   FROM user_artifacts a LEFT JOIN artifact_blobs b ON b.hash = a.content_hash
+                   WHERE a.user_id = ? AND a.type = ?
+                   ORDER BY a.created_at DESC""",
+                (user_id, artifact_type)
+            )
+        else:
+            c.execute(
+                """SELECT a.id, a.type, a.language, a.title, COALESCE(b.content, a.content) AS content,
+                          a.source_session_id, a.created_at
+                   FROM user_artifacts a LEFT JOIN artifact_blobs b ON b.hash = a.content_hash
+                   WHERE a.user_id = ?
+                   ORDER BY a.created_at DESC""",
+                (user_id,)
+            )
+        rows = c.fetchall()
 
     grouped = {"code": [], "thought": [], "document": []}
     for row in rows:
@@ -1041,28 +1773,30 @@ def get_user_artifacts(user_id: int, artifact_type: str = None) -> dict:
 
 def delete_user_artifact(artifact_id: int, user_id: int) -> bool:
     """Delete a user artifact by ID."""
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "DELETE FROM user_artifacts WHERE id = ? AND user_id = ?",
-        (artifact_id, user_id)
-    )
-    deleted = c.rowcount > 0
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("SELECT content_hash FROM user_artifacts WHERE id = ? AND user_id = ?", (artifact_id, user_id))
+        hashes = [row[0] for row in c.fetchall()]
+        c.execute(
+            "DELETE FROM user_artifacts WHERE id = ? AND user_id = ?",
+            (artifact_id, user_id)
+        )
+        deleted = c.rowcount > 0
+        prune_artifact_blobs(c, hashes)
     return deleted
 
 
 def get_artifact(artifact_id: int, user_id: int) -> Optional[dict]:
     """Get a single artifact by ID."""
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "SELECT id, type, language, title, content, created_at FROM artifacts WHERE id = ? AND user_id = ?",
-        (artifact_id, user_id)
-    )
-    row = c.fetchone()
-    conn.close()
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute(
+            """SELECT a.id, a.type, a.language, a.title, COALESCE(b.content, a.content) AS content, a.created_at
+               FROM artifacts a LEFT JOIN artifact_blobs b ON b.hash = a.content_hash
+               WHERE a.id = ? AND a.user_id = ?""",
+            (artifact_id, user_id)
+        )
+        row = c.fetchone()
     if row:
         return {
             "id": row["id"],
@@ -1075,24 +1809,65 @@ def get_artifact(artifact_id: int, user_id: int) -> Optional[dict]:
     return None
 
 
+def get_artifact_manifest(user_id: int, session_id: int = None) -> List[dict]:
+    """
+    Everything needed to lay out an artifact archive except the content:
+    a session's artifacts oldest first, or (no session_id) the user-level
+    artifacts newest first. `size` is the content's length in UTF-8 bytes.
+    """
+    if session_id is not None:
+        where, params, order = "a.session_id = ? AND a.user_id = ?", (session_id, user_id), "ASC"
+        table = "artifacts"
+    else:
+        where, params, order = "a.user_id = ?", (user_id,), "DESC"
+        table = "user_artifacts"
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute(
+            f"""SELECT a.id, a.type, a.language, a.title, a.created_at, a.content_hash,
+                       length(CAST(COALESCE(b.content, a.content) AS BLOB)) AS size
+                FROM {table} a LEFT JOIN artifact_blobs b ON b.hash = a.content_hash
+                WHERE {where}
+                ORDER BY a.created_at {order}, a.id {order}""",
+            params
+        )
+        rows = c.fetchall()
+    return [dict(row) for row in rows]
+
+
+def get_artifact_contents(artifact_ids: List[int], user_id: int, user_level: bool = False) -> Dict[int, str]:
+    """Content of the given artifacts (from user_artifacts if user_level), by id."""
+    if not artifact_ids:
+        return {}
+    table = "user_artifacts" if user_level else "artifacts"
+    placeholders = ",".join("?" * len(artifact_ids))
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute(
+            f"""SELECT a.id, COALESCE(b.content, a.content) AS content
+                FROM {table} a LEFT JOIN artifact_blobs b ON b.hash = a.content_hash
+                WHERE a.user_id = ? AND a.id IN ({placeholders})""",
+            (user_id, *artifact_ids)
+        )
+        return {row["id"]: row["content"] for row in c.fetchall()}
+
+
 # =============================================================================
 # Code Execution Functions
 # =============================================================================
 
 def create_execution(user_id: int, language: str, code: str, artifact_id: int = None) -> int:
     """Create a new execution record and return its ID."""
-    conn = get_db()
-    c = conn.cursor()
     now = datetime.now().isoformat()
-    c.execute(
-        """INSERT INTO code_executions
-           (user_id, artifact_id, language, code, status, created_at)
-           VALUES (?, ?, ?, ?, 'pending', ?)""",
-        (user_id, artifact_id, language, code, now)
-    )
-    execution_id = c.lastrowid
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute(
+            """INSERT INTO code_executions
+               (user_id, artifact_id, language, code, status, created_at)
+               VALUES (?, ?, ?, ?, 'pending', ?)""",
+            (user_id, artifact_id, language, code, now)
+        )
+        execution_id = c.lastrowid
     return execution_id
 
 
@@ -1100,33 +1875,29 @@ def update_execution(execution_id: int, status: str, stdout: str = None,
                      stderr: str = None, exit_code: int = None,
                      execution_time_ms: int = None, preview_html: str = None):
     """Update an execution record with results."""
-    conn = get_db()
-    c = conn.cursor()
     completed_at = datetime.now().isoformat() if status in ('completed', 'failed', 'timeout') else None
-    c.execute(
-        """UPDATE code_executions SET
-           status = ?, stdout = ?, stderr = ?, exit_code = ?,
-           execution_time_ms = ?, completed_at = ?, preview_html = ?
-           WHERE id = ?""",
-        (status, stdout, stderr, exit_code, execution_time_ms, completed_at, preview_html, execution_id)
-    )
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        conn.execute(
+            """UPDATE code_executions SET
+               status = ?, stdout = ?, stderr = ?, exit_code = ?,
+               execution_time_ms = ?, completed_at = ?, preview_html = ?
+               WHERE id = ?""",
+            (status, stdout, stderr, exit_code, execution_time_ms, completed_at, preview_html, execution_id)
+        )
 
 
 def get_execution(execution_id: int, user_id: int) -> Optional[dict]:
     """Get a single execution by ID."""
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        """SELECT id, user_id, artifact_id, language, code, status,
-                  stdout, stderr, exit_code, execution_time_ms,
-                  created_at, completed_at, preview_html
-           FROM code_executions WHERE id = ? AND user_id = ?""",
-        (execution_id, user_id)
-    )
-    row = c.fetchone()
-    conn.close()
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute(
+            """SELECT id, user_id, artifact_id, language, code, status,
+                      stdout, stderr, exit_code, execution_time_ms,
+                      created_at, completed_at, preview_html
+               FROM code_executions WHERE id = ? AND user_id = ?""",
+            (execution_id, user_id)
+        )
+        row = c.fetchone()
     if row:
         return dict(row)
     return None
@@ -1134,19 +1905,18 @@ def get_execution(execution_id: int, user_id: int) -> Optional[dict]:
 
 def get_executions_history(user_id: int, limit: int = 20) -> List[dict]:
     """Get execution history for a user."""
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        """SELECT id, artifact_id, language, status, exit_code,
-                  execution_time_ms, created_at, completed_at
-           FROM code_executions
-           WHERE user_id = ?
-           ORDER BY created_at DESC
-           LIMIT ?""",
-        (user_id, limit)
-    )
-    rows = c.fetchall()
-    conn.close()
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute(
+            """SELECT id, artifact_id, language, status, exit_code,
+                      execution_time_ms, created_at, completed_at
+               FROM code_executions
+               WHERE user_id = ?
+               ORDER BY created_at DESC
+               LIMIT ?""",
+            (user_id, limit)
+        )
+        rows = c.fetchall()
     return [dict(r) for r in rows]
 
 # =============================================================================
@@ -1232,249 +2002,3125 @@ def chroma_clear_user(user_id: int):
     except Exception as e:
         print(f"Chroma clear error: {e}")
 
+def get_response_cache_collection(client):
+    if not client:
+        return None
+    return client.get_or_create_collection(
+        name="response_cache",
+        metadata={"description": "BORAK response cache prompts", "hnsw:space": "cosine"}
+    )
+
+def chroma_cache_add(doc_id: str, text: str, metadata: dict):
+    if not CHROMA_AVAILABLE:
+        return
+    try:
+        collection = get_response_cache_collection(get_chroma_client())
+        if collection:
+            collection.upsert(ids=[doc_id], documents=[text], metadatas=[metadata])
+    except Exception as e:
+        print(f"Chroma cache save error: {e}")
+
+def chroma_cache_query(text: str, where: dict) -> Optional[tuple[str, float]]:
+    """Nearest cached prompt matching `where`, as (id, cosine similarity)."""
+    if not CHROMA_AVAILABLE:
+        return None
+    try:
+        collection = get_response_cache_collection(get_chroma_client())
+        if not collection:
+            return None
+        results = collection.query(query_texts=[text], n_results=1, where=where)
+        if not results["ids"] or not results["ids"][0]:
+            return None
+        return results["ids"][0][0], 1.0 - results["distances"][0][0]
+    except Exception as e:
+        print(f"Chroma cache query error: {e}")
+        return None
+
+def chroma_cache_delete(doc_ids: List[str] = None, older_than: float = None):
+    if not CHROMA_AVAILABLE:
+        return
+    try:
+        collection = get_response_cache_collection(get_chroma_client())
+        if not collection:
+            return
+        if doc_ids:
+            collection.delete(ids=doc_ids)
+        if older_than is not None:
+            collection.delete(where={"created_at": {"$lt": older_than}})
+    except Exception as e:
+        print(f"Chroma cache delete error: {e}")
+
+# =============================================================================
+# Async Data Access (keeps blocking work off the event loop)
+# =============================================================================
+
+class LazyExecutor:
+    """
+    A ThreadPoolExecutor created on first use, and again after shutdown(),
+    so the app's lifespan can run more than once per process (one
+    TestClient per test, say).
+    """
+
+    def __init__(self, max_workers: int, thread_name_prefix: str):
+        self.max_workers = max_workers
+        self.thread_name_prefix = thread_name_prefix
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def get(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix=self.thread_name_prefix)
+            return self._executor
+
+    def shutdown(self, wait: bool = True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+# SQLite calls run on a dedicated pool sized to the connection pool, so a
+# worker never waits on a connection; bcrypt gets its own small CPU pool so
+# a burst of logins cannot starve history/session queries (or vice versa).
+# File I/O (generation journals, attachment reads) has a pool of its own too,
+# and so does ZIP compression, so large exports cannot hold up logins.
+db_executor = LazyExecutor(DB_POOL_SIZE, "borak-db")
+cpu_executor = LazyExecutor(CPU_EXECUTOR_WORKERS, "borak-cpu")
+io_executor = LazyExecutor(IO_EXECUTOR_WORKERS, "borak-io")
+zip_executor = LazyExecutor(ZIP_EXECUTOR_WORKERS, "borak-zip")
+
+
+async def run_db(fn, *args, **kwargs):
+    """Run a blocking data helper on the DB thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor.get(), functools.partial(fn, *args, **kwargs))
+
+
+async def run_cpu(fn, *args, **kwargs):
+    """Run CPU-heavy work (password hashing) on the CPU thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(cpu_executor.get(), functools.partial(fn, *args, **kwargs))
+
+
+async def run_io(fn, *args, **kwargs):
+    """Run blocking file I/O (journals, attachment files) on the I/O thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(io_executor.get(), functools.partial(fn, *args, **kwargs))
+
+
+async def run_zip(fn, *args, **kwargs):
+    """Run ZIP compression on the export thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(zip_executor.get(), functools.partial(fn, *args, **kwargs))
+
+
+class AsyncDataAccess:
+    """
+    Awaitable facade over the sync data helpers.
+
+    Every helper in `helpers` is exposed under the same name as a coroutine
+    that runs on the DB pool: `await adb.save_message(...)`. Helpers that
+    mix hashing and SQL are composed explicitly so each part runs on the
+    right pool.
+    """
+
+    def __init__(self, helpers):
+        for fn in helpers:
+            setattr(self, fn.__name__, self._wrap(fn))
+
+    @staticmethod
+    def _wrap(fn):
+        @functools.wraps(fn)
+        async def call(*args, **kwargs):
+            return await run_db(fn, *args, **kwargs)
+        return call
+
+    async def register_user(self, username: str, password: str) -> tuple[bool, str]:
+        password_hash = await run_cpu(hash_password, password)
+        return await run_db(insert_user, username, password_hash)
+
+    async def verify_user(self, username: str, password: str) -> Optional[int]:
+        result = await run_db(get_user_credentials, username)
+        if result and await run_cpu(check_password, password, result["password_hash"]):
+            return result["id"]
+        return None
+
+
+adb = AsyncDataAccess([
+    get_username, get_user_settings, update_user_settings, get_system_prompt_for_model,
+    log_usage, save_attachment, get_attachment, get_message_attachments, get_attachments_for_messages,
+    cleanup_expired_attachments,
+    save_message, update_message, load_chat_history, load_chat_history_page, clear_chat_history,
+    create_session, get_sessions, get_session, rename_session, delete_session,
+    get_or_create_active_session, get_prompt_window, set_prompt_window,
+    get_session_summary, save_session_summary,
+    save_artifacts, get_artifacts, get_user_artifacts, delete_user_artifact, get_artifact,
+    get_artifact_manifest, get_artifact_contents,
+    create_execution, update_execution, get_execution, get_executions_history,
+    chroma_save_message, chroma_load_history, chroma_clear_user,
+    chroma_cache_add, chroma_cache_query, chroma_cache_delete,
+])
+
 # =============================================================================
 # Background Generation (survives connection drops)
 # =============================================================================
+#
+# Each generation streams into an append-only journal, STREAM_CACHE_DIR/<id>.log:
+# one JSON record per line ({"seq", "type", ...}), flushed on every append and
+# fsynced at most every STREAM_JOURNAL_FSYNC_SECONDS. A record is only visible
+# to readers once its trailing newline is on disk, so a reader tailing from a
+# byte offset never sees a torn write. On completion the journal is compacted
+# into <id>.json (written to a temp file, then os.replace) and the log removed.
 
-def get_generation_path(user_id: int) -> str:
-    return os.path.join(STREAM_CACHE_DIR, f"gen_{user_id}.json")
+GENERATION_ID_RE = re.compile(r"^(\d+)-[0-9a-f]{32}$")
 
-def start_background_generation(user_id: int, messages: List[dict], model: str, images: List[str] = None):
-    gen_path = get_generation_path(user_id)
-    state = {
-        "status": "running",
-        "content": "",
-        "error": None,
-        "started": datetime.now().isoformat(),
-        "updated": datetime.now().isoformat(),
-        "usage": None
-    }
-    with open(gen_path, 'w') as f:
-        json.dump(state, f)
+def new_generation_id(user_id: int) -> str:
+    return f"{user_id}-{uuid.uuid4().hex}"
+
+def generation_owner(generation_id: str) -> Optional[int]:
+    """User id encoded in a generation id, or None if the id is malformed."""
+    match = GENERATION_ID_RE.match(generation_id or "")
+    return int(match.group(1)) if match else None
+
+def get_generation_paths(generation_id: str) -> tuple:
+    """(journal_path, snapshot_path) for a generation."""
+    base = os.path.join(STREAM_CACHE_DIR, generation_id)
+    return base + ".log", base + ".json"
+
+
+class StreamJournal:
+    """
+    Writer side of a generation journal. Single writer per generation.
+
+    Deltas are appended as {"seq", "type": "delta", "content"} records;
+    close() appends the terminal record and writes the compacted snapshot,
+    which keeps the full content plus [seq, end_offset] marks so a reader
+    that last saw event `seq` can still resume from the right character.
+    The terminal record's fields are kept in the snapshot as "final".
+
+    Created on an event loop, the journal only encodes records there: each
+    tick's records are written as one batch on the DB pool, which also does
+    the periodic fsync and, after finish(), the snapshot compaction; drain()
+    waits for both. Created elsewhere (a worker thread), it writes inline.
+    If a write fails the journal is closed with an error snapshot (or the
+    terminal one, if finish() already built it), so readers still see an end.
+    """
 
-    def generate():
-        nonlocal state
+    def __init__(self, generation_id: str, meta: dict = None):
+        self.generation_id = generation_id
+        self.log_path, self.snapshot_path = get_generation_paths(generation_id)
+        self.seq = 0
+        self.started = datetime.now().isoformat()
+        self.meta = meta or {}
+        self.parts: List[str] = []
+        self.marks: List[list] = []
+        self.length = 0
+        self.closed = False
+        self._file = open(self.log_path, "ab")
+        self._last_sync = time.monotonic()
+        self._pending: List[bytes] = []
+        self._snapshot: Optional[dict] = None
+        self._flushing: Optional[asyncio.Task] = None
+        self.failed = False
+        try:
+            self._loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._loop = None
+        self.append("start", generation_id=generation_id, started=self.started, meta=self.meta)
+
+    def append(self, record_type: str, **fields) -> int:
+        """Append one framed record and return its sequence number."""
+        self.seq += 1
+        record = {"seq": self.seq, "type": record_type, **fields}
+        self._enqueue(json.dumps(record, separators=(",", ":")).encode() + b"\n")
+        return self.seq
+
+    def delta(self, content: str) -> int:
+        self.seq += 1
+        self._enqueue(b'{"seq":%d,"type":"delta","content":%s}\n'
+                      % (self.seq, encode_basestring_ascii(content).encode("ascii")))
+        self.parts.append(content)
+        self.length += len(content)
+        self.marks.append([self.seq, self.length])
+        return self.seq
+
+    @property
+    def content(self) -> str:
+        return "".join(self.parts)
+
+    def _enqueue(self, line: bytes):
+        if self.failed:
+            return
+        self._pending.append(line)
+        if self._loop is None:
+            self._write(self._take())
+        elif self._flushing is None:
+            self._flushing = self._loop.create_task(self._flush())
+
+    def _take(self) -> List[bytes]:
+        batch, self._pending = self._pending, []
+        return batch
+
+    def _write(self, batch: List[bytes]):
+        self._file.write(b"".join(batch))
+        self._file.flush()
+        now = time.monotonic()
+        if now - self._last_sync >= STREAM_JOURNAL_FSYNC_SECONDS:
+            os.fsync(self._file.fileno())
+            self._last_sync = now
+
+    async def _flush(self):
         try:
-            payload = {"model": model, "messages": messages, "stream": True}
-            if images and messages and messages[-1]["role"] == "user":
-                messages[-1]["images"] = images
-
-            with httpx.Client(timeout=600) as client:
-                with client.stream("POST", f"{OLLAMA_URL}/api/chat", json=payload) as response:
-                    if response.status_code == 200:
-                        for line in response.iter_lines():
-                            if line:
-                                chunk = json.loads(line)
-                                content = chunk.get("message", {}).get("content", "")
-                                if content:
-                                    state["content"] += content
-                                    state["updated"] = datetime.now().isoformat()
-                                    with open(gen_path, 'w') as f:
-                                        json.dump(state, f)
-                                if chunk.get("done"):
-                                    state["status"] = "complete"
-                                    state["usage"] = {
-                                        "prompt_tokens": chunk.get("prompt_eval_count", 0),
-                                        "completion_tokens": chunk.get("eval_count", 0)
-                                    }
-                                    with open(gen_path, 'w') as f:
-                                        json.dump(state, f)
-                    else:
-                        state["status"] = "error"
-                        state["error"] = f"HTTP {response.status_code}"
-                        with open(gen_path, 'w') as f:
-                            json.dump(state, f)
+            await asyncio.sleep(0)  # Let the rest of this tick's records join the batch
+            while self._pending:
+                await run_io(self._write, self._take())
+            if self._snapshot is not None:
+                await run_io(self._compact, self._snapshot)
+                self._snapshot = None
         except Exception as e:
-            state["status"] = "error"
-            state["error"] = str(e)
-            with open(gen_path, 'w') as f:
-                json.dump(state, f)
+            print(f"Journal write error for {self.generation_id}: {e}")
+            # Stop writing; end the journal with the terminal snapshot, or an error one built from memory
+            self.failed = True
+            self._pending = []
+            snapshot, self._snapshot = self._snapshot, None
+            if snapshot is None:
+                self.closed = True
+                snapshot = self._state("error", {"error": f"Journal write failed: {e}"})
+            try:
+                await run_io(self._abandon, snapshot)
+            except Exception as e:
+                print(f"Journal snapshot error for {self.generation_id}: {e}")
+        finally:
+            self._flushing = None
 
-    thread = threading.Thread(target=generate, daemon=True)
-    thread.start()
-    return gen_path
+    def _finalize(self, status: str, fields: dict) -> dict:
+        self.append(status, **fields)
+        self.closed = True
+        return self._state(status, fields)
 
-def get_generation_state(user_id: int) -> Optional[dict]:
-    gen_path = get_generation_path(user_id)
-    try:
-        if os.path.exists(gen_path):
-            with open(gen_path, 'r') as f:
-                return json.load(f)
-    except Exception:
-        pass
-    return None
+    def _state(self, status: str, fields: dict) -> dict:
+        return {
+            "generation_id": self.generation_id,
+            "status": status,
+            "content": self.content,
+            "error": fields.get("error"),
+            "started": self.started,
+            "updated": datetime.now().isoformat(),
+            "usage": fields.get("usage"),
+            "seq": self.seq,
+            "meta": self.meta,
+            "final": fields,
+            "marks": list(self.marks)
+        }
 
-def clear_generation(user_id: int):
-    gen_path = get_generation_path(user_id)
-    try:
-        if os.path.exists(gen_path):
-            os.remove(gen_path)
-    except Exception:
-        pass
+    def _compact(self, snapshot: dict):
+        # The log is removed once the snapshot is in place, so only the snapshot is fsynced
+        self._file.close()
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(snapshot, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        try:
+            os.remove(self.log_path)
+        except OSError:
+            pass
 
-# =============================================================================
-# JWT Authentication
-# =============================================================================
+    def _abandon(self, snapshot: dict):
+        try:
+            self._file.close()
+        except OSError:
+            pass  # The buffered tail is lost; the snapshot has it all
+        self._compact(snapshot)
+
+    def close(self, status: str = "complete", **fields) -> dict:
+        """Write the terminal record, compact into the snapshot and drop the log (blocking)."""
+        if self.closed:
+            return get_generation_state(self.generation_id)
+        snapshot = self._finalize(status, fields)
+        self._compact(snapshot)
+        return snapshot
+
+    def finish(self, status: str = "complete", **fields) -> dict:
+        """close() for a journal on the event loop: the writes happen in the background (see drain())."""
+        if self.closed:
+            return get_generation_state(self.generation_id)
+        snapshot = self._finalize(status, fields)
+        self._snapshot = snapshot
+        if self._flushing is None:
+            self._flushing = self._loop.create_task(self._flush())
+        return snapshot
+
+    async def drain(self):
+        """Wait until everything appended so far is written (and compacted, if finished)."""
+        while self._flushing is not None:
+            await asyncio.shield(self._flushing)
+
+
+def read_generation_journal(generation_id: str, offset: int = 0) -> dict:
+    """
+    Records appended since byte `offset`.
 
-def create_access_token(data: dict, expires_delta: timedelta = None) -> str:
-    to_encode = data.copy()
-    expire = datetime.utcnow() + (expires_delta or timedelta(days=ACCESS_TOKEN_EXPIRE_DAYS))
-    to_encode.update({"exp": expire})
-    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    Returns {"records", "offset", "snapshot"}: pass the returned offset back
+    to continue tailing. Once the generation has been compacted, "snapshot"
+    holds the final state and no further records will appear.
+    """
+    log_path, snapshot_path = get_generation_paths(generation_id)
+    try:
+        with open(log_path, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+    except FileNotFoundError:
+        try:
+            with open(snapshot_path, "r") as f:
+                return {"records": [], "offset": offset, "snapshot": json.load(f)}
+        except FileNotFoundError:
+            return {"records": [], "offset": offset, "snapshot": None}
+
+    # Only consume complete lines; a partial trailing record is picked up next time
+    end = data.rfind(b"\n") + 1
+    records = [json.loads(line) for line in data[:end].splitlines() if line]
+    return {"records": records, "offset": offset + end, "snapshot": None}
+
+def get_generation_state(generation_id: str) -> Optional[dict]:
+    """Current state of a generation, folded from its journal or snapshot."""
+    journal = read_generation_journal(generation_id)
+    if journal["snapshot"]:
+        return journal["snapshot"]
+    records = journal["records"]
+    if not records:
+        return None
+    start = records[0]
+    state = {
+        "generation_id": generation_id,
+        "status": "running",
+        "content": "".join(r["content"] for r in records if r["type"] == "delta"),
+        "error": None,
+        "started": start.get("started"),
+        "updated": None,
+        "usage": None,
+        "seq": records[-1]["seq"],
+        "meta": start.get("meta", {})
+    }
+    try:
+        state["updated"] = datetime.fromtimestamp(os.path.getmtime(get_generation_paths(generation_id)[0])).isoformat()
+    except OSError:
+        state["updated"] = state["started"]
+    last = records[-1]
+    if last["type"] not in ("start", "delta"):
+        state.update(status=last["type"], error=last.get("error"), usage=last.get("usage"))
+    return state
 
-def verify_token(token: str) -> Optional[dict]:
+def list_user_generations(user_id: int) -> List[str]:
+    """Generation ids for a user, newest first."""
+    found = {}
+    prefix = f"{user_id}-"
+    with os.scandir(STREAM_CACHE_DIR) as entries:
+        for entry in entries:
+            stem, ext = os.path.splitext(entry.name)
+            if ext in (".log", ".json") and stem.startswith(prefix) and generation_owner(stem) == user_id:
+                found[stem] = max(found.get(stem, 0), entry.stat().st_mtime)
+    return sorted(found, key=found.get, reverse=True)
+
+def generation_session_id(generation_id: str) -> Optional[int]:
+    """Session a generation belongs to, from its journal's start record or its snapshot."""
+    log_path, snapshot_path = get_generation_paths(generation_id)
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return payload
-    except JWTError:
+        with open(log_path, "rb") as f:
+            line = f.readline()
+        if line.endswith(b"\n"):
+            return json.loads(line).get("meta", {}).get("session_id")
+    except (FileNotFoundError, ValueError):
+        pass
+    try:
+        with open(snapshot_path, "r") as f:
+            return json.load(f).get("meta", {}).get("session_id")
+    except (FileNotFoundError, ValueError):
         return None
 
-async def get_current_user(request: Request) -> int:
-    token = request.cookies.get("access_token")
-    if not token:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    payload = verify_token(token)
-    if not payload:
-        raise HTTPException(status_code=401, detail="Invalid token")
-    user_id = payload.get("user_id")
-    if not user_id:
-        raise HTTPException(status_code=401, detail="Invalid token")
-    return user_id
+def clear_generation(generation_id: str):
+    for path in get_generation_paths(generation_id):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def clear_user_generations(user_id: int, session_id: int = None, keep: set = frozenset()):
+    """Remove a user's generation journals (only a session's, if given), except the ids in `keep`."""
+    for generation_id in list_user_generations(user_id):
+        if generation_id in keep:
+            continue
+        if session_id is not None and generation_session_id(generation_id) != session_id:
+            continue
+        clear_generation(generation_id)
+
+def cleanup_stream_journals():
+    """Remove journals and snapshots older than STREAM_JOURNAL_RETENTION_HOURS."""
+    cutoff = time.time() - STREAM_JOURNAL_RETENTION_HOURS * 3600
+    with os.scandir(STREAM_CACHE_DIR) as entries:
+        for entry in entries:
+            try:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError as e:
+                print(f"Error deleting file {entry.path}: {e}")
 
 # =============================================================================
-# Ollama Functions
+# Resumable Generation Streams (SSE replay via Last-Event-ID)
 # =============================================================================
+#
+# Chat generations run as their own asyncio task and publish SSE events to a
+# LiveGeneration. Every event's SSE id is its journal sequence number; the
+# last SSE_REPLAY_BUFFER_EVENTS events stay in memory and older ones are
+# replayed from the generation journal, so a client that reconnects with
+# Last-Event-ID receives exactly the events it missed.
+
+# Journal record types that replay as a differently named SSE event
+JOURNAL_EVENT_TYPES = {"start": "session", "delta": "content", "complete": "done"}
+# Terminal SSE events and the journal status they close with
+SSE_TERMINAL_EVENTS = {"done": "complete", "error": "error", "stopped": "stopped"}
+
+def journal_record_to_event(record: dict) -> dict:
+    """Rebuild the SSE event a journal record was written for."""
+    if record["type"] == "start":
+        return {"type": "session", "generation_id": record["generation_id"], **record.get("meta", {})}
+    event = {k: v for k, v in record.items() if k not in ("seq", "type")}
+    return {"type": JOURNAL_EVENT_TYPES.get(record["type"], record["type"]), **event}
+
+def snapshot_events(snapshot: dict, after_seq: int) -> List[tuple]:
+    """
+    (seq, event) pairs a client that last saw `after_seq` is missing, from a
+    compacted snapshot. Missed deltas collapse into one content event.
+    """
+    events = []
+    if after_seq < 1:
+        events.append((1, {"type": "session", "generation_id": snapshot["generation_id"], **snapshot.get("meta", {})}))
+    marks = snapshot.get("marks", [])
+    i = bisect.bisect_right([seq for seq, _ in marks], after_seq)
+    if i < len(marks):
+        start = marks[i - 1][1] if i > 0 else 0
+        events.append((marks[-1][0], {"type": "content", "content": snapshot["content"][start:]}))
+    if snapshot["seq"] > after_seq:
+        events.append((snapshot["seq"], {"type": JOURNAL_EVENT_TYPES.get(snapshot["status"], snapshot["status"]),
+                                         **snapshot.get("final", {})}))
+    return events
+
+def replay_generation_events(generation_id: str, after_seq: int) -> tuple:
+    """
+    (events, complete): (seq, event) pairs after `after_seq` from a
+    generation's journal, and whether they run to the end of the generation.
+    """
+    journal = read_generation_journal(generation_id)
+    if journal["snapshot"]:
+        return snapshot_events(journal["snapshot"], after_seq), True
+    return [(r["seq"], journal_record_to_event(r)) for r in journal["records"] if r["seq"] > after_seq], False
 
-def get_available_models() -> List[str]:
-    """Get models from Ollama (sync, used for background threads)."""
-    try:
-        with httpx.Client(timeout=5) as client:
-            response = client.get(f"{OLLAMA_URL}/api/tags")
-            if response.status_code == 200:
-                return [m["name"] for m in response.json().get("models", [])]
-    except Exception:
-        pass
-    return [DEFAULT_MODEL]
-
-async def get_all_available_models() -> Dict[str, List[str]]:
-    """Get models from both Ollama and vLLM backends (async)."""
-    ollama_models = []
-    vllm_models = []
 
-    # Get Ollama models
-    try:
-        async with httpx.AsyncClient(timeout=5) as client:
-            response = await client.get(f"{OLLAMA_URL}/api/tags")
-            if response.status_code == 200:
-                ollama_models = [m["name"] for m in response.json().get("models", [])]
-    except Exception:
-        pass
+class LiveGeneration:
+    """
+    In-process fan-out for one running generation.
 
-    # Get vLLM models if enabled
-    if VLLM_ENABLED:
-        vllm_models = await vllm_list_models()
+    run() drains a producer (an async generator of event dicts), normally
+    in its own task, so the upstream request keeps going when a client
+    disconnects; any number of subscribers can follow it, each from its
+    own cursor.
+    """
 
-    return {
-        "ollama": ollama_models or [DEFAULT_MODEL],
-        "vllm": vllm_models,
-        "all": list(set(ollama_models + vllm_models)) or [DEFAULT_MODEL]
-    }
+    def __init__(self, generation_id: str, session_event: dict):
+        self.generation_id = generation_id
+        self.journal = StreamJournal(generation_id, session_event)
+        self.buffer = deque([(self.journal.seq, {"type": "session", "generation_id": generation_id, **session_event})],
+                            maxlen=SSE_REPLAY_BUFFER_EVENTS)
+        self.finished = False
+        self.task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+
+    def publish(self, event: dict) -> int:
+        """Journal an event, buffer it and wake subscribers. Returns its id."""
+        event_type = event["type"]
+        fields = {k: v for k, v in event.items() if k != "type"}
+        if event_type == "content":
+            seq = self.journal.delta(event["content"])
+        elif event_type in SSE_TERMINAL_EVENTS:
+            self.journal.finish(SSE_TERMINAL_EVENTS[event_type], **fields)
+            seq = self.journal.seq
+            self.finished = True
+        else:
+            seq = self.journal.append(event_type, **fields)
+        self.buffer.append((seq, event))
+        self._wakeup.set()
+        self._wakeup = asyncio.Event()
+        return seq
 
-def is_vision_model(model_name: str) -> bool:
-    return any(vm in model_name.lower() for vm in VISION_MODELS)
+    async def run(self, producer):
+        try:
+            async with aclosing(producer) as events:
+                async for event in events:
+                    self.publish(event)
+                    if self.finished:
+                        break
+        except Exception as e:
+            if not self.finished:
+                self.publish({"type": "error", "error": str(e)})
+        finally:
+            if not self.finished:
+                self.publish({"type": "error", "error": "Generation ended unexpectedly"})
+
+    async def subscribe(self, last_event_id: int = 0):
+        """Yield (seq, event) after `last_event_id`, then follow live until the generation ends."""
+        cursor = last_event_id
+        while True:
+            wakeup = self._wakeup
+            if cursor < self.buffer[0][0] - 1:
+                # Fell behind the ring buffer: fill the gap from the journal
+                oldest = self.buffer[0][0]
+                events, complete = await run_io(replay_generation_events, self.generation_id, cursor)
+                if complete:
+                    for seq, event in events:
+                        yield seq, event
+                    return
+                for seq, event in events:
+                    if seq >= oldest:
+                        break
+                    yield seq, event
+                    cursor = seq
+                cursor = max(cursor, oldest - 1)
+                continue
+            for seq, event in list(self.buffer):
+                if seq > cursor:
+                    yield seq, event
+                    cursor = seq
+            if self.finished and cursor >= self.buffer[-1][0]:
+                return
+            await wakeup.wait()
+
+
+async def follow_generation_journal(generation_id: str, after_seq: int = 0):
+    """
+    Tail a generation that is not live in this process (another worker, or
+    already finished) by polling its journal until it is compacted.
+    """
+    offset = 0
+    last_progress = time.monotonic()
+    while True:
+        journal = await run_io(read_generation_journal, generation_id, offset)
+        if journal["snapshot"]:
+            for seq, event in snapshot_events(journal["snapshot"], after_seq):
+                yield seq, event
+            return
+        if journal["records"]:
+            last_progress = time.monotonic()
+        for record in journal["records"]:
+            if record["seq"] > after_seq:
+                yield record["seq"], journal_record_to_event(record)
+                after_seq = record["seq"]
+        offset = journal["offset"]
+        if time.monotonic() - last_progress > SSE_JOURNAL_STALL_SECONDS:
+            yield None, {"type": "error", "error": "Generation is no longer running"}
+            return
+        await asyncio.sleep(SSE_JOURNAL_POLL_SECONDS)
+
+# Event types whose consecutive {"type", "content"} deltas are merged into one frame
+COALESCED_EVENT_TYPES = ("content", "stdout", "stderr")
+DELTA_PREFIXES = {event_type: '{"type":"%s","content":' % event_type for event_type in COALESCED_EVENT_TYPES}
+framing_stats = {"streams": 0, "events": 0, "frames": 0, "bytes": 0}
+
+
+def wants_ndjson(accept: Optional[str]) -> bool:
+    return bool(accept) and "application/x-ndjson" in accept
+
+
+def encode_frame(seq: Optional[int], body: str, ndjson: bool) -> str:
+    """One SSE event or NDJSON line around an already-encoded JSON object."""
+    if ndjson:
+        return body + "\n" if seq is None else '{"id":%d,%s\n' % (seq, body[1:])
+    return f"data: {body}\n\n" if seq is None else f"id: {seq}\ndata: {body}\n\n"
+
+
+async def frame_events(source, ndjson: bool = False):
+    """
+    Frame (seq, event) pairs for the wire, coalescing runs of content
+    deltas.
+
+    Consecutive deltas of the same type are merged into one frame that
+    carries the last delta's id, so Last-Event-ID resumes stay exact. A
+    frame goes out once it reaches SSE_COALESCE_BYTES, after
+    SSE_COALESCE_MS, or ahead of any other event, whichever comes first.
+    The merged text is escaped once per frame with the C string encoder
+    into a pre-built template rather than json.dumps per token. The source
+    is drained by its own task so the time window is honoured while it is
+    idle.
+    """
+    loop = asyncio.get_running_loop()
+    window = SSE_COALESCE_MS / 1000
+    ready = asyncio.Event()
+    frames: List[str] = []
+    run_type: Optional[str] = None
+    run_parts: List[str] = []
+    run_size = 0
+    run_seq: Optional[int] = None
+    timer: Optional[asyncio.TimerHandle] = None
+    finished = False
+
+    def close_run():
+        nonlocal run_type, run_parts, run_size
+        if run_parts:
+            body = DELTA_PREFIXES[run_type] + encode_basestring_ascii("".join(run_parts)) + "}"
+            frames.append(encode_frame(run_seq, body, ndjson))
+            run_type, run_parts, run_size = None, [], 0
+
+    def flush():
+        nonlocal timer
+        if timer:
+            timer.cancel()
+            timer = None
+        close_run()
+        ready.set()
+
+    async def pump():
+        nonlocal run_type, run_size, run_seq, timer, finished
+        try:
+            async for seq, event in source:
+                framing_stats["events"] += 1
+                event_type = event.get("type")
+                if event_type in DELTA_PREFIXES and len(event) == 2 and isinstance(event.get("content"), str):
+                    if run_type != event_type:
+                        close_run()
+                        run_type = event_type
+                    run_parts.append(event["content"])
+                    run_size += len(event["content"])
+                    run_seq = seq
+                    if run_size >= SSE_COALESCE_BYTES or window <= 0:
+                        flush()
+                    elif timer is None:
+                        timer = loop.call_later(window, flush)
+                else:
+                    close_run()
+                    frames.append(encode_frame(seq, json.dumps(event, separators=(",", ":")), ndjson))
+                    flush()
+        finally:
+            finished = True
+            flush()
+
+    framing_stats["streams"] += 1
+    task = asyncio.create_task(pump())
+    try:
+        while True:
+            await ready.wait()
+            ready.clear()
+            done = finished
+            if frames:
+                chunk = "".join(frames)
+                frames.clear()
+                framing_stats["frames"] += 1
+                framing_stats["bytes"] += len(chunk)
+                yield chunk
+            if done:
+                break
+        await task  # Re-raise a source failure
+    finally:
+        if timer:
+            timer.cancel()
+        task.cancel()
+
+
+def event_stream_response(source, accept: Optional[str] = None) -> StreamingResponse:
+    """Stream (seq, event) pairs as SSE, or as NDJSON if the client's Accept asks for it."""
+    ndjson = wants_ndjson(accept)
+    return StreamingResponse(
+        frame_events(source, ndjson),
+        media_type="application/x-ndjson" if ndjson else "text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            "X-Accel-Buffering": "no"
+        }
+    )
+
+# =============================================================================
+# Generation Registry (cross-worker state and stop signals)
+# =============================================================================
+#
+# With `uvicorn --workers N` a stop/continue/status request usually lands on
+# a different worker than the one streaming. Every running generation is
+# recorded in a shared registry along with the worker that owns it; stop
+# requests are delivered to that worker as a signal. Only running
+# generations live here; finished ones are served from their journal.
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+class GenerationRegistry:
+    """
+    Interface for the shared generation registry.
+
+    Entries are dicts with generation_id, user_id, session_id, worker_id,
+    model, backend and started_at. Owners heartbeat their entries; an entry
+    whose owner stopped heartbeating for `stale_after` seconds (a crashed
+    worker) no longer counts as running.
+    """
+
+    def __init__(self, stale_after: float):
+        self.stale_after = stale_after
+
+    async def register(self, entry: dict, max_per_user: int) -> Optional[str]:
+        """Record a generation; returns None, or "session_busy" / "limit" if refused."""
+        raise NotImplementedError
+
+    async def heartbeat(self, entries: List[dict]):
+        raise NotImplementedError
+
+    async def finish(self, entry: dict):
+        raise NotImplementedError
+
+    async def get(self, generation_id: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def find(self, user_id: int, session_id: int) -> Optional[dict]:
+        """The generation running for a session, on any worker."""
+        raise NotImplementedError
+
+    async def running(self, user_id: int) -> List[dict]:
+        raise NotImplementedError
+
+    async def request_stop(self, generation_id: str) -> Optional[dict]:
+        """Signal the owning worker to stop a generation; returns its entry if running."""
+        raise NotImplementedError
+
+    def stop_requests(self, worker_id: str):
+        """Async iterator of generation ids this worker has been asked to stop."""
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class SQLiteGenerationRegistry(GenerationRegistry):
+    """
+    Registry in the app database, for workers on one host sharing DATA_DIR.
+
+    Session exclusivity and the per-user limit are checked and recorded in
+    one IMMEDIATE transaction. Stop signals are a flag on the row that the
+    owning worker polls every `poll_interval` seconds.
+    """
+
+    def __init__(self, stale_after: float, poll_interval: float):
+        super().__init__(stale_after)
+        self.poll_interval = poll_interval
+
+    def _live_cutoff(self) -> float:
+        return time.time() - self.stale_after
+
+    def _register(self, entry: dict, max_per_user: int) -> Optional[str]:
+        with get_db() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            # Entries left behind by a dead worker don't hold the session or a slot
+            conn.execute("DELETE FROM generations WHERE user_id = ? AND heartbeat_at < ?",
+                         (entry["user_id"], self._live_cutoff()))
+            if conn.execute("SELECT 1 FROM generations WHERE user_id = ? AND session_id = ?",
+                            (entry["user_id"], entry["session_id"])).fetchone():
+                return "session_busy"
+            count = conn.execute("SELECT COUNT(*) FROM generations WHERE user_id = ?",
+                                 (entry["user_id"],)).fetchone()[0]
+            if count >= max_per_user:
+                return "limit"
+            conn.execute('''INSERT INTO generations
+                            (generation_id, user_id, session_id, worker_id, model, backend, started_at, heartbeat_at)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                         (entry["generation_id"], entry["user_id"], entry["session_id"], entry["worker_id"],
+                          entry["model"], entry["backend"], entry["started_at"], time.time()))
+        return None
+
+    def _heartbeat(self, generation_ids: List[str]):
+        now = time.time()
+        with get_db() as conn:
+            conn.executemany("UPDATE generations SET heartbeat_at = ? WHERE generation_id = ?",
+                             [(now, gid) for gid in generation_ids])
+            # Sweep entries whose worker went away
+            conn.execute("DELETE FROM generations WHERE heartbeat_at < ?", (self._live_cutoff(),))
+
+    def _finish(self, generation_id: str):
+        with get_db() as conn:
+            conn.execute("DELETE FROM generations WHERE generation_id = ?", (generation_id,))
+
+    def _select(self, where: str, params: tuple) -> List[dict]:
+        with get_db() as conn:
+            rows = conn.execute(
+                f'''SELECT generation_id, user_id, session_id, worker_id, model, backend, started_at
+                    FROM generations WHERE {where} AND heartbeat_at >= ?''',
+                params + (self._live_cutoff(),)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def _request_stop(self, generation_id: str) -> Optional[dict]:
+        entries = self._select("generation_id = ?", (generation_id,))
+        if not entries:
+            return None
+        with get_db() as conn:
+            conn.execute("UPDATE generations SET stop_requested = 1 WHERE generation_id = ?", (generation_id,))
+        return entries[0]
+
+    def _take_stop_requests(self, worker_id: str) -> List[str]:
+        with get_db() as conn:
+            rows = conn.execute("SELECT generation_id FROM generations WHERE worker_id = ? AND stop_requested = 1",
+                                (worker_id,)).fetchall()
+            if rows:
+                conn.executemany("UPDATE generations SET stop_requested = 2 WHERE generation_id = ?",
+                                 [(row[0],) for row in rows])
+        return [row[0] for row in rows]
+
+    async def register(self, entry: dict, max_per_user: int) -> Optional[str]:
+        return await run_db(self._register, entry, max_per_user)
+
+    async def heartbeat(self, entries: List[dict]):
+        await run_db(self._heartbeat, [e["generation_id"] for e in entries])
+
+    async def finish(self, entry: dict):
+        await run_db(self._finish, entry["generation_id"])
+
+    async def get(self, generation_id: str) -> Optional[dict]:
+        entries = await run_db(self._select, "generation_id = ?", (generation_id,))
+        return entries[0] if entries else None
+
+    async def find(self, user_id: int, session_id: int) -> Optional[dict]:
+        entries = await run_db(self._select, "user_id = ? AND session_id = ?", (user_id, session_id))
+        return entries[0] if entries else None
+
+    async def running(self, user_id: int) -> List[dict]:
+        return await run_db(self._select, "user_id = ?", (user_id,))
+
+    async def request_stop(self, generation_id: str) -> Optional[dict]:
+        return await run_db(self._request_stop, generation_id)
+
+    async def stop_requests(self, worker_id: str):
+        while True:
+            for generation_id in await run_db(self._take_stop_requests, worker_id):
+                yield generation_id
+            await asyncio.sleep(self.poll_interval)
+
+
+class RedisGenerationRegistry(GenerationRegistry):
+    """
+    Registry in Redis, for workers spread across hosts.
+
+    Takes any client with the redis.asyncio API, so tests can pass an
+    in-process stand-in (e.g. fakeredis). Entries are hashes that expire
+    unless heartbeated; a SET NX on the session key makes session
+    exclusivity atomic (the per-user limit is best-effort across workers).
+    Stop signals are published on a per-worker channel.
+    """
+
+    def __init__(self, client, stale_after: float, prefix: str = "borak:gen"):
+        super().__init__(stale_after)
+        self.client = client
+        self.prefix = prefix
+        self.ttl = max(int(stale_after), 1)
+
+    def _entry_key(self, generation_id: str) -> str:
+        return f"{self.prefix}:{generation_id}"
+
+    def _session_key(self, user_id: int, session_id: int) -> str:
+        return f"{self.prefix}:session:{user_id}:{session_id}"
+
+    def _user_key(self, user_id: int) -> str:
+        return f"{self.prefix}:user:{user_id}"
+
+    def _channel(self, worker_id: str) -> str:
+        return f"{self.prefix}:stop:{worker_id}"
+
+    @staticmethod
+    def _str(value) -> str:
+        return value.decode() if isinstance(value, bytes) else value
+
+    def _decode(self, raw: dict) -> Optional[dict]:
+        if not raw:
+            return None
+        entry = {self._str(k): self._str(v) for k, v in raw.items()}
+        entry["user_id"] = int(entry["user_id"])
+        entry["session_id"] = int(entry["session_id"])
+        return entry
+
+    async def _live_ids(self, user_id: int) -> List[str]:
+        ids = [self._str(gid) for gid in await self.client.smembers(self._user_key(user_id))]
+        if not ids:
+            return []
+        pipe = self.client.pipeline()
+        for gid in ids:
+            pipe.exists(self._entry_key(gid))
+        alive = await pipe.execute()
+        dead = [gid for gid, ok in zip(ids, alive) if not ok]
+        if dead:
+            await self.client.srem(self._user_key(user_id), *dead)
+        return [gid for gid, ok in zip(ids, alive) if ok]
+
+    async def register(self, entry: dict, max_per_user: int) -> Optional[str]:
+        gid = entry["generation_id"]
+        session_key = self._session_key(entry["user_id"], entry["session_id"])
+        if not await self.client.set(session_key, gid, nx=True, ex=self.ttl):
+            # The holder may have died without cleaning up
+            holder = self._str(await self.client.get(session_key))
+            if holder and await self.client.exists(self._entry_key(holder)):
+                return "session_busy"
+            await self.client.set(session_key, gid, ex=self.ttl)
+        if len(await self._live_ids(entry["user_id"])) >= max_per_user:
+            await self.client.delete(session_key)
+            return "limit"
+        pipe = self.client.pipeline()
+        pipe.hset(self._entry_key(gid), mapping={k: str(v) for k, v in entry.items()})
+        pipe.expire(self._entry_key(gid), self.ttl)
+        pipe.sadd(self._user_key(entry["user_id"]), gid)
+        pipe.expire(self._user_key(entry["user_id"]), self.ttl)
+        await pipe.execute()
+        return None
+
+    async def heartbeat(self, entries: List[dict]):
+        if not entries:
+            return
+        pipe = self.client.pipeline()
+        for entry in entries:
+            pipe.expire(self._entry_key(entry["generation_id"]), self.ttl)
+            pipe.expire(self._session_key(entry["user_id"], entry["session_id"]), self.ttl)
+            pipe.expire(self._user_key(entry["user_id"]), self.ttl)
+        await pipe.execute()
+
+    async def finish(self, entry: dict):
+        gid = entry["generation_id"]
+        session_key = self._session_key(entry["user_id"], entry["session_id"])
+        pipe = self.client.pipeline()
+        pipe.delete(self._entry_key(gid))
+        pipe.srem(self._user_key(entry["user_id"]), gid)
+        await pipe.execute()
+        if self._str(await self.client.get(session_key)) == gid:
+            await self.client.delete(session_key)
+
+    async def get(self, generation_id: str) -> Optional[dict]:
+        return self._decode(await self.client.hgetall(self._entry_key(generation_id)))
+
+    async def find(self, user_id: int, session_id: int) -> Optional[dict]:
+        gid = await self.client.get(self._session_key(user_id, session_id))
+        return await self.get(self._str(gid)) if gid else None
+
+    async def running(self, user_id: int) -> List[dict]:
+        entries = [await self.get(gid) for gid in await self._live_ids(user_id)]
+        return [e for e in entries if e]
+
+    async def request_stop(self, generation_id: str) -> Optional[dict]:
+        entry = await self.get(generation_id)
+        if entry:
+            await self.client.publish(self._channel(entry["worker_id"]), generation_id)
+        return entry
+
+    async def stop_requests(self, worker_id: str):
+        pubsub = self.client.pubsub()
+        await pubsub.subscribe(self._channel(worker_id))
+        try:
+            async for message in pubsub.listen():
+                if message.get("type") == "message":
+                    yield self._str(message["data"])
+        finally:
+            await pubsub.aclose()
+
+    async def close(self):
+        await self.client.aclose()
+
+
+def create_generation_registry() -> GenerationRegistry:
+    if GENERATION_REGISTRY == "redis":
+        if REDIS_AVAILABLE:
+            return RedisGenerationRegistry(aioredis.from_url(REDIS_URL), stale_after=GENERATION_STALE_SECONDS)
+        print("GENERATION_REGISTRY=redis but the redis package is not installed; using SQLite")
+    return SQLiteGenerationRegistry(stale_after=GENERATION_STALE_SECONDS,
+                                    poll_interval=GENERATION_STOP_POLL_SECONDS)
+
+
+generation_registry = create_generation_registry()
+
+# =============================================================================
+# Admission Control (fair queueing in front of each backend/model)
+# =============================================================================
+
+class AdmissionRejected(Exception):
+    """The queue for a backend/model is full; retry after `retry_after` seconds."""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionTicket:
+    """A request's place in an admission lane; granted once it may open a stream."""
+
+    def __init__(self, lane: "AdmissionLane", user_id: int):
+        self.lane = lane
+        self.user_id = user_id
+        self.position = 0
+        self.granted = False
+        self.granted_at = 0.0
+        self.released = False
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        self._changed.set()
+
+    async def wait(self):
+        """Yield queue positions as they change until the ticket is granted."""
+        while not self.granted:
+            self._changed.clear()
+            yield self.position
+            await self._changed.wait()
+
+
+@dataclass
+class AdmissionLane:
+    """Scheduling state for one (backend, model)."""
+    backend: str
+    model: str
+    limit: int
+    active: int = 0
+    queued: int = 0
+    admitted: int = 0
+    rejected: int = 0
+    avg_stream_seconds: float = ADMISSION_INITIAL_STREAM_SECONDS
+
+    def __post_init__(self):
+        self.waiting: Dict[int, deque] = {}   # user_id -> that user's tickets, oldest first
+        self.rotation: deque = deque()        # users with waiting tickets, next to be served first
+        self.streams_by_user: Dict[int, int] = {}
+        self.last_served: Dict[int, int] = {}  # user_id -> grant serial, for least-recently-served order
+        self.grants = 0
+
+    def next_user(self, rotation: deque, streams: Dict[int, int], last_served: Dict[int, int]) -> int:
+        """
+        Pick (and remove) the waiting user holding the fewest streams, then the
+        least recently served; remaining ties go in rotation order.
+        """
+        user_id = min(rotation, key=lambda u: (streams.get(u, 0), last_served.get(u, 0)))
+        rotation.remove(user_id)
+        return user_id
+
+
+class AdmissionScheduler:
+    """
+    Caps concurrent upstream streams per (backend, model) and queues the rest.
+
+    Waiting requests are served fairly across users (fewest streams held,
+    then least recently served), so one user with several queued requests
+    cannot starve everyone else. When a lane's queue
+    is full, new requests are rejected with a Retry-After estimate based on
+    the lane's recent stream durations. Limits are per worker.
+    """
+
+    def __init__(self, backend_limits: Dict[str, int], model_limits: Dict[str, int], max_queue: int):
+        self.backend_limits = backend_limits
+        self.model_limits = model_limits
+        self.max_queue = max_queue
+        self.lanes: Dict[tuple, AdmissionLane] = {}
+
+    def _lane(self, backend: str, model: str) -> AdmissionLane:
+        lane = self.lanes.get((backend, model))
+        if lane is None:
+            limit = self.model_limits.get(model) or self.backend_limits.get(backend, 1)
+            lane = self.lanes[(backend, model)] = AdmissionLane(backend, model, max(limit, 1))
+        return lane
+
+    def retry_after(self, lane: AdmissionLane) -> int:
+        return max(1, math.ceil(lane.avg_stream_seconds * (lane.queued + 1) / lane.limit))
+
+    def enqueue(self, backend: str, model: str, user_id: int) -> AdmissionTicket:
+        """Take a slot, or a place in the queue; raises AdmissionRejected if the queue is full."""
+        lane = self._lane(backend, model)
+        ticket = AdmissionTicket(lane, user_id)
+        if lane.active < lane.limit and not lane.queued:
+            self._grant(lane, ticket)
+            return ticket
+        if lane.queued >= self.max_queue:
+            lane.rejected += 1
+            raise AdmissionRejected(f"{model} is busy ({lane.queued} requests queued)", self.retry_after(lane))
+
+        if user_id not in lane.waiting:
+            lane.waiting[user_id] = deque()
+            lane.rotation.append(user_id)
+        lane.waiting[user_id].append(ticket)
+        lane.queued += 1
+        self._renumber(lane)
+        return ticket
+
+    def release(self, ticket: Optional[AdmissionTicket]):
+        """Give back a slot (or leave the queue) and admit whoever is next."""
+        if ticket is None or ticket.released:
+            return
+        ticket.released = True
+        lane = ticket.lane
+        if ticket.granted:
+            lane.active -= 1
+            lane.streams_by_user[ticket.user_id] -= 1
+            if not lane.streams_by_user[ticket.user_id]:
+                del lane.streams_by_user[ticket.user_id]
+            # Exponentially weighted average of how long streams hold a slot
+            held = time.monotonic() - ticket.granted_at
+            lane.avg_stream_seconds = 0.8 * lane.avg_stream_seconds + 0.2 * held
+        else:
+            user_queue = lane.waiting.get(ticket.user_id)
+            if user_queue and ticket in user_queue:
+                user_queue.remove(ticket)
+                lane.queued -= 1
+                if not user_queue:
+                    del lane.waiting[ticket.user_id]
+                    lane.rotation.remove(ticket.user_id)
+        self._dispatch(lane)
+
+    def _grant(self, lane: AdmissionLane, ticket: AdmissionTicket):
+        lane.active += 1
+        lane.streams_by_user[ticket.user_id] = lane.streams_by_user.get(ticket.user_id, 0) + 1
+        lane.grants += 1
+        lane.last_served[ticket.user_id] = lane.grants
+        lane.admitted += 1
+        ticket.granted = True
+        ticket.granted_at = time.monotonic()
+        ticket.position = 0
+        ticket._notify()
+
+    def _dispatch(self, lane: AdmissionLane):
+        while lane.active < lane.limit and lane.rotation:
+            user_id = lane.next_user(lane.rotation, lane.streams_by_user, lane.last_served)
+            user_queue = lane.waiting[user_id]
+            ticket = user_queue.popleft()
+            lane.queued -= 1
+            if user_queue:
+                lane.rotation.append(user_id)
+            else:
+                del lane.waiting[user_id]
+            self._grant(lane, ticket)
+        self._renumber(lane)
+
+    def _renumber(self, lane: AdmissionLane):
+        """Recompute every waiter's position in the order _dispatch would serve them."""
+        queues = {user_id: list(tickets) for user_id, tickets in lane.waiting.items()}
+        rotation = deque(lane.rotation)
+        streams = dict(lane.streams_by_user)
+        last_served = dict(lane.last_served)
+        grants = lane.grants
+        position = 0
+        while rotation:
+            user_id = lane.next_user(rotation, streams, last_served)
+            streams[user_id] = streams.get(user_id, 0) + 1
+            grants += 1
+            last_served[user_id] = grants
+            ticket = queues[user_id].pop(0)
+            position += 1
+            if ticket.position != position:
+                ticket.position = position
+                ticket._notify()
+            if queues[user_id]:
+                rotation.append(user_id)
+
+    def stats(self) -> dict:
+        return {
+            f"{backend}/{model}": {
+                "limit": lane.limit,
+                "active": lane.active,
+                "queued": lane.queued,
+                "users_waiting": len(lane.waiting),
+                "admitted": lane.admitted,
+                "rejected": lane.rejected,
+                "avg_stream_seconds": round(lane.avg_stream_seconds, 2)
+            }
+            for (backend, model), lane in self.lanes.items()
+        }
+
+
+admission = AdmissionScheduler(
+    backend_limits={"ollama": OLLAMA_MAX_STREAMS, "vllm": VLLM_MAX_STREAMS},
+    model_limits=ADMISSION_MODEL_LIMITS,
+    max_queue=ADMISSION_MAX_QUEUE
+)
+
+# =============================================================================
+# Response Cache (opt-in reuse of replies to repeated prompts)
+# =============================================================================
+
+class TTLCache:
+    """
+    In-memory mapping with a per-entry TTL and LRU eviction at max_entries.
+    `on_evict(key, value)` is called for entries dropped by expiry or
+    eviction (not for explicit pop()).
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float, on_evict=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.on_evict = on_evict
+        self.entries: OrderedDict = OrderedDict()  # key -> (expires_at, value)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        item = self.entries.get(key)
+        if item is not None and item[0] <= time.monotonic():
+            self._evict(key)
+            item = None
+        if item is None:
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def set(self, key, value, ttl_seconds: float = None):
+        self.entries.pop(key, None)
+        self.entries[key] = (time.monotonic() + (ttl_seconds or self.ttl_seconds), value)
+        while len(self.entries) > self.max_entries:
+            self._evict(next(iter(self.entries)))
+
+    def pop(self, key, default=None):
+        item = self.entries.pop(key, None)
+        return item[1] if item is not None else default
+
+    def _evict(self, key):
+        _, value = self.entries.pop(key)
+        self.evictions += 1
+        if self.on_evict:
+            self.on_evict(key, value)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "evictions": self.evictions
+        }
+
+
+@dataclass
+class CachedResponse:
+    content: str
+    match: str               # "exact" or "semantic"
+    similarity: float = 1.0
+
+
+class ResponseCache:
+    """
+    Reuses replies to repeated prompts for the models in RESPONSE_CACHE_MODELS.
+
+    Entries are keyed by (model, system prompt hash, hash of the packed
+    conversation before the last RESPONSE_CACHE_TAIL_MESSAGES messages,
+    normalised tail text), plus the user unless RESPONSE_CACHE_SCOPE is
+    "global". Lookup tries the exact key, then the nearest tail embedding
+    in the chroma_db "response_cache" collection above
+    RESPONSE_CACHE_SIMILARITY, among entries with the same conversation
+    hash, so a short follow-up ("why?") only matches in the same context.
+    Replies live in this worker's TTL/LRU map; the embeddings index only
+    what is in it and is pruned on eviction.
+    """
+
+    def __init__(self, models: set, max_entries: int, ttl_seconds: float, similarity: float,
+                 tail_messages: int, scope: str):
+        self.models = models
+        self.similarity = similarity
+        self.tail_messages = tail_messages
+        self.scope = scope
+        self.entries = TTLCache(max_entries, ttl_seconds, on_evict=self._forget)
+        self.counters: Dict[str, Dict[str, int]] = {}
+        self._evicted: List[str] = []
+
+    @property
+    def semantic(self) -> bool:
+        return CHROMA_AVAILABLE and 0 < self.similarity < 1
+
+    def enabled_for(self, model: str) -> bool:
+        return "*" in self.models or model in self.models
+
+    def _count(self, model: str, counter: str):
+        counts = self.counters.setdefault(model, {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "stores": 0})
+        counts[counter] += 1
+
+    def _forget(self, key: str, value):
+        self._evicted.append(key)
+
+    def _identity(self, user_id: int, model: str, system_prompt: Optional[str],
+                  messages: List[dict]) -> tuple[str, str, str]:
+        """Returns (key, scope hash, normalised tail text); the scope hash covers the conversation."""
+        scope = "" if self.scope == "global" else str(user_id)
+        system_hash = hashlib.sha256((system_prompt or "").encode()).hexdigest()[:16]
+        context = hashlib.sha256()
+        for m in messages[:-self.tail_messages]:
+            context.update(f"{m['role']}\0{m['content']}\0".encode())
+        tail = "\n".join(
+            f"{m['role']}: {' '.join(m['content'].lower().split())}"
+            for m in messages[-self.tail_messages:]
+        )
+        scope_hash = hashlib.sha256(
+            f"{scope}\0{model}\0{system_hash}\0{context.hexdigest()}".encode()
+        ).hexdigest()[:16]
+        key = hashlib.sha256(f"{scope_hash}\0{tail}".encode()).hexdigest()
+        return key, scope_hash, tail
+
+    async def _flush_evicted(self):
+        if self._evicted and self.semantic:
+            evicted, self._evicted = self._evicted, []
+            await adb.chroma_cache_delete(evicted)
+        self._evicted.clear()
+
+    async def lookup(self, user_id: int, model: str, system_prompt: Optional[str],
+                     messages: List[dict]) -> Optional[CachedResponse]:
+        if not self.enabled_for(model) or not messages or any(m.get("images") for m in messages):
+            return None
+        key, scope_hash, tail = self._identity(user_id, model, system_prompt, messages)
+        content = self.entries.get(key)
+        if content is not None:
+            self._count(model, "exact_hits")
+            return CachedResponse(content, "exact")
+
+        if self.semantic:
+            await self._flush_evicted()
+            nearest = await adb.chroma_cache_query(tail, {"$and": [
+                {"scope": scope_hash}, {"worker": WORKER_ID},
+                {"created_at": {"$gte": time.time() - self.entries.ttl_seconds}}
+            ]})
+            if nearest and nearest[1] >= self.similarity:
+                content = self.entries.get(nearest[0])
+                if content is not None:
+                    self._count(model, "semantic_hits")
+                    return CachedResponse(content, "semantic", round(nearest[1], 4))
+        self._count(model, "misses")
+        return None
+
+    async def store(self, user_id: int, model: str, system_prompt: Optional[str],
+                    messages: List[dict], content: str):
+        if not content or not self.enabled_for(model) or any(m.get("images") for m in messages):
+            return
+        key, scope_hash, tail = self._identity(user_id, model, system_prompt, messages)
+        self.entries.set(key, content)
+        self._count(model, "stores")
+        if self.semantic:
+            await self._flush_evicted()
+            await adb.chroma_cache_add(key, tail, {"scope": scope_hash, "worker": WORKER_ID, "created_at": time.time()})
+
+    async def prune(self):
+        """Drop embeddings older than the TTL (left behind by earlier processes)."""
+        if self.semantic:
+            await adb.chroma_cache_delete(older_than=time.time() - self.entries.ttl_seconds)
+
+    def stats(self) -> dict:
+        return {
+            "models": sorted(self.models),
+            "semantic": self.semantic,
+            "similarity": self.similarity,
+            "entries": len(self.entries),
+            "max_entries": self.entries.max_entries,
+            "ttl_seconds": self.entries.ttl_seconds,
+            "evictions": self.entries.evictions,
+            "by_model": self.counters
+        }
+
+
+async def replay_cached_response(content: str):
+    """A backend-shaped stream for a cached reply: the content in chunks, then done."""
+    for start in range(0, len(content), RESPONSE_CACHE_CHUNK_CHARS):
+        yield StreamDelta(content=content[start:start + RESPONSE_CACHE_CHUNK_CHARS])
+        await asyncio.sleep(0)
+    yield StreamDelta(done=True, finish_reason="stop")
+
+
+response_cache = ResponseCache(
+    models=RESPONSE_CACHE_MODELS,
+    max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+    ttl_seconds=RESPONSE_CACHE_TTL_SECONDS,
+    similarity=RESPONSE_CACHE_SIMILARITY,
+    tail_messages=RESPONSE_CACHE_TAIL_MESSAGES,
+    scope=RESPONSE_CACHE_SCOPE
+)
+
+# =============================================================================
+# Prompt Assembly (token-budgeted chat context)
+# =============================================================================
+
+TOKEN_PIECE_RE = re.compile(r"\w+|[^\w\s]")
+TRUNCATION_MARKER = "\n\n[… {omitted} tokens omitted …]\n\n"
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Fast local token estimate: one token per punctuation mark, one per word
+    plus one per further 6 characters (long identifiers, CJK runs). Slightly
+    pessimistic for BPE vocabularies, which is the safe side for budgeting.
+    """
+    if not text:
+        return 0
+    return sum(1 + (len(piece) - 1) // 6 for piece in TOKEN_PIECE_RE.findall(text))
+
+
+def message_tokens(message: dict) -> int:
+    """Estimated prompt cost of a message; stored messages carry their count as "tokens"."""
+    tokens = message.get("tokens")
+    if tokens is None:
+        tokens = estimate_tokens(message["content"])
+    return tokens + PROMPT_MESSAGE_OVERHEAD_TOKENS
+
+
+def context_length_for(model: str) -> int:
+    return model_metadata_for(model).get("context_length", PROMPT_DEFAULT_CONTEXT_TOKENS)
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cut text to about max_tokens, keeping its head and tail around an omission marker."""
+    total = estimate_tokens(text)
+    if total <= max_tokens:
+        return text
+    keep = max(max_tokens - 16, 0)  # Room for the marker
+    # Scale by characters; the estimate is roughly linear in length
+    keep_chars = int(len(text) * keep / total)
+    head = text[:keep_chars // 2]
+    tail = text[len(text) - (keep_chars - len(head)):] if keep_chars > len(head) else ""
+    return head + TRUNCATION_MARKER.format(omitted=total - keep) + tail
+
+
+@dataclass
+class PromptPlan:
+    messages: List[dict]
+    context_length: int
+    budget: int           # Tokens available for the system prompt and history
+    prompt_tokens: int    # Estimated tokens actually used
+    included: int
+    dropped: int          # Loaded messages left out of the window
+    truncated: int        # Messages cut down to fit
+    pinned: int = 0       # Early turns kept at the head of the prompt
+    window_start: Optional[int] = None  # Id of the oldest unpinned message included
+    compacted: bool = False
+    summary_through: Optional[int] = None  # Last message id covered by the summary in the system prompt
+
+    def stats(self) -> dict:
+        return {
+            "mode": PROMPT_ASSEMBLY,
+            "context_length": self.context_length,
+            "budget": self.budget,
+            "prompt_tokens": self.prompt_tokens,
+            "messages": self.included,
+            "pinned": self.pinned,
+            "dropped": self.dropped,
+            "truncated": self.truncated,
+            "compacted": self.compacted,
+            "summary": self.summary_through is not None
+        }
+
+
+def pack_messages(history: List[dict], model: str, system_prompt: Optional[str] = None,
+                  pinned: List[dict] = (), fill: float = 1.0) -> PromptPlan:
+    """
+    Fit history (oldest-first) into the model's context budget, newest first.
+
+    The budget is the model's context length minus room for the reply.
+    Pinned messages go first; the newest message is always kept (truncated
+    if it alone overflows); older messages are added until the next one no
+    longer fits, or until `fill` of the remaining budget is used. Any single
+    message larger than PROMPT_MAX_MESSAGE_SHARE of the budget is cut down
+    first so one long code answer cannot crowd out the rest of the
+    conversation.
+    """
+    context_length = context_length_for(model)
+    budget = context_length - min(PROMPT_RESPONSE_RESERVE_TOKENS, context_length // 4)
+    used = estimate_tokens(system_prompt) + PROMPT_MESSAGE_OVERHEAD_TOKENS if system_prompt else 0
+    per_message = max(int(budget * PROMPT_MAX_MESSAGE_SHARE), 256)
+    truncated = 0
+
+    def fit(message: dict, limit: int) -> tuple[dict, int]:
+        nonlocal truncated
+        cost = message_tokens(message)
+        message = {"role": message["role"], "content": message["content"]}
+        if cost > limit:
+            message["content"] = truncate_to_tokens(message["content"], limit - PROMPT_MESSAGE_OVERHEAD_TOKENS)
+            cost = message_tokens(message)
+            truncated += 1
+        return message, cost
+
+    head: List[dict] = []
+    for message in pinned:
+        message, cost = fit(message, per_message)
+        head.append(message)
+        used += cost
+
+    tail_budget = used + int((budget - used) * fill)
+    packed: List[dict] = []
+    for message in reversed(history):
+        message, cost = fit(message, per_message if packed else max(budget - used, 64))
+        if packed and used + cost > tail_budget:
+            break
+        packed.append(message)
+        used += cost
+
+    packed.reverse()
+    return PromptPlan(
+        messages=head + packed, context_length=context_length, budget=budget, prompt_tokens=used,
+        included=len(head) + len(packed), dropped=len(history) - len(packed), truncated=truncated,
+        pinned=len(head), window_start=history[len(history) - len(packed)].get("id") if packed else None
+    )
+
+
+async def load_recent_history(user_id: int, session_id: int, token_limit: int,
+                              floor_id: int = 0) -> tuple[List[dict], bool]:
+    """
+    Load the session's messages with id >= floor_id newest-first, a page at
+    a time, stopping once token_limit is reached. Returns (history
+    oldest-first, reached_floor).
+    """
+    history: List[dict] = []
+    tokens = 0
+    before_id = None
+    while True:
+        page, has_more = await adb.load_chat_history_page(user_id, PROMPT_HISTORY_PAGE, session_id, before_id=before_id)
+        kept = [m for m in page if m["id"] >= floor_id]
+        history[:0] = kept
+        tokens += sum(message_tokens(m) for m in kept)
+        if len(kept) < len(page) or not has_more or not page:
+            return history, True
+        if tokens >= token_limit:
+            return history, False
+        before_id = page[0]["id"]
+
+
+async def build_chat_prompt(user_id: int, session_id: int, model: str) -> tuple[PromptPlan, Optional[str]]:
+    """
+    Assemble the context for the next reply. Returns (plan, system_prompt).
+
+    "sliding" packs the most recent history that fits the budget, so the
+    window moves by a message every turn. "stable" keeps the prompt prefix
+    byte-identical between turns so the backend's KV cache for it is
+    reused: system prompt, then the session's first PROMPT_PINNED_MESSAGES,
+    then every message since the session's window start. New turns only
+    append; when the window overflows it is compacted once, restarting at
+    PROMPT_COMPACT_FILL of the budget, and the new start is stored on the
+    session. Either way prefill cost follows the budget, not the session;
+    turns left out are condensed in the background by the session
+    summariser and come back as a summary in the system prompt.
+    """
+    system_prompt = await adb.get_system_prompt_for_model(user_id, model)
+    context_length = context_length_for(model)
+    summary = await adb.get_session_summary(session_id) if session_summarizer.enabled else None
+
+    if PROMPT_ASSEMBLY != "stable":
+        history, _ = await load_recent_history(user_id, session_id, context_length)
+        plan = pack_messages(history, model, system_prompt)
+        if summary and plan.window_start is not None and summary["through_id"] < plan.window_start:
+            system_prompt = summary_system_prompt(system_prompt, summary)
+            plan = pack_messages(history, model, system_prompt)
+            plan.summary_through = summary["through_id"]
+        session_summarizer.schedule(user_id, session_id, plan.window_start)
+        return plan, system_prompt
+
+    pinned = []
+    if PROMPT_PINNED_MESSAGES:
+        pinned = await adb.load_chat_history(user_id, PROMPT_PINNED_MESSAGES, session_id, after_id=0)
+    floor_id = max(await adb.get_prompt_window(session_id) or 0, pinned[-1]["id"] + 1 if pinned else 0)
+    # The summary of the turns before the window rides in the system prompt, so it is part of the stable prefix
+    summary_applies = bool(summary) and summary["through_id"] < floor_id
+    if summary_applies:
+        system_prompt = summary_system_prompt(system_prompt, summary)
+    history, complete = await load_recent_history(user_id, session_id, context_length, floor_id)
+
+    plan = pack_messages(history, model, system_prompt, pinned)
+    if plan.dropped or not complete:
+        plan = pack_messages(history, model, system_prompt, pinned, fill=PROMPT_COMPACT_FILL)
+        plan.compacted = True
+        if plan.window_start is not None:
+            await adb.set_prompt_window(session_id, plan.window_start)
+    if summary_applies:
+        plan.summary_through = summary["through_id"]
+    session_summarizer.schedule(user_id, session_id, plan.window_start)
+    return plan, system_prompt
+
+
+class PrefixCacheStats:
+    """
+    How much of each prompt the backend served from its prefix (KV) cache,
+    per session, and what that did to time to first token.
+
+    vLLM reports cached prompt tokens directly when prefix caching is on.
+    Ollama reports only the tokens it evaluated (prompt_eval_count), so the
+    reused share is estimated against the packed prompt size.
+    """
+
+    def __init__(self, max_sessions: int = 1024):
+        self.max_sessions = max_sessions
+        self.sessions: OrderedDict = OrderedDict()
+
+    def record(self, session_id: int, estimated_tokens: int, delta: "StreamDelta") -> dict:
+        if delta.cached_tokens is not None and delta.prompt_tokens:
+            cached = delta.cached_tokens
+            evaluated = delta.prompt_tokens - cached
+            hit_ratio = cached / delta.prompt_tokens
+        else:
+            evaluated = delta.prompt_tokens
+            cached = max(estimated_tokens - evaluated, 0)
+            hit_ratio = cached / estimated_tokens if estimated_tokens else 0.0
+        result = {
+            "prompt_tokens": estimated_tokens,
+            "evaluated_tokens": evaluated,
+            "cached_tokens": cached,
+            "hit_ratio": round(hit_ratio, 3),
+            "ttft_ms": round(delta.ttft_ms, 1) if delta.ttft_ms is not None else None
+        }
+
+        stats = self.sessions.pop(session_id, None) or {
+            "requests": 0, "cached_tokens": 0, "evaluated_tokens": 0,
+            "hit": {"count": 0, "ttft_ms": 0.0}, "miss": {"count": 0, "ttft_ms": 0.0}
+        }
+        stats["requests"] += 1
+        stats["cached_tokens"] += cached
+        stats["evaluated_tokens"] += evaluated
+        if delta.ttft_ms is not None:
+            bucket = stats["hit" if hit_ratio >= 0.5 else "miss"]
+            bucket["count"] += 1
+            bucket["ttft_ms"] += delta.ttft_ms
+        self.sessions[session_id] = stats
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+        return result
+
+    def session(self, session_id: int) -> Optional[dict]:
+        stats = self.sessions.get(session_id)
+        if stats is None:
+            return None
+        hit, miss = stats["hit"], stats["miss"]
+        total = stats["cached_tokens"] + stats["evaluated_tokens"]
+        avg_hit = hit["ttft_ms"] / hit["count"] if hit["count"] else None
+        avg_miss = miss["ttft_ms"] / miss["count"] if miss["count"] else None
+        return {
+            "requests": stats["requests"],
+            "hit_ratio": round(stats["cached_tokens"] / total, 3) if total else 0.0,
+            "ttft_ms_hit": round(avg_hit, 1) if avg_hit is not None else None,
+            "ttft_ms_miss": round(avg_miss, 1) if avg_miss is not None else None,
+            "ttft_ms_saved": round(avg_miss - avg_hit, 1) if avg_hit is not None and avg_miss is not None else None
+        }
+
+    def stats(self) -> dict:
+        cached = sum(s["cached_tokens"] for s in self.sessions.values())
+        evaluated = sum(s["evaluated_tokens"] for s in self.sessions.values())
+        return {
+            "mode": PROMPT_ASSEMBLY,
+            "sessions": len(self.sessions),
+            "requests": sum(s["requests"] for s in self.sessions.values()),
+            "hit_ratio": round(cached / (cached + evaluated), 3) if cached + evaluated else 0.0
+        }
+
+
+prefix_cache_stats = PrefixCacheStats()
+
+# =============================================================================
+# Session Summaries (rolling condensation of older turns, off the request path)
+# =============================================================================
+
+SUMMARY_PROMPT = """You maintain a running summary of a conversation between a user and an AI assistant.
+Merge the existing summary and the new messages into one updated summary. Keep facts, decisions,
+requirements, names, file paths and code identifiers; drop pleasantries and restated content.
+Write at most {max_words} words of plain prose or terse bullet points. Output only the summary.
+
+EXISTING SUMMARY:
+{summary}
+
+NEW MESSAGES:
+{messages}
+
+UPDATED SUMMARY:"""
+
+
+def summary_system_prompt(system_prompt: Optional[str], summary: Optional[dict]) -> Optional[str]:
+    """Append a session summary to the system prompt (the one place every chat template accepts it)."""
+    if not summary:
+        return system_prompt
+    section = f"Summary of the earlier conversation:\n{summary['content']}"
+    return f"{system_prompt}\n\n{section}" if system_prompt else section
+
+
+class SessionSummarizer:
+    """
+    Condenses the turns that have fallen out of a session's prompt window
+    into a stored summary (session_summaries), using a cheap model.
+
+    The prompt builder calls schedule() with the id of the oldest message it
+    kept; once the unsummarised turns before it reach
+    SUMMARY_THRESHOLD_TOKENS, a background task folds them into the rolling
+    summary, a chunk at a time. Summaries go through admission like chat
+    streams, run at most `concurrency` at a time, and are deleted by the
+    data layer when a covered message is edited or deleted.
+    """
+
+    def __init__(self, model: str, threshold_tokens: int, concurrency: int = 1, max_sessions: int = 4096):
+        self.model = model
+        self.threshold_tokens = threshold_tokens
+        self.max_sessions = max_sessions
+        self.tasks: Dict[int, asyncio.Task] = {}
+        self._checked: OrderedDict = OrderedDict()  # session_id -> window start already found below threshold
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.runs = 0
+        self.errors = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.model) and self.threshold_tokens > 0
+
+    def schedule(self, user_id: int, session_id: int, window_start: Optional[int]):
+        if not self.enabled or window_start is None or session_id in self.tasks:
+            return
+        if self._checked.get(session_id) == window_start:
+            self._checked.move_to_end(session_id)
+            return
+        task = asyncio.create_task(self._run(user_id, session_id, window_start))
+        self.tasks[session_id] = task
+        task.add_done_callback(lambda _: self.tasks.pop(session_id, None))
+
+    async def _run(self, user_id: int, session_id: int, window_start: int):
+        try:
+            async with self._semaphore:
+                if not await self.summarize(user_id, session_id, window_start):
+                    self._mark_checked(session_id, window_start)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.errors += 1
+            self._mark_checked(session_id, window_start)  # Retry once the window moves again
+            print(f"Session summary error (session {session_id}): {e}")
+
+    def _mark_checked(self, session_id: int, window_start: int):
+        self._checked.pop(session_id, None)
+        self._checked[session_id] = window_start
+        while len(self._checked) > self.max_sessions:
+            self._checked.popitem(last=False)
+
+    def forget(self, session_id: int):
+        """Drop per-session state once the session is deleted."""
+        self._checked.pop(session_id, None)
+
+    async def summarize(self, user_id: int, session_id: int, window_start: int) -> bool:
+        """Fold unsummarised turns before window_start into the summary. Returns False if below threshold."""
+        summary = await adb.get_session_summary(session_id)
+        if summary:
+            after_id = summary["through_id"]
+        elif PROMPT_ASSEMBLY == "stable" and PROMPT_PINNED_MESSAGES:
+            # Pinned messages stay in every stable prompt; only sliding windows drop them
+            pinned = await adb.load_chat_history(user_id, PROMPT_PINNED_MESSAGES, session_id, after_id=0)
+            after_id = pinned[-1]["id"] if pinned else 0
+        else:
+            after_id = 0
+
+        gap: List[dict] = []
+        while True:
+            page, has_more = await adb.load_chat_history_page(user_id, PROMPT_HISTORY_PAGE, session_id, after_id=after_id)
+            gap.extend(m for m in page if m["id"] < window_start)
+            if not has_more or not page or page[-1]["id"] >= window_start:
+                break
+            after_id = page[-1]["id"]
+        source_tokens = sum(message_tokens(m) for m in gap)
+        if source_tokens < self.threshold_tokens:
+            return False
+
+        text = summary["content"] if summary else ""
+        chunk: List[str] = []
+        chunk_tokens = 0
+        for message in gap:
+            line = f"{message['role'].upper()}: {truncate_to_tokens(message['content'], SUMMARY_INPUT_TOKENS // 2)}"
+            chunk.append(line)
+            chunk_tokens += estimate_tokens(line)
+            if chunk_tokens >= SUMMARY_INPUT_TOKENS:
+                text = await self._condense(user_id, text, chunk)
+                chunk, chunk_tokens = [], 0
+        if chunk:
+            text = await self._condense(user_id, text, chunk)
+
+        await adb.save_session_summary(
+            session_id, user_id, gap[-1]["id"], text, self.model,
+            source_tokens + (summary["source_tokens"] if summary else 0)
+        )
+        self.runs += 1
+        return True
+
+    async def _condense(self, user_id: int, summary: str, lines: List[str]) -> str:
+        backend, base_url = get_backend_for_model(self.model)
+        prompt = SUMMARY_PROMPT.format(
+            max_words=SUMMARY_MAX_TOKENS * 3 // 4, summary=summary or "(none)", messages="\n\n".join(lines)
+        )
+        ticket = admission.enqueue(backend, self.model, user_id)
+        try:
+            async for _ in ticket.wait():
+                pass
+            response = await get_llm_backend(backend).generate(
+                base_url, self.model, prompt, temperature=0.2, max_tokens=SUMMARY_MAX_TOKENS
+            )
+        finally:
+            admission.release(ticket)
+        response = re.sub(r"<think>[\s\S]*?</think>", "", response or "").strip()
+        if not response:
+            raise ValueError("Summary model returned no text")
+        return response
+
+    async def shutdown(self):
+        for task in list(self.tasks.values()):
+            task.cancel()
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {"model": self.model or None, "running": len(self.tasks), "runs": self.runs, "errors": self.errors}
+
+
+session_summarizer = SessionSummarizer(SUMMARY_MODEL, SUMMARY_THRESHOLD_TOKENS)
+
+# =============================================================================
+# Generation Manager (owns chat generations independently of HTTP requests)
+# =============================================================================
+
+class GenerationRejected(Exception):
+    """A generation could not be started (limit reached, session busy, bad state)."""
+
+    def __init__(self, message: str, status_code: int = 400, retry_after: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+    def to_http(self) -> HTTPException:
+        headers = {"Retry-After": str(self.retry_after)} if self.retry_after else None
+        return HTTPException(status_code=self.status_code, detail=str(self), headers=headers)
+
+
+@dataclass
+class GenerationRequest:
+    user_id: int
+    session_id: int
+    model: str
+    backend: str
+    base_url: str
+    messages: List[dict]
+    prefix: str = ""                   # Partial content being continued
+    message_id: Optional[int] = None   # Assistant message to update instead of inserting
+    system_prompt: Optional[str] = None
+    prompt_stats: dict = field(default_factory=dict)  # Token accounting from the prompt builder
+    cached: Optional[CachedResponse] = None  # Replay this instead of calling the backend
+
+    @property
+    def options(self) -> Optional[dict]:
+        # Size Ollama's context window to the budget the prompt was packed for
+        if self.backend == "ollama" and self.prompt_stats:
+            return {"num_ctx": self.prompt_stats["context_length"]}
+        return None
+
+
+class ChatGeneration(LiveGeneration):
+    """A LiveGeneration for one chat reply, with the state its manager needs."""
+
+    def __init__(self, generation_id: str, request: GenerationRequest):
+        super().__init__(generation_id, {
+            "session_id": request.session_id, "backend": request.backend, "prompt": request.prompt_stats,
+            "cached": request.cached is not None
+        })
+        self.request = request
+        self.parts: List[str] = [request.prefix] if request.prefix else []
+        self.artifacts = ArtifactTokenizer()
+        if request.prefix:
+            # A continuation picks up mid-reply: prime the tokenizer without emitting events
+            self.artifacts.feed(request.prefix)
+        self.message_id = request.message_id
+        self.ticket: Optional[AdmissionTicket] = None
+        self.status = "running"
+        self.streaming = True
+        self.persisted = False
+        self.stop_requested = False
+
+    @property
+    def content(self) -> str:
+        return "".join(self.parts)
+
+
+class GenerationManager:
+    """
+    Owns the chat generations running in this worker.
+
+    Each generation's upstream request runs as its own task and fans out to
+    any number of SSE subscribers, so clients can disconnect and reattach
+    freely. Start/stop/continue/status go through here; the chat routes are
+    thin views. Running generations are also recorded in the shared
+    registry, so limits, stop and status work whichever worker a request
+    lands on. The assistant message is persisted exactly once per
+    generation, whichever way it ends (complete, stopped, error, shutdown).
+    """
+
+    def __init__(self, registry: GenerationRegistry, max_per_user: int, worker_id: str):
+        self.registry = registry
+        self.max_per_user = max_per_user
+        self.worker_id = worker_id
+        self.generations: Dict[str, ChatGeneration] = {}
+        self._tasks: List[asyncio.Task] = []
+
+    def get(self, generation_id: str) -> Optional[ChatGeneration]:
+        return self.generations.get(generation_id)
+
+    def local_running(self) -> List[ChatGeneration]:
+        return [g for g in self.generations.values() if not g.finished]
+
+    async def check_capacity(self, user_id: int, session_id: Optional[int] = None):
+        """Raise GenerationRejected if the user may not start another generation now."""
+        if session_id is not None and await self.registry.find(user_id, session_id):
+            raise GenerationRejected("A response is already being generated for this session", 409)
+        if len(await self.registry.running(user_id)) >= self.max_per_user:
+            raise GenerationRejected(
+                f"Too many concurrent generations (limit {self.max_per_user})", 429
+            )
+
+    async def start(self, request: GenerationRequest) -> ChatGeneration:
+        # Take a backend slot or a queue place first, so an overloaded model sheds load with 429
+        # (a cache hit never touches the backend)
+        ticket = None
+        if request.cached is None:
+            try:
+                ticket = admission.enqueue(request.backend, request.model, request.user_id)
+            except AdmissionRejected as e:
+                raise GenerationRejected(str(e), 429, retry_after=e.retry_after)
+
+        generation_id = new_generation_id(request.user_id)
+        try:
+            refused = await self.registry.register(self._entry(generation_id, request), self.max_per_user)
+        except BaseException:
+            admission.release(ticket)
+            raise
+        if refused:
+            admission.release(ticket)
+        if refused == "session_busy":
+            raise GenerationRejected("A response is already being generated for this session", 409)
+        if refused == "limit":
+            raise GenerationRejected(f"Too many concurrent generations (limit {self.max_per_user})", 429)
+
+        generation = ChatGeneration(generation_id, request)
+        generation.ticket = ticket
+        self.generations[generation_id] = generation
+        generation.task = asyncio.create_task(self._run(generation))
+        return generation
+
+    async def continue_session(self, user_id: int, session_id: int, model: str) -> ChatGeneration:
+        """Continue the session's trailing partial assistant message."""
+        await self.check_capacity(user_id, session_id)
+        last = await adb.load_chat_history(user_id, limit=1, session_id=session_id)
+        if not last:
+            raise GenerationRejected("No messages to continue from")
+        last_msg = last[-1]
+        if last_msg["role"] != "assistant" or not last_msg.get("is_partial"):
+            raise GenerationRejected("Last message is not a partial response")
+
+        # Partial response as context, plus a continue prompt
+        plan, system_prompt = await build_chat_prompt(user_id, session_id, model)
+        messages = plan.messages + [{"role": "user", "content": "Continue from where you left off."}]
+        backend, backend_url = get_backend_for_model(model)
+        return await self.start(GenerationRequest(
+            user_id=user_id, session_id=session_id, model=model,
+            backend=backend, base_url=backend_url, messages=messages,
+            prefix=last_msg["content"], message_id=last_msg["id"],
+            system_prompt=system_prompt, prompt_stats=plan.stats()
+        ))
+
+    async def stop(self, user_id: int, generation_id: str = None, session_id: int = None) -> Optional[dict]:
+        """
+        Stop a generation by id or by session, wherever it runs. Returns
+        {"generation_id", "partial_content"}, or None if nothing is running.
+        The owning task saves the partial reply.
+        """
+        if generation_id is None:
+            entry = await self.registry.find(user_id, session_id)
+            if not entry:
+                return None
+            generation_id = entry["generation_id"]
+        if generation_owner(generation_id) != user_id:
+            return None
+
+        generation = self.generations.get(generation_id)
+        if generation:
+            if generation.finished:
+                return None
+            self._stop_local(generation)
+            return {"generation_id": generation_id, "partial_content": generation.content}
+
+        # Running on another worker: signal it and report what it has streamed so far
+        if not await self.registry.request_stop(generation_id):
+            return None
+        state = await run_io(get_generation_state, generation_id)
+        return {"generation_id": generation_id, "partial_content": (state or {}).get("content", "")}
+
+    def _stop_local(self, generation: ChatGeneration):
+        generation.stop_requested = True
+        if generation.streaming and generation.task:
+            # Interrupt the upstream read right away rather than at the next token
+            generation.task.cancel()
+
+    async def status(self, user_id: int, generation_id: str = None, session_id: int = None) -> Optional[dict]:
+        """Status of a running generation (local or on another worker), else None."""
+        if generation_id is None:
+            entry = await self.registry.find(user_id, session_id)
+            if not entry:
+                return None
+            generation_id = entry["generation_id"]
+        if generation_owner(generation_id) != user_id:
+            return None
+
+        generation = self.generations.get(generation_id)
+        if generation:
+            return self._local_status(generation)
+        entry = await self.registry.get(generation_id)
+        if not entry:
+            return None
+        state = await run_io(get_generation_state, generation_id) or {}
+        return {
+            "generation_id": generation_id,
+            "status": state.get("status", "running"),
+            "session_id": entry["session_id"],
+            "model": entry["model"],
+            "backend": entry["backend"],
+            "content": state.get("content", ""),
+            "message_id": None,
+            "seq": state.get("seq", 0),
+            "started": entry["started_at"],
+            "worker_id": entry["worker_id"]
+        }
+
+    async def running_ids(self, user_id: int) -> set:
+        """Ids of the user's generations still running, here or on another worker."""
+        ids = {g.generation_id for g in self.local_running() if g.request.user_id == user_id}
+        ids.update(entry["generation_id"] for entry in await self.registry.running(user_id))
+        return ids
+
+    async def running(self, user_id: int) -> List[dict]:
+        """Status of every generation the user has running, across workers."""
+        statuses = []
+        for entry in await self.registry.running(user_id):
+            status = await self.status(user_id, entry["generation_id"])
+            if status:
+                statuses.append(status)
+        return statuses
+
+    def _local_status(self, generation: ChatGeneration) -> dict:
+        request = generation.request
+        return {
+            "generation_id": generation.generation_id,
+            "status": generation.status,
+            "session_id": request.session_id,
+            "model": request.model,
+            "backend": request.backend,
+            "content": generation.content,
+            "message_id": generation.message_id,
+            "seq": generation.journal.seq,
+            "started": generation.journal.started,
+            "worker_id": self.worker_id
+        }
+
+    def _entry(self, generation_id: str, request: GenerationRequest) -> dict:
+        return {
+            "generation_id": generation_id,
+            "user_id": request.user_id,
+            "session_id": request.session_id,
+            "worker_id": self.worker_id,
+            "model": request.model,
+            "backend": request.backend,
+            "started_at": datetime.now().isoformat()
+        }
+
+    async def _run(self, generation: ChatGeneration):
+        try:
+            await generation.run(self._events(generation))
+        finally:
+            admission.release(generation.ticket)
+            if generation.status in ("queued", "running"):
+                generation.status = "error"
+            try:
+                await self.registry.finish(self._entry(generation.generation_id, generation.request))
+            except Exception as e:
+                print(f"Generation registry error: {e}")
+            # Keep finished generations around briefly so reattaching clients replay from memory
+            asyncio.get_running_loop().call_later(
+                SSE_REPLAY_LINGER_SECONDS, self.generations.pop, generation.generation_id, None
+            )
+
+    async def _events(self, generation: ChatGeneration):
+        request = generation.request
+        usage = {"prompt_tokens": 0, "completion_tokens": 0}
+        prefix_cache = None
+        try:
+            if request.cached:
+                stream = replay_cached_response(request.cached.content)
+            else:
+                # Wait for a backend slot, telling the client where it is in the queue
+                async for position in generation.ticket.wait():
+                    generation.status = "queued"
+                    yield {"type": "queued", "position": position, "queue_length": generation.ticket.lane.queued}
+                llm = get_llm_backend(request.backend)
+                stream = llm.stream_chat(request.base_url, request.model, request.messages,
+                                         request.system_prompt, request.options)
+            generation.status = "running"
+
+            try:
+                async with aclosing(stream) as stream:
+                    async for delta in stream:
+                        if delta.content:
+                            generation.parts.append(delta.content)
+                            yield {"type": "content", "content": delta.content}
+                            for event in generation.artifacts.feed(delta.content):
+                                yield event
+                        if delta.done and not request.cached:
+                            usage = {"prompt_tokens": delta.prompt_tokens, "completion_tokens": delta.completion_tokens}
+                            prefix_cache = prefix_cache_stats.record(
+                                request.session_id, request.prompt_stats.get("prompt_tokens", 0), delta
+                            )
+            finally:
+                # Free the slot as soon as the upstream stream ends, before persisting
+                admission.release(generation.ticket)
+        except asyncio.CancelledError:
+            # Stop request or shutdown: keep what we have
+            generation.streaming = False
+            await asyncio.shield(self._persist(generation, partial=True))
+            generation.status = "stopped"
+            yield {"type": "stopped", "partial": True}
+            return
+        except Exception as e:
+            generation.streaming = False
+            await asyncio.shield(self._persist(generation, partial=True))
+            generation.status = "error"
+            yield {"type": "error", "error": str(e)}
+            return
+        generation.streaming = False
+
+        if generation.stop_requested:
+            await asyncio.shield(self._persist(generation, partial=True))
+            generation.status = "stopped"
+            yield {"type": "stopped", "partial": True}
+            return
+
+        for event in generation.artifacts.finish():
+            yield event
+        artifact_counts = await asyncio.shield(self._persist(generation, partial=False, usage=usage))
+        generation.status = "complete"
+        if artifact_counts is not None:
+            done = {"type": "done", "usage": usage, "artifacts": artifact_counts, "prefix_cache": prefix_cache}
+            if request.cached:
+                done["cache"] = {"match": request.cached.match, "similarity": request.cached.similarity}
+            yield done
+        else:
+            yield {"type": "done", "usage": {"prompt_tokens": 0, "completion_tokens": 0}}
+
+    async def _persist(self, generation: ChatGeneration, partial: bool, usage: dict = None) -> Optional[dict]:
+        """Save the assistant message (once). Returns artifact counts for a completed reply."""
+        if generation.persisted:
+            return None
+        generation.persisted = True
+        request = generation.request
+        content = generation.content
+        if not content:
+            return None
+
+        if generation.message_id is not None:
+            await adb.update_message(generation.message_id, content, is_partial=partial)
+        else:
+            generation.message_id = await adb.save_message(
+                request.user_id, "assistant", content, request.model,
+                request.session_id, is_partial=partial
+            )
+            if not partial:
+                await adb.chroma_save_message(request.user_id, "assistant", content, request.model)
+        if partial:
+            return None
+
+        usage = usage or {"prompt_tokens": 0, "completion_tokens": 0}
+        await adb.log_usage(request.user_id, request.model, usage["prompt_tokens"], usage["completion_tokens"])
+        if not request.prefix and not request.cached:
+            await response_cache.store(request.user_id, request.model, request.system_prompt, request.messages, content)
+
+        # Save the artifacts the tokenizer completed while streaming
+        artifact_counts = {"code": 0, "thought": 0, "document": 0}
+        saved = await adb.save_artifacts(
+            request.session_id, request.user_id, generation.artifacts.artifacts, generation.message_id
+        )
+        for artifact in saved:
+            artifact_counts[artifact["type"]] += 1
+        return artifact_counts
+
+    def start_background(self):
+        """Start heartbeating local generations and listening for stop signals."""
+        self._tasks = [asyncio.create_task(self._heartbeat_loop()), asyncio.create_task(self._stop_listener())]
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(GENERATION_HEARTBEAT_SECONDS)
+            try:
+                await self.registry.heartbeat([
+                    self._entry(g.generation_id, g.request) for g in self.local_running()
+                ])
+            except Exception as e:
+                print(f"Generation registry error: {e}")
+
+    async def _stop_listener(self):
+        while True:
+            try:
+                async for generation_id in self.registry.stop_requests(self.worker_id):
+                    generation = self.generations.get(generation_id)
+                    if generation and not generation.finished:
+                        self._stop_local(generation)
+            except Exception as e:
+                print(f"Generation registry error: {e}")
+                await asyncio.sleep(GENERATION_STOP_POLL_SECONDS)
+
+    async def shutdown(self):
+        """Stop everything still running; each task saves its partial reply."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        running = self.local_running()
+        for generation in running:
+            self._stop_local(generation)
+        await asyncio.gather(*(g.task for g in running if g.task), return_exceptions=True)
+        # Journals finish writing (and compact) in the background; let them
+        await asyncio.gather(*(g.journal.drain() for g in self.generations.values()), return_exceptions=True)
+        await self.registry.close()
+
+    def stats(self) -> dict:
+        running = self.local_running()
+        return {
+            "worker_id": self.worker_id,
+            "registry": type(self.registry).__name__,
+            "running": len(running),
+            "users": len({g.request.user_id for g in running}),
+            "retained": len(self.generations) - len(running),
+            "max_per_user": self.max_per_user
+        }
+
+
+generation_manager = GenerationManager(generation_registry, MAX_GENERATIONS_PER_USER, WORKER_ID)
+
+# =============================================================================
+# JWT Authentication
+# =============================================================================
+
+def create_access_token(data: dict, expires_delta: timedelta = None) -> str:
+    to_encode = data.copy()
+    expire = datetime.utcnow() + (expires_delta or timedelta(days=ACCESS_TOKEN_EXPIRE_DAYS))
+    to_encode.update({"exp": expire})
+    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+
+def verify_token(token: str) -> Optional[dict]:
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        return payload
+    except JWTError:
+        return None
+
+async def get_current_user(request: Request) -> int:
+    token = request.cookies.get("access_token")
+    if not token:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    payload = verify_token(token)
+    if not payload:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    user_id = payload.get("user_id")
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return user_id
+
+# =============================================================================
+# Backend HTTP Clients (shared keep-alive pools)
+# =============================================================================
+
+class BackendHTTPClients:
+    """
+    Application-scoped registry of httpx.AsyncClient, one per backend URL.
+
+    Clients are opened in lifespan() and reused for every backend call, so
+    chats ride on warm keep-alive connections instead of paying a TCP
+    handshake and pool setup per request. Use `async with
+    backend_http.client(url, "ollama") as client:`; per-request timeouts
+    can still be passed to the individual httpx calls. In-flight counts per
+    URL are tracked for saturation metrics (and endpoint selection).
+    """
+
+    def __init__(self, max_connections: int, max_keepalive: int, keepalive_expiry: float,
+                 timeouts: Dict[str, httpx.Timeout], http2: bool = False):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=keepalive_expiry
+        )
+        self.timeouts = timeouts
+        self.http2 = http2
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self._stats: Dict[str, dict] = {}
+
+    def get(self, base_url: str, backend: str = "ollama") -> httpx.AsyncClient:
+        client = self._clients.get(base_url)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(
+                base_url=base_url,
+                limits=self.limits,
+                timeout=self.timeouts.get(backend, self.timeouts["default"]),
+                # HTTP/2 is only negotiated over TLS (ALPN); plain http stays on 1.1
+                http2=self.http2 and base_url.startswith("https://")
+            )
+            self._clients[base_url] = client
+            self._stats.setdefault(base_url, {
+                "backend": backend, "in_flight": 0, "peak_in_flight": 0, "requests": 0, "errors": 0
+            })
+        return client
+
+    @asynccontextmanager
+    async def client(self, base_url: str, backend: str = "ollama"):
+        client = self.get(base_url, backend)
+        stats = self._stats[base_url]
+        stats["in_flight"] += 1
+        stats["requests"] += 1
+        stats["peak_in_flight"] = max(stats["peak_in_flight"], stats["in_flight"])
+        try:
+            yield client
+        except httpx.TransportError as e:
+            stats["errors"] += 1
+            # Connection-level failures count toward ejecting the endpoint from the pool
+            backend_pool.report_failure(base_url, str(e) or type(e).__name__)
+            raise
+        except Exception:
+            stats["errors"] += 1
+            raise
+        else:
+            backend_pool.report_success(base_url)
+        finally:
+            stats["in_flight"] -= 1
+
+    def in_flight(self, base_url: str) -> int:
+        stats = self._stats.get(base_url)
+        return stats["in_flight"] if stats else 0
+
+    async def aclose(self):
+        clients, self._clients = self._clients, {}
+        for client in clients.values():
+            await client.aclose()
+
+    def stats(self) -> dict:
+        max_connections = self.limits.max_connections
+        return {
+            url: {
+                **stats,
+                "max_connections": max_connections,
+                "saturation": round(stats["in_flight"] / max_connections, 3) if max_connections else 0.0
+            }
+            for url, stats in self._stats.items()
+        }
+
+
+backend_http = BackendHTTPClients(
+    max_connections=HTTP_MAX_CONNECTIONS,
+    max_keepalive=HTTP_MAX_KEEPALIVE,
+    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    timeouts={
+        "ollama": httpx.Timeout(OLLAMA_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+        "vllm": httpx.Timeout(VLLM_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+        "default": httpx.Timeout(120, connect=HTTP_CONNECT_TIMEOUT)
+    },
+    http2=HTTP2_ENABLED and H2_AVAILABLE
+)
+
+# =============================================================================
+# Ollama Functions
+# =============================================================================
+
+async def get_all_available_models() -> Dict[str, List[str]]:
+    """Get models from both Ollama and vLLM backends (served from the model catalog)."""
+    return await model_catalog.get()
+
+@functools.lru_cache(maxsize=1024)
+def match_vision_model(model_name: str) -> bool:
+    return any(vm in model_name.lower() for vm in VISION_MODELS)
+
+def is_vision_model(model_name: str) -> bool:
+    # Catalogued models carry a precomputed flag; unknown names fall back to the memoized scan
+    vision = model_catalog.vision_flag(model_name)
+    return match_vision_model(model_name) if vision is None else vision
+
+def backend_for_model(model_name: str) -> str:
+    """
+    The backend type ("ollama" or "vllm") a model is routed to, without
+    picking an endpoint. Vision models always go to Ollama, text models go
+    to vLLM when enabled, unless the model catalog has only seen the model
+    on Ollama (or every vLLM endpoint serving it is ejected).
+    """
+    if VLLM_ENABLED and not is_vision_model(model_name):
+        served_by = model_catalog.backends_for(model_name)
+        if served_by != {"ollama"} and not (
+            "ollama" in served_by and not backend_pool.serves("vllm", model_name)
+        ):
+            return "vllm"
+    return "ollama"
+
+def get_backend_for_model(model_name: str) -> tuple:
+    """
+    Returns (backend_type, base_url) for routing a request: the backend as
+    backend_for_model() decides, and a concrete endpoint picked from the
+    backend pool (one pick per request, so load spreads across endpoints).
+    """
+    backend = backend_for_model(model_name)
+    return (backend, backend_pool.pick(backend, model_name))
+
+# =============================================================================
+# LLM Backend Adapters
+# =============================================================================
+
+class BackendHTTPError(Exception):
+    """Backend answered with a non-200 status."""
+
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+@dataclass
+class StreamDelta:
+    """One event from a backend chat stream: a content delta, or the final summary."""
+    content: str = ""
+    done: bool = False
+    finish_reason: Optional[str] = None
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cached_tokens: Optional[int] = None  # Prompt tokens served from the prefix cache, if reported
+    ttft_ms: Optional[float] = None  # Time to first content token (set on done)
+    total_ms: Optional[float] = None  # Wall time of the whole stream (set on done)
+    backend_timings: Optional[Dict[str, float]] = None  # Backend-reported durations in ms, if any
+
+
+async def iter_stream_lines(response: httpx.Response):
+    """Split a streaming body into raw lines (bytes) without re-decoding the buffer."""
+    buffer = bytearray()
+    async for chunk in response.aiter_bytes():
+        buffer += chunk
+        start = 0
+        while True:
+            end = buffer.find(b"\n", start)
+            if end < 0:
+                break
+            if end > start:
+                yield bytes(buffer[start:end])
+            start = end + 1
+        if start:
+            del buffer[:start]
+    if buffer.strip():
+        yield bytes(buffer)
+
+
+def scan_json_string_after(text: str, marker: str, start: int = 0) -> Optional[str]:
+    """
+    Decode the JSON string value that follows `marker` (which ends with an
+    opening quote) using the C string scanner, without parsing the whole object.
+    """
+    idx = text.find(marker, start)
+    if idx < 0:
+        return None
+    try:
+        value, _ = json_scanstring(text, idx + len(marker))
+    except ValueError:
+        return None
+    return value
+
+
+class LLMBackend:
+    """
+    Adapter interface for an inference engine.
+
+    stream_chat() yields StreamDelta events: zero or more content deltas
+    followed by exactly one `done` delta carrying usage, finish reason and
+    timing. Adapters are stateless; the base URL is passed per call so one
+    adapter serves any number of endpoints. Register new engines with
+    register_llm_backend().
+    """
+
+    name = "base"
+    error_prefix = "HTTP"
+
+    @staticmethod
+    def with_system_prompt(messages: List[Dict], system_prompt: Optional[str]) -> List[Dict]:
+        """Prepend the system prompt as the first message, identically for every engine."""
+        if not system_prompt:
+            return messages
+        return [{"role": "system", "content": system_prompt}] + messages
+
+    async def stream_chat(self, base_url: str, model: str, messages: List[Dict],
+                          system_prompt: Optional[str] = None, options: Optional[Dict] = None):
+        raise NotImplementedError
+        yield  # pragma: no cover - makes this an async generator
+
+    async def generate(self, base_url: str, model: str, prompt: str,
+                       temperature: float = 0.3, max_tokens: int = 1500, timeout: float = 120) -> Optional[str]:
+        raise NotImplementedError
+
+    async def generate_batch(self, base_url: str, model: str, prompts: List[str], temperature: float = 0.3,
+                             max_tokens: int = 1500, timeout: float = 120) -> List[Optional[str]]:
+        """Completions for several prompts, in order. Default: concurrent generate() calls."""
+        return await asyncio.gather(*(
+            self.generate(base_url, model, prompt, temperature, max_tokens, timeout) for prompt in prompts
+        ))
+
+    async def list_models(self, base_url: str, timeout: float = 5) -> List[str]:
+        raise NotImplementedError
+
+    async def ping(self, base_url: str, timeout: float = 2) -> bool:
+        raise NotImplementedError
+
+    async def loaded_models(self, base_url: str, timeout: float = 5) -> List[str]:
+        """Models currently loaded in memory (default: everything the server lists)."""
+        return await self.list_models(base_url, timeout)
+
+    def _http_error(self, response: httpx.Response) -> BackendHTTPError:
+        return BackendHTTPError(f"{self.error_prefix} {response.status_code}", response.status_code)
+
+
+class OllamaBackend(LLMBackend):
+    """Ollama native API: NDJSON chat stream, /api/generate, /api/tags."""
+
+    name = "ollama"
+
+    def parse_line(self, line: bytes) -> Optional[dict]:
+        """Return {"content": ...} for a plain delta line (fast path) or the full chunk."""
+        text = line.decode("utf-8")
+        if '"done":false' in text:
+            msg_idx = text.find('"message":{')
+            if msg_idx >= 0:
+                content = scan_json_string_after(text, '"content":"', msg_idx)
+                if content is not None:
+                    return {"content": content}
+        try:
+            chunk = json.loads(text)
+        except json.JSONDecodeError:
+            return None
+        chunk["content"] = (chunk.get("message") or {}).get("content", "")
+        return chunk
+
+    async def stream_chat(self, base_url, model, messages, system_prompt=None, options=None):
+        payload = {"model": model, "messages": self.with_system_prompt(messages, system_prompt), "stream": True}
+        if OLLAMA_KEEP_ALIVE:
+            payload["keep_alive"] = OLLAMA_KEEP_ALIVE
+        if options:
+            payload["options"] = options
+
+        started = time.perf_counter()
+        ttft = None
+        async with backend_http.client(base_url, self.name) as client:
+            async with client.stream("POST", "/api/chat", json=payload) as response:
+                if response.status_code != 200:
+                    raise self._http_error(response)
+                async for line in iter_stream_lines(response):
+                    chunk = self.parse_line(line)
+                    if chunk is None:
+                        continue
+                    content = chunk["content"]
+                    if content:
+                        if ttft is None:
+                            ttft = (time.perf_counter() - started) * 1000
+                        yield StreamDelta(content=content)
+                    if chunk.get("done"):
+                        yield StreamDelta(
+                            done=True,
+                            finish_reason=chunk.get("done_reason", "stop"),
+                            prompt_tokens=chunk.get("prompt_eval_count", 0),
+                            completion_tokens=chunk.get("eval_count", 0),
+                            ttft_ms=ttft,
+                            total_ms=(time.perf_counter() - started) * 1000,
+                            backend_timings={
+                                key: chunk[key] / 1e6
+                                for key in ("load_duration", "prompt_eval_duration", "eval_duration", "total_duration")
+                                if isinstance(chunk.get(key), (int, float))
+                            }
+                        )
+                        return
+
+    async def generate(self, base_url, model, prompt, temperature=0.3, max_tokens=1500, timeout=120):
+        payload = {
+            "model": model,
+            "prompt": prompt,
+            "stream": False,
+            "options": {
+                "temperature": temperature,
+                "num_predict": max_tokens
+            }
+        }
+        if OLLAMA_KEEP_ALIVE:
+            payload["keep_alive"] = OLLAMA_KEEP_ALIVE
+        async with backend_http.client(base_url, self.name) as client:
+            response = await client.post("/api/generate", json=payload, timeout=timeout)
+            if response.status_code != 200:
+                raise self._http_error(response)
+            return response.json().get("response", "{}")
+
+    async def list_models(self, base_url, timeout=5):
+        async with backend_http.client(base_url, self.name) as client:
+            response = await client.get("/api/tags", timeout=timeout)
+            if response.status_code != 200:
+                raise self._http_error(response)
+            return [m["name"] for m in response.json().get("models", [])]
+
+    async def ping(self, base_url, timeout=2):
+        async with backend_http.client(base_url, self.name) as client:
+            response = await client.get("/api/tags", timeout=timeout)
+            return response.status_code == 200
+
+    async def loaded_models(self, base_url, timeout=5):
+        async with backend_http.client(base_url, self.name) as client:
+            response = await client.get("/api/ps", timeout=timeout)
+            if response.status_code != 200:
+                raise self._http_error(response)
+            return [m["name"] for m in response.json().get("models", [])]
+
+
+class VLLMBackend(LLMBackend):
+    """vLLM (or any OpenAI-compatible server): SSE chat stream, /v1/completions, /v1/models."""
+
+    name = "vllm"
+    error_prefix = "vLLM HTTP"
+
+    def parse_line(self, line: bytes) -> Optional[dict]:
+        """Return {"content": ...} for a plain delta (fast path), the full chunk, or {"end": True} on [DONE]."""
+        if not line.startswith(b"data: "):
+            return None
+        text = line[6:].decode("utf-8")
+        if text == "[DONE]":
+            return {"end": True}
+        if '"finish_reason":null' in text and '"usage":{' not in text:
+            delta_idx = text.find('"delta":{')
+            if delta_idx >= 0:
+                content = scan_json_string_after(text, '"content":"', delta_idx)
+                if content is not None:
+                    return {"content": content}
+        try:
+            chunk = json.loads(text)
+        except json.JSONDecodeError:
+            return None
+        choices = chunk.get("choices") or []
+        if choices:
+            chunk["content"] = (choices[0].get("delta") or {}).get("content") or ""
+            chunk["finish_reason"] = choices[0].get("finish_reason")
+        else:
+            chunk["content"] = ""
+        return chunk
+
+    async def stream_chat(self, base_url, model, messages, system_prompt=None, options=None):
+        payload = {
+            "model": model,
+            "messages": self.with_system_prompt(messages, system_prompt),
+            "stream": True,
+            "stream_options": {"include_usage": True}
+        }
+        if options:
+            payload.update(options)
+
+        started = time.perf_counter()
+        ttft = None
+        finish_reason = None
+        usage = {}
+        async with backend_http.client(base_url, self.name) as client:
+            async with client.stream("POST", "/v1/chat/completions", json=payload) as response:
+                if response.status_code != 200:
+                    raise self._http_error(response)
+                async for line in iter_stream_lines(response):
+                    chunk = self.parse_line(line)
+                    if chunk is None:
+                        continue
+                    if chunk.get("end"):
+                        break
+                    content = chunk["content"]
+                    if content:
+                        if ttft is None:
+                            ttft = (time.perf_counter() - started) * 1000
+                        yield StreamDelta(content=content)
+                    if chunk.get("finish_reason"):
+                        finish_reason = chunk["finish_reason"]
+                    if chunk.get("usage"):
+                        usage = chunk["usage"]
+
+        yield StreamDelta(
+            done=True,
+            finish_reason=finish_reason or "stop",
+            prompt_tokens=usage.get("prompt_tokens", 0),
+            completion_tokens=usage.get("completion_tokens", 0),
+            cached_tokens=(usage.get("prompt_tokens_details") or {}).get("cached_tokens"),
+            ttft_ms=ttft,
+            total_ms=(time.perf_counter() - started) * 1000
+        )
+
+    async def generate(self, base_url, model, prompt, temperature=0.3, max_tokens=1500, timeout=120):
+        payload = {
+            "model": model,
+            "prompt": prompt,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "stream": False
+        }
+        async with backend_http.client(base_url, self.name) as client:
+            response = await client.post("/v1/completions", json=payload, timeout=timeout)
+            if response.status_code != 200:
+                raise self._http_error(response)
+            choices = response.json().get("choices", [])
+            return choices[0].get("text", "") if choices else None
+
+    async def generate_batch(self, base_url, model, prompts, temperature=0.3, max_tokens=1500, timeout=120):
+        # /v1/completions takes a list of prompts and schedules them as one batch
+        payload = {
+            "model": model,
+            "prompt": prompts,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "stream": False
+        }
+        async with backend_http.client(base_url, self.name) as client:
+            response = await client.post("/v1/completions", json=payload, timeout=timeout)
+            if response.status_code != 200:
+                raise self._http_error(response)
+            texts: List[Optional[str]] = [None] * len(prompts)
+            for choice in response.json().get("choices", []):
+                index = choice.get("index", 0)
+                if 0 <= index < len(prompts):
+                    texts[index] = choice.get("text", "")
+            return texts
+
+    async def list_models(self, base_url, timeout=5):
+        async with backend_http.client(base_url, self.name) as client:
+            response = await client.get("/v1/models", timeout=timeout)
+            if response.status_code != 200:
+                raise self._http_error(response)
+            return [m["id"] for m in response.json().get("data", [])]
+
+    async def ping(self, base_url, timeout=2):
+        async with backend_http.client(base_url, self.name) as client:
+            response = await client.get("/v1/models", timeout=timeout)
+            return response.status_code == 200
+
+
+# Registry of engine adapters, keyed by the backend type backend_for_model returns
+LLM_BACKENDS: Dict[str, LLMBackend] = {}
+
+
+def register_llm_backend(backend: LLMBackend):
+    LLM_BACKENDS[backend.name] = backend
+
+
+def get_llm_backend(name: str) -> LLMBackend:
+    try:
+        return LLM_BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"Unknown LLM backend: {name}")
+
+
+register_llm_backend(OllamaBackend())
+register_llm_backend(VLLMBackend())
+
+# =============================================================================
+# Backend Endpoint Pool (model-aware load balancing across endpoints)
+# =============================================================================
+
+@dataclass
+class BackendEndpoint:
+    backend: str
+    url: str
+    models: set = field(default_factory=set)   # Models the endpoint serves
+    warm: set = field(default_factory=set)     # Models currently loaded in memory
+    failures: int = 0
+    ejected_until: float = 0.0
+    probed: bool = False
+    latency_ms: Optional[float] = None
+    last_seen: Optional[str] = None
+    error: Optional[str] = None
+
+    @property
+    def ejected(self) -> bool:
+        return self.ejected_until > time.monotonic()
+
+
+class BackendPool:
+    """
+    The endpoints behind each backend type (OLLAMA_URLS / VLLM_URLS).
+
+    pick() routes a model to an endpoint that serves it, preferring ones
+    where it is already loaded (no cold start), then the fewest outstanding
+    requests. An endpoint is ejected for BACKEND_EJECT_SECONDS after
+    BACKEND_EJECT_FAILURES consecutive transport failures; a successful
+    probe or request re-admits it. Endpoints are probed by the model
+    catalog refresh.
+    """
+
+    def __init__(self, urls: Dict[str, List[str]], eject_failures: int, eject_seconds: float):
+        self.eject_failures = eject_failures
+        self.eject_seconds = eject_seconds
+        self.endpoints: Dict[str, List[BackendEndpoint]] = {
+            backend: [BackendEndpoint(backend, url) for url in backend_urls]
+            for backend, backend_urls in urls.items()
+        }
+        self._by_url = {ep.url: ep for eps in self.endpoints.values() for ep in eps}
+        self._turn = 0
+
+    def urls(self, backend: str) -> List[str]:
+        return [ep.url for ep in self.endpoints.get(backend, [])]
+
+    def available(self, backend: str, model: Optional[str] = None) -> List[BackendEndpoint]:
+        """Non-ejected endpoints of a backend, narrowed to those known to serve `model`."""
+        live = [ep for ep in self.endpoints.get(backend, []) if not ep.ejected]
+        if model:
+            serving = [ep for ep in live if model in ep.models]
+            if serving:
+                return serving
+        return live
+
+    def serves(self, backend: str, model: str) -> bool:
+        return any(model in ep.models for ep in self.available(backend, model))
+
+    def pick(self, backend: str, model: Optional[str] = None) -> str:
+        endpoints = self.available(backend, model) or self.endpoints.get(backend, [])
+        if not endpoints:
+            raise ValueError(f"No endpoints configured for backend: {backend}")
+        if len(endpoints) == 1:
+            return endpoints[0].url
+        # Warm first, then least outstanding; rotate the starting point so ties spread out
+        self._turn = (self._turn + 1) % len(endpoints)
+        rotated = endpoints[self._turn:] + endpoints[:self._turn]
+        best = min(rotated, key=lambda ep: (model not in ep.warm, backend_http.in_flight(ep.url)))
+        return best.url
+
+    def report_success(self, url: str):
+        endpoint = self._by_url.get(url)
+        if endpoint and (endpoint.failures or endpoint.ejected_until):
+            endpoint.failures = 0
+            endpoint.ejected_until = 0.0
+
+    def report_failure(self, url: str, error: str = None):
+        endpoint = self._by_url.get(url)
+        if endpoint is None:
+            return
+        endpoint.failures += 1
+        endpoint.error = error or endpoint.error
+        if endpoint.failures >= self.eject_failures:
+            endpoint.ejected_until = time.monotonic() + self.eject_seconds
+
+    async def probe(self, endpoint: BackendEndpoint) -> Optional[List[str]]:
+        """Refresh one endpoint's model and warm sets; returns its models, or None if unreachable."""
+        llm = get_llm_backend(endpoint.backend)
+        started = time.perf_counter()
+        try:
+            models = await llm.list_models(endpoint.url)
+            loaded = await llm.loaded_models(endpoint.url)
+        except Exception as e:
+            endpoint.latency_ms = round((time.perf_counter() - started) * 1000, 1)
+            endpoint.error = str(e) or type(e).__name__
+            if not isinstance(e, httpx.TransportError):  # Transport errors are counted by backend_http
+                self.report_failure(endpoint.url)
+            return None
+        endpoint.latency_ms = round((time.perf_counter() - started) * 1000, 1)
+        endpoint.models = set(models)
+        endpoint.warm = set(loaded)
+        endpoint.probed = True
+        endpoint.last_seen = datetime.now().isoformat()
+        endpoint.error = None
+        self.report_success(endpoint.url)
+        return models
+
+    async def refresh(self, backends: List[str]) -> Dict[str, Optional[List[str]]]:
+        """Probe every endpoint of `backends`; per backend, the union of models (None if all failed)."""
+        probes = [(backend, ep) for backend in backends for ep in self.endpoints.get(backend, [])]
+        results = await asyncio.gather(*(self.probe(ep) for _, ep in probes))
+        listed: Dict[str, Optional[List[str]]] = {backend: None for backend in backends}
+        for (backend, _), models in zip(probes, results):
+            if models is not None:
+                listed[backend] = list(dict.fromkeys((listed[backend] or []) + models))
+        return listed
+
+    def stats(self) -> dict:
+        return {
+            backend: [{
+                "url": ep.url,
+                "healthy": not ep.ejected and ep.failures == 0,
+                "ejected": ep.ejected,
+                "failures": ep.failures,
+                "latency_ms": ep.latency_ms,
+                "last_seen": ep.last_seen,
+                "error": ep.error,
+                "models": len(ep.models),
+                "warm": sorted(ep.warm),
+                "in_flight": backend_http.in_flight(ep.url)
+            } for ep in endpoints]
+            for backend, endpoints in self.endpoints.items()
+        }
+
+
+backend_pool = BackendPool(
+    {"ollama": OLLAMA_URLS, "vllm": VLLM_URLS if VLLM_ENABLED else []},
+    eject_failures=BACKEND_EJECT_FAILURES,
+    eject_seconds=BACKEND_EJECT_SECONDS
+)
+
+# =============================================================================
+# Model Catalog (cached model listing with background refresh)
+# =============================================================================
+
+def model_metadata_for(model: str) -> dict:
+    """UI metadata for a model, matching by full name then base name."""
+    # Match by prefix (e.g., "qwen3-coder:30b" or "qwen3-coder")
+    base_name = model.split(":")[0] if ":" in model else model
+    return MODEL_METADATA.get(model) or MODEL_METADATA.get(base_name) or {
+        "name": model,
+        "origin": "🌐",
+        "size": "unknown",
+        "category": "general",
+        "description": "",
+        "tender_stages": [],
+        "tags": []
+    }
+
+
+class ModelCatalog:
+    """
+    Cached list of the models each backend serves.
+
+    A background task refreshes the catalog every `refresh_interval`
+    seconds. Readers get the last snapshot immediately; if it is older
+    than `ttl` a refresh is kicked off in the background (stale-while-
+    revalidate), so a slow backend never blocks /api/models. The
+    /api/models body is precomputed per refresh along with its ETag.
+    """
+
+    def __init__(self, ttl: float, refresh_interval: float):
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.snapshot: Optional[Dict[str, List[str]]] = None
+        self.payload: Optional[dict] = None
+        self.etag: Optional[str] = None
+        self.refreshed_at = 0.0
+        self.backend_status: Dict[str, dict] = {}
+        self._served_by: Dict[str, set] = {}
+        self._listed: Dict[str, List[str]] = {}
+        self._vision: Dict[str, bool] = {}
+        self._lock = asyncio.Lock()
+        self._refreshing: Optional[asyncio.Task] = None
+        self._loop_task: Optional[asyncio.Task] = None
+
+    def _targets(self) -> List[str]:
+        return ["ollama", "vllm"] if VLLM_ENABLED else ["ollama"]
+
+    def _update_status(self, backend: str, models: Optional[List[str]]):
+        endpoints = backend_pool.endpoints.get(backend, [])
+        latencies = [ep.latency_ms for ep in endpoints if ep.latency_ms is not None]
+        status = self.backend_status.setdefault(backend, {"last_seen": None})
+        status.update(
+            urls=[ep.url for ep in endpoints],
+            ok=models is not None,
+            error=None if models is not None else "; ".join(ep.error for ep in endpoints if ep.error) or None,
+            latency_ms=min(latencies) if latencies else None
+        )
+        if models is not None:
+            status.update(last_seen=datetime.now().isoformat(), model_count=len(models))
+
+    async def refresh(self) -> Dict[str, List[str]]:
+        """Probe every backend endpoint concurrently and rebuild the snapshot."""
+        async with self._lock:
+            results = await backend_pool.refresh(self._targets())
+            listed: Dict[str, List[str]] = {}
+            for name, models in results.items():
+                self._update_status(name, models)
+                # Keep serving the last known list for a backend that failed this round
+                listed[name] = models if models is not None else self._listed.get(name, [])
+
+            ollama_models = listed.get("ollama", [])
+            vllm_models = listed.get("vllm", [])
+            served_by: Dict[str, set] = {}
+            for name, models in listed.items():
+                for model in models:
+                    served_by.setdefault(model, set()).add(name)
+            self._served_by = served_by
+            self._vision = {model: match_vision_model(model) for model in served_by}
+            self._listed = listed
+
+            self.snapshot = {
+                "ollama": ollama_models or [DEFAULT_MODEL],
+                "vllm": vllm_models,
+                "all": list(dict.fromkeys(ollama_models + vllm_models)) or [DEFAULT_MODEL]
+            }
+            self.payload = self._build_payload(self.snapshot)
+            self.etag = '"' + hashlib.sha1(json.dumps(self.payload, sort_keys=True).encode()).hexdigest() + '"'
+            self.refreshed_at = time.monotonic()
+            return self.snapshot
+
+    def _build_payload(self, snapshot: dict) -> dict:
+        models = snapshot["all"]
+        models_with_meta = [{
+            "id": model,
+            "backend": backend_for_model(model),
+            **model_metadata_for(model)
+        } for model in models]
+        return {
+            "models": models,
+            "models_meta": models_with_meta,
+            "default": DEFAULT_MODEL,
+            "vision_models": VISION_MODELS,
+            "translation_models": TRANSLATION_MODELS,
+            "model_metadata": MODEL_METADATA,
+            "backends": {
+                "ollama": {"url": OLLAMA_URL, "urls": OLLAMA_URLS, "models": snapshot["ollama"]},
+                "vllm": {"url": VLLM_URL, "urls": VLLM_URLS, "enabled": VLLM_ENABLED, "models": snapshot["vllm"]}
+            }
+        }
 
-def get_backend_for_model(model_name: str) -> tuple:
-    """
-    Returns (backend_type, base_url) for routing requests.
-    Vision models always go to Ollama, text models go to vLLM when enabled.
-    """
-    if is_vision_model(model_name) or not VLLM_ENABLED:
-        return ("ollama", OLLAMA_URL)
-    return ("vllm", VLLM_URL)
+    def _revalidate(self):
+        if self._refreshing is None or self._refreshing.done():
+            self._refreshing = asyncio.create_task(self.refresh())
 
-# =============================================================================
-# vLLM Client Functions (OpenAI-compatible API)
-# =============================================================================
+    async def get(self, force: bool = False) -> Dict[str, List[str]]:
+        """Current snapshot; waits only if there is none yet (or force=True)."""
+        if self.snapshot is None or force:
+            return await self.refresh()
+        if time.monotonic() - self.refreshed_at > self.ttl:
+            self._revalidate()
+        return self.snapshot
 
-async def vllm_list_models() -> List[str]:
-    """Get available models from vLLM server."""
-    try:
-        async with httpx.AsyncClient(timeout=5) as client:
-            response = await client.get(f"{VLLM_URL}/v1/models")
-            if response.status_code == 200:
-                data = response.json()
-                return [m["id"] for m in data.get("data", [])]
-    except Exception:
-        pass
-    return []
+    def backends_for(self, model_name: str) -> set:
+        """Backend types that listed this model on the last refresh (empty if unknown)."""
+        return self._served_by.get(model_name, set())
 
-async def vllm_chat_stream(
-    model: str,
-    messages: List[Dict],
-    system_prompt: Optional[str] = None
-):
-    """
-    Stream chat completion from vLLM using OpenAI-compatible format.
-    Yields (content_delta, is_done, usage_dict) tuples.
-    """
-    payload = {
-        "model": model,
-        "messages": messages,
-        "stream": True
-    }
-    if system_prompt:
-        # Insert system message at the beginning
-        payload["messages"] = [{"role": "system", "content": system_prompt}] + messages
+    def vision_flag(self, model_name: str) -> Optional[bool]:
+        """Whether a catalogued model is a vision model (None if not catalogued)."""
+        return self._vision.get(model_name)
 
-    async with httpx.AsyncClient(timeout=600) as client:
-        async with client.stream("POST", f"{VLLM_URL}/v1/chat/completions", json=payload) as response:
-            if response.status_code != 200:
-                raise Exception(f"vLLM HTTP {response.status_code}")
-
-            async for line in response.aiter_lines():
-                if not line or not line.startswith("data: "):
-                    continue
-                data = line[6:]  # Remove "data: " prefix
-                if data == "[DONE]":
-                    yield ("", True, None)
-                    return
+    async def _run(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f"Model catalog refresh error: {e}")
+            await asyncio.sleep(self.refresh_interval)
+
+    def start(self):
+        if self._loop_task is None:
+            self._loop_task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        for task in (self._loop_task, self._refreshing):
+            if task and not task.done():
+                task.cancel()
                 try:
-                    chunk = json.loads(data)
-                    choices = chunk.get("choices", [])
-                    if choices:
-                        delta = choices[0].get("delta", {})
-                        content = delta.get("content", "")
-                        finish_reason = choices[0].get("finish_reason")
-                        usage = chunk.get("usage")  # Only present in final chunk
-                        yield (content, finish_reason == "stop", usage)
-                except json.JSONDecodeError:
-                    continue
-
-async def vllm_generate(
-    model: str,
-    prompt: str,
-    temperature: float = 0.3,
-    max_tokens: int = 1500
-) -> Optional[str]:
-    """Non-streaming text generation using vLLM."""
-    payload = {
-        "model": model,
-        "prompt": prompt,
-        "temperature": temperature,
-        "max_tokens": max_tokens,
-        "stream": False
-    }
-    try:
-        async with httpx.AsyncClient(timeout=120) as client:
-            response = await client.post(f"{VLLM_URL}/v1/completions", json=payload)
-            if response.status_code == 200:
-                data = response.json()
-                choices = data.get("choices", [])
-                if choices:
-                    return choices[0].get("text", "")
-    except Exception:
-        pass
-    return None
+                    await task
+                except (asyncio.CancelledError, Exception):
+                    pass
+        self._loop_task = None
+
+    def stats(self) -> dict:
+        return {
+            "age_seconds": round(time.monotonic() - self.refreshed_at, 1) if self.snapshot else None,
+            "etag": self.etag,
+            "backends": self.backend_status
+        }
+
+
+model_catalog = ModelCatalog(ttl=MODEL_CATALOG_TTL_SECONDS, refresh_interval=MODEL_CATALOG_REFRESH_SECONDS)
 
 # =============================================================================
 # FastAPI App
@@ -1484,11 +5130,30 @@ async def vllm_generate(
 async def lifespan(app: FastAPI):
     # Startup
     init_db()
-    # Cleanup expired attachments on startup
+    # Cleanup expired attachments and stale generation journals on startup
     cleanup_expired_attachments()
+    cleanup_stream_journals()
+    # Open shared keep-alive clients for every configured backend endpoint
+    for backend, urls in (("ollama", OLLAMA_URLS), ("vllm", VLLM_URLS if VLLM_ENABLED else [])):
+        for url in urls:
+            backend_http.get(url, backend)
+    # Keep the model list warm in the background
+    model_catalog.start()
+    await response_cache.prune()
+    # Heartbeat running generations and listen for stop signals from other workers
+    generation_manager.start_background()
     yield
-    # Shutdown - final cleanup
+    # Shutdown - final cleanup (running generations save their partial replies first)
+    await generation_manager.shutdown()
+    await session_summarizer.shutdown()
+    await model_catalog.stop()
+    await backend_http.aclose()
     cleanup_expired_attachments()
+    cpu_executor.shutdown(wait=True)
+    io_executor.shutdown(wait=True)
+    zip_executor.shutdown(wait=True)
+    db_executor.shutdown(wait=True)
+    db_pool.close()
 
 app = FastAPI(title="BORAK", lifespan=lifespan)
 
@@ -1509,14 +5174,14 @@ app.add_middleware(
 async def api_register(user: UserCreate):
     if len(user.password) < 6:
         raise HTTPException(status_code=400, detail="Password must be at least 6 characters")
-    success, message = register_user(user.username, user.password)
+    success, message = await adb.register_user(user.username, user.password)
     if not success:
         raise HTTPException(status_code=400, detail=message)
     return {"success": True, "message": message}
 
 @app.post("/api/auth/login")
 async def api_login(user: UserLogin, response: Response):
-    user_id = verify_user(user.username, user.password)
+    user_id = await adb.verify_user(user.username, user.password)
     if not user_id:
         raise HTTPException(status_code=401, detail="Invalid credentials")
     token = create_access_token({"user_id": user_id, "username": user.username})
@@ -1538,7 +5203,7 @@ async def api_logout(response: Response):
 
 @app.get("/api/auth/me")
 async def api_me(user_id: int = Depends(get_current_user)):
-    username = get_username(user_id)
+    username = await adb.get_username(user_id)
     if not username:
         raise HTTPException(status_code=404, detail="User not found")
     return {"user_id": user_id, "username": username}
@@ -1548,42 +5213,13 @@ async def api_me(user_id: int = Depends(get_current_user)):
 # =============================================================================
 
 @app.get("/api/models")
-async def api_models():
-    all_models = await get_all_available_models()
-    models = all_models["all"]
-
-    # Enrich with metadata and backend info
-    models_with_meta = []
-    for model in models:
-        # Match by prefix (e.g., "qwen3-coder:30b" or "qwen3-coder")
-        base_name = model.split(":")[0] if ":" in model else model
-        backend, _ = get_backend_for_model(model)
-        meta = MODEL_METADATA.get(model) or MODEL_METADATA.get(base_name) or {
-            "name": model,
-            "origin": "🌐",
-            "size": "unknown",
-            "category": "general",
-            "description": "",
-            "tender_stages": [],
-            "tags": []
-        }
-        models_with_meta.append({
-            "id": model,
-            "backend": backend,
-            **meta
-        })
-    return {
-        "models": models,
-        "models_meta": models_with_meta,
-        "default": DEFAULT_MODEL,
-        "vision_models": VISION_MODELS,
-        "translation_models": TRANSLATION_MODELS,
-        "model_metadata": MODEL_METADATA,
-        "backends": {
-            "ollama": {"url": OLLAMA_URL, "models": all_models["ollama"]},
-            "vllm": {"url": VLLM_URL, "enabled": VLLM_ENABLED, "models": all_models["vllm"]}
-        }
-    }
+async def api_models(request: Request, refresh: bool = False):
+    """List models with metadata. Served from the model catalog; supports If-None-Match."""
+    await model_catalog.get(force=refresh)
+    headers = {"ETag": model_catalog.etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == model_catalog.etag:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(model_catalog.payload, headers=headers)
 
 # =============================================================================
 # Session Routes
@@ -1592,7 +5228,7 @@ async def api_models():
 @app.post("/api/sessions")
 async def api_create_session(session: SessionCreate, user_id: int = Depends(get_current_user)):
     """Create a new chat session."""
-    session_id = create_session(user_id, session.name)
+    session_id = await adb.create_session(user_id, session.name)
     return {"success": True, "session_id": session_id}
 
 
@@ -1600,22 +5236,51 @@ async def api_create_session(session: SessionCreate, user_id: int = Depends(get_
 async def api_list_sessions(
     limit: int = 20,
     offset: int = 0,
+    cursor: Optional[str] = None,
     user_id: int = Depends(get_current_user)
 ):
-    """List user's chat sessions with previews."""
-    sessions, has_more = get_sessions(user_id, limit, offset)
-    return {"sessions": sessions, "has_more": has_more}
+    """List user's chat sessions with previews (keyset paginated via `cursor`)."""
+    limit = max(1, min(limit, 100))
+    before = None
+    if cursor:
+        try:
+            data = decode_cursor(cursor)
+            before = (str(data["updated_at"]), int(data["id"]))
+        except (ValueError, KeyError, TypeError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        offset = 0
+
+    sessions, has_more = await adb.get_sessions(user_id, limit, offset, before)
+    next_cursor = None
+    if has_more and sessions:
+        last = sessions[-1]
+        next_cursor = encode_cursor({"updated_at": last["updated_at"], "id": last["id"]})
+    return {"sessions": sessions, "has_more": has_more, "next_cursor": next_cursor}
 
 
 @app.get("/api/sessions/{session_id}")
 async def api_get_session(session_id: int, user_id: int = Depends(get_current_user)):
     """Get a specific session."""
-    session = get_session(user_id, session_id)
+    session = await adb.get_session(user_id, session_id)
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     return session
 
 
+@app.get("/api/sessions/{session_id}/prompt-stats")
+async def api_session_prompt_stats(session_id: int, user_id: int = Depends(get_current_user)):
+    """Prefix (KV) cache reuse and time-to-first-token for a session's recent replies."""
+    if not await adb.get_session(user_id, session_id):
+        raise HTTPException(status_code=404, detail="Session not found")
+    return {
+        "session_id": session_id,
+        "mode": PROMPT_ASSEMBLY,
+        "window_start": await adb.get_prompt_window(session_id),
+        "summary": await adb.get_session_summary(session_id),
+        "prefix_cache": prefix_cache_stats.session(session_id)
+    }
+
+
 @app.patch("/api/sessions/{session_id}")
 async def api_update_session(
     session_id: int,
@@ -1623,7 +5288,7 @@ async def api_update_session(
     user_id: int = Depends(get_current_user)
 ):
     """Rename a session."""
-    success = rename_session(user_id, session_id, update.name)
+    success = await adb.rename_session(user_id, session_id, update.name)
     if not success:
         raise HTTPException(status_code=404, detail="Session not found")
     return {"success": True}
@@ -1632,9 +5297,10 @@ async def api_update_session(
 @app.delete("/api/sessions/{session_id}")
 async def api_delete_session(session_id: int, user_id: int = Depends(get_current_user)):
     """Delete a session and all its messages."""
-    success = delete_session(user_id, session_id)
+    success = await adb.delete_session(user_id, session_id)
     if not success:
         raise HTTPException(status_code=404, detail="Session not found")
+    session_summarizer.forget(session_id)
     return {"success": True}
 
 
@@ -1645,10 +5311,38 @@ async def api_delete_session(session_id: int, user_id: int = Depends(get_current
 @app.get("/api/chat/history")
 async def api_chat_history(
     session_id: Optional[int] = None,
+    limit: int = 50,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    cursor: Optional[str] = None,
     user_id: int = Depends(get_current_user)
 ):
-    """Get chat history for a session, including image attachments."""
-    messages = load_chat_history(user_id, limit=50, session_id=session_id, include_attachments=True)
+    """
+    Get chat history for a session, including image attachments.
+
+    Returns the newest page by default. Scroll back with `before_id` (or the
+    returned `next_cursor`), or fetch newer messages with `after_id`.
+    """
+    limit = max(1, min(limit, 200))
+    if cursor:
+        try:
+            data = decode_cursor(cursor)
+            before_id = int(data["before_id"]) if "before_id" in data else None
+            after_id = int(data["after_id"]) if "after_id" in data else None
+        except (ValueError, TypeError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    messages, has_more = await adb.load_chat_history_page(
+        user_id, limit=limit, session_id=session_id, include_attachments=True,
+        before_id=before_id, after_id=after_id
+    )
+
+    next_cursor = None
+    if has_more and messages:
+        if after_id is not None and before_id is None:
+            next_cursor = encode_cursor({"after_id": messages[-1]["id"]})
+        else:
+            next_cursor = encode_cursor({"before_id": messages[0]["id"]})
 
     # Get the last used model for this session (from most recent message)
     last_model = None
@@ -1659,7 +5353,7 @@ async def api_chat_history(
                 last_model = msg["model"]
                 break
 
-    return {"messages": messages, "last_model": last_model}
+    return {"messages": messages, "last_model": last_model, "has_more": has_more, "next_cursor": next_cursor}
 
 
 @app.delete("/api/chat/clear")
@@ -1667,9 +5361,12 @@ async def api_clear_chat(
     session_id: Optional[int] = None,
     user_id: int = Depends(get_current_user)
 ):
-    """Clear chat history for a session."""
-    clear_chat_history(user_id, session_id)
-    clear_generation(user_id)
+    """Clear chat history for a session (all sessions if none is given), with its finished generations."""
+    await adb.clear_chat_history(user_id, session_id)
+    if session_id is not None:
+        session_summarizer.forget(session_id)
+    # Running generations keep their journals, or reattaching clients would lose them mid-reply
+    await run_io(clear_user_generations, user_id, session_id, await generation_manager.running_ids(user_id))
     return {"success": True}
 
 
@@ -1731,341 +5428,414 @@ def extract_code_title(code: str, lang: str) -> str:
     return f"{lang.capitalize()} Code"
 
 
-def extract_artifacts_from_response(content: str) -> List[dict]:
-    """Extract code blocks, thoughts, and explanations from response."""
-    artifacts = []
-
-    # Extract code blocks
-    code_pattern = r'```(\w+)?\n([\s\S]*?)```'
-    for match in re.finditer(code_pattern, content):
-        lang = match.group(1) or 'text'
-        code = match.group(2).strip()
-        if code:
-            title = extract_code_title(code, lang)
-            artifacts.append({
-                "type": "code",
-                "language": lang,
-                "title": title,
-                "content": code
-            })
+class ArtifactTokenizer:
+    """
+    Incremental artifact extraction for a streamed reply.
+
+    feed() takes each delta and returns the artifact_started /
+    artifact_completed events it produced; finish() closes what is still
+    open at the end. Text is consumed once, a line at a time, by three
+    independent state machines (fenced code blocks, <think> spans and "##"
+    sections), matching what the former regex passes found. Completed
+    artifacts collect in .artifacts, ready to persist without rescanning.
+    """
 
-    # Extract thinking blocks
-    think_pattern = r'<think>([\s\S]*?)</think>'
-    for match in re.finditer(think_pattern, content):
-        thought = match.group(1).strip()
-        if thought:
-            artifacts.append({
-                "type": "thought",
-                "language": None,
-                "title": "Reasoning",
-                "content": thought
-            })
+    def __init__(self):
+        self.artifacts: List[dict] = []
+        self._partial = ""
+        self._count = 0
+        self._events: List[dict] = []
+        self._code: Optional[dict] = None
+        self._think: Optional[dict] = None
+        self._section: Optional[dict] = None
+
+    def feed(self, text: str) -> List[dict]:
+        self._partial += text
+        if "\n" in text:
+            *lines, self._partial = self._partial.split("\n")
+            for line in lines:
+                self._line(line, complete=True)
+        return self._take_events()
+
+    def finish(self) -> List[dict]:
+        """End of reply: close the last section; unterminated code/think spans are dropped."""
+        if self._partial:
+            self._line(self._partial, complete=False)
+            self._partial = ""
+        self._close(self._section, "document")
+        self._section = None
+        for span in (self._code, self._think):
+            if span:
+                self._events.append({"type": "artifact_completed", "index": span["index"], "discarded": True})
+        self._code = self._think = None
+        return self._take_events()
+
+    def _take_events(self) -> List[dict]:
+        events, self._events = self._events, []
+        return events
+
+    def _open(self, artifact_type: str, language: Optional[str] = None, title: Optional[str] = None) -> dict:
+        span = {"index": self._count, "type": artifact_type, "language": language, "title": title, "parts": []}
+        self._count += 1
+        self._events.append({
+            "type": "artifact_started", "index": span["index"],
+            "artifact_type": artifact_type, "language": language, "title": title
+        })
+        return span
 
-    # Extract markdown sections as documents (headers with 50+ char content)
-    section_pattern = r'^##\s+(.+?)\n([\s\S]*?)(?=^##|\Z)'
-    for match in re.finditer(section_pattern, content, re.MULTILINE):
-        title = match.group(1).strip()
-        body = match.group(2).strip()
-        # Only include substantial sections
-        if len(body) >= 50 and not body.startswith('```'):
-            artifacts.append({
-                "type": "document",
-                "language": None,
-                "title": title,
-                "content": body
-            })
+    def _close(self, span: Optional[dict], artifact_type: str):
+        if span is None:
+            return
+        content = "".join(span["parts"]).strip()
+        if artifact_type == "code":
+            keep = bool(content)
+            title = extract_code_title(content, span["language"]) if keep else None
+        elif artifact_type == "thought":
+            keep, title = bool(content), "Reasoning"
+        else:
+            # Only substantial prose sections
+            keep, title = len(content) >= 50 and not content.startswith("```"), span["title"]
+        if not keep:
+            self._events.append({"type": "artifact_completed", "index": span["index"], "discarded": True})
+            return
+        self.artifacts.append({"type": artifact_type, "language": span["language"], "title": title, "content": content})
+        self._events.append({
+            "type": "artifact_completed", "index": span["index"], "artifact_type": artifact_type,
+            "language": span["language"], "title": title, "size": len(content)
+        })
 
-    return artifacts
+    def _line(self, line: str, complete: bool):
+        newline = "\n" if complete else ""
+
+        # Sections: a line starting with "##" ends the open section; "## Title" starts the next
+        if line.startswith("##"):
+            self._close(self._section, "document")
+            self._section = None
+            title = line[2:].strip()
+            if complete and line[2:3].isspace() and title:
+                self._section = self._open("document", title=title)
+        elif self._section is not None:
+            self._section["parts"].append(line + newline)
+
+        # Code fences: "```lang" at the end of a line opens, the next "```" anywhere closes
+        pos = 0
+        while True:
+            if self._code is None:
+                start = line.find("```", pos)
+                while start >= 0 and not (complete and all(c.isalnum() or c == "_" for c in line[start + 3:])):
+                    start = line.find("```", start + 1)
+                if start < 0:
+                    break
+                self._code = self._open("code", language=line[start + 3:] or "text")
+                break
+            end = line.find("```", pos)
+            if end < 0:
+                self._code["parts"].append(line[pos:] + newline)
+                break
+            self._code["parts"].append(line[pos:end])
+            self._close(self._code, "code")
+            self._code = None
+            pos = end + 3
+
+        # Reasoning spans: <think> ... </think>, possibly across lines
+        pos = 0
+        while True:
+            if self._think is None:
+                start = line.find("<think>", pos)
+                if start < 0:
+                    break
+                self._think = self._open("thought")
+                pos = start + len("<think>")
+                continue
+            end = line.find("</think>", pos)
+            if end < 0:
+                self._think["parts"].append(line[pos:] + newline)
+                break
+            self._think["parts"].append(line[pos:end])
+            self._close(self._think, "thought")
+            self._think = None
+            pos = end + len("</think>")
 
 
 @app.post("/api/chat/send")
-async def api_chat_send(chat: ChatRequest, user_id: int = Depends(get_current_user)):
+async def api_chat_send(chat: ChatRequest, request: Request, user_id: int = Depends(get_current_user)):
     """Send a message and get a streaming response via SSE."""
+    # Refuse before saving anything if the user is at their generation limit
+    try:
+        await generation_manager.check_capacity(user_id, chat.session_id)
+    except GenerationRejected as e:
+        raise e.to_http()
+
+    # Images uploaded beforehand must be the user's and not yet on a message
+    uploaded = []
+    for att_id in chat.attachment_ids or []:
+        attachment = await adb.get_attachment(att_id, user_id)
+        if not attachment or attachment["message_id"] is not None:
+            raise HTTPException(status_code=404, detail=f"Attachment {att_id} not found or expired")
+        uploaded.append(attachment)
+
     # Get or create session
     session_id = chat.session_id
     if not session_id:
-        session_id = create_session(user_id)
+        session_id = await adb.create_session(user_id)
 
     # Save images first (time-bound storage)
-    attachment_ids = []
+    attachment_ids = [attachment["id"] for attachment in uploaded]
     if chat.images:
         for img_base64 in chat.images:
-            attachment = save_attachment(user_id, img_base64)
+            attachment = await adb.save_attachment(user_id, img_base64)
             if attachment:
                 attachment_ids.append(attachment["id"])
 
-    # Save user message
-    msg_id = save_message(user_id, "user", chat.message, chat.model, session_id)
-    chroma_save_message(user_id, "user", chat.message, chat.model)
-
-    # Link attachments to the message
-    for att_id in attachment_ids:
-        link_attachment_to_message(att_id, msg_id)
-
-    # Get chat history for context
-    history = load_chat_history(user_id, limit=20, session_id=session_id)
+    # Save the user message with its attachments (one transaction: an attachment can only be sent once)
+    try:
+        await adb.save_message(user_id, "user", chat.message, chat.model, session_id, attachment_ids=attachment_ids)
+    except AttachmentRejected as e:
+        raise e.to_http()
+    await adb.chroma_save_message(user_id, "user", chat.message, chat.model)
 
-    # Build messages for Ollama (only role and content)
-    messages = [{"role": m["role"], "content": m["content"]} for m in history]
+    # Pack as much recent history as fits the model's context budget
+    plan, system_prompt = await build_chat_prompt(user_id, session_id, chat.model)
+    messages = plan.messages
 
     # If vision model with images, add to last message
-    if chat.images and is_vision_model(chat.model):
-        messages[-1]["images"] = chat.images
-
-    # Track this generation for stop functionality
-    gen_key = f"{user_id}_{session_id}"
-    cancel_event = asyncio.Event()
-    active_generations[gen_key] = {
-        "cancel": cancel_event,
-        "content": "",
-        "msg_id": None
-    }
+    if (chat.images or uploaded) and is_vision_model(chat.model):
+        images = list(chat.images or [])
+        for attachment in uploaded:
+            images.append(await run_io(read_attachment_base64, attachment))
+        messages[-1]["images"] = images
 
     # Determine which backend to use
     backend, backend_url = get_backend_for_model(chat.model)
+    cached = await response_cache.lookup(user_id, chat.model, system_prompt, messages) if chat.use_cache else None
 
-    async def generate_stream():
-        full_response = ""
-        prompt_tokens = 0
-        completion_tokens = 0
-        msg_id = None
+    # The upstream request runs as its own task; this response is just its first subscriber
+    try:
+        generation = await generation_manager.start(GenerationRequest(
+            user_id=user_id, session_id=session_id, model=chat.model,
+            backend=backend, base_url=backend_url, messages=messages,
+            system_prompt=system_prompt, prompt_stats=plan.stats(), cached=cached
+        ))
+    except GenerationRejected as e:
+        raise e.to_http()
+    return event_stream_response(generation.subscribe(), request.headers.get("accept"))
 
-        # First event: session and backend info
-        yield f"data: {json.dumps({'type': 'session', 'session_id': session_id, 'backend': backend})}\n\n"
 
-        try:
-            system_prompt = get_system_prompt_for_model(user_id, chat.model)
-
-            if backend == "vllm":
-                # Use vLLM OpenAI-compatible API
-                async for content, is_done, usage in vllm_chat_stream(chat.model, messages, system_prompt):
-                    if cancel_event.is_set():
-                        if full_response:
-                            msg_id = save_message(
-                                user_id, "assistant", full_response, chat.model,
-                                session_id, is_partial=True
-                            )
-                            active_generations[gen_key]["msg_id"] = msg_id
-                        yield f"data: {json.dumps({'type': 'stopped', 'partial': True})}\n\n"
-                        return
+@app.post("/api/chat/stop")
+async def api_chat_stop(stop: StopRequest, user_id: int = Depends(get_current_user)):
+    """Stop an active generation (by generation id, or the one running in a session)."""
+    if not stop.generation_id and stop.session_id is None:
+        raise HTTPException(status_code=400, detail="session_id or generation_id is required")
+    stopped = await generation_manager.stop(user_id, stop.generation_id, stop.session_id)
+    if stopped:
+        return {"success": True, **stopped}
+    return {"success": False, "error": "No active generation"}
 
-                    if content:
-                        full_response += content
-                        active_generations[gen_key]["content"] = full_response
-                        yield f"data: {json.dumps({'type': 'content', 'content': content})}\n\n"
 
-                    if is_done and usage:
-                        prompt_tokens = usage.get("prompt_tokens", 0)
-                        completion_tokens = usage.get("completion_tokens", 0)
-            else:
-                # Use Ollama API
-                payload = {"model": chat.model, "messages": messages, "stream": True}
-                if system_prompt:
-                    payload["system"] = system_prompt
-
-                async with httpx.AsyncClient(timeout=600) as client:
-                    async with client.stream("POST", f"{backend_url}/api/chat", json=payload) as response:
-                        if response.status_code == 200:
-                            async for line in response.aiter_lines():
-                                if cancel_event.is_set():
-                                    if full_response:
-                                        msg_id = save_message(
-                                            user_id, "assistant", full_response, chat.model,
-                                            session_id, is_partial=True
-                                        )
-                                        active_generations[gen_key]["msg_id"] = msg_id
-                                    yield f"data: {json.dumps({'type': 'stopped', 'partial': True})}\n\n"
-                                    return
-
-                                if line:
-                                    chunk = json.loads(line)
-                                    content = chunk.get("message", {}).get("content", "")
-                                    if content:
-                                        full_response += content
-                                        active_generations[gen_key]["content"] = full_response
-                                        yield f"data: {json.dumps({'type': 'content', 'content': content})}\n\n"
-                                    if chunk.get("done"):
-                                        prompt_tokens = chunk.get("prompt_eval_count", 0)
-                                        completion_tokens = chunk.get("eval_count", 0)
-                        else:
-                            yield f"data: {json.dumps({'type': 'error', 'error': f'HTTP {response.status_code}'})}\n\n"
-                            return
-        except asyncio.CancelledError:
-            # Save partial on cancellation
-            if full_response:
-                save_message(user_id, "assistant", full_response, chat.model, session_id, is_partial=True)
-            yield f"data: {json.dumps({'type': 'stopped', 'partial': True})}\n\n"
-            return
-        except Exception as e:
-            yield f"data: {json.dumps({'type': 'error', 'error': str(e)})}\n\n"
-            return
-        finally:
-            # Clean up tracking
-            if gen_key in active_generations:
-                del active_generations[gen_key]
-
-        # Save complete assistant response
-        if full_response:
-            msg_id = save_message(user_id, "assistant", full_response, chat.model, session_id)
-            chroma_save_message(user_id, "assistant", full_response, chat.model)
-            log_usage(user_id, chat.model, prompt_tokens, completion_tokens)
-
-            # Extract and save artifacts
-            artifacts = extract_artifacts_from_response(full_response)
-            artifact_counts = {"code": 0, "thought": 0, "document": 0}
-            for artifact in artifacts:
-                save_artifact(
-                    session_id, user_id, artifact["type"],
-                    artifact["content"], artifact["language"], artifact["title"]
-                )
-                artifact_counts[artifact["type"]] += 1
+@app.post("/api/chat/continue")
+async def api_chat_continue(cont: ContinueRequest, request: Request, user_id: int = Depends(get_current_user)):
+    """Continue from a partial response via SSE."""
+    try:
+        generation = await generation_manager.continue_session(user_id, cont.session_id, cont.model)
+    except GenerationRejected as e:
+        raise e.to_http()
+    return event_stream_response(generation.subscribe(), request.headers.get("accept"))
 
-            yield f"data: {json.dumps({'type': 'done', 'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens}, 'artifacts': artifact_counts})}\n\n"
-        else:
-            yield f"data: {json.dumps({'type': 'done', 'usage': {'prompt_tokens': 0, 'completion_tokens': 0}})}\n\n"
 
-    return StreamingResponse(
-        generate_stream(),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no"
-        }
-    )
+# =============================================================================
+# Artifact Export (streaming ZIP)
+# =============================================================================
+
+SESSION_ZIP_EXTENSIONS = {
+    "python": "py", "javascript": "js", "typescript": "ts",
+    "html": "html", "css": "css", "json": "json", "yaml": "yaml",
+    "java": "java", "cpp": "cpp", "c": "c", "go": "go", "rust": "rs"
+}
+USER_ZIP_EXTENSIONS = {
+    "python": "py", "javascript": "js", "typescript": "ts",
+    "markdown": "md", "yaml": "yml", "thought": "md", "document": "md"
+}
+ZIP_COMPRESSION = {"deflate": zipfile.ZIP_DEFLATED, "store": zipfile.ZIP_STORED}
+ZIP_WRITE_CHUNK_BYTES = 64 * 1024
 
+# Lengths of compressed archives already produced in full, by ETag, so a
+# later Range request for the same archive can be answered
+archive_lengths = TTLCache(1000, ARTIFACT_ZIP_LENGTH_TTL_SECONDS)
 
-@app.post("/api/chat/stop")
-async def api_chat_stop(stop: StopRequest, user_id: int = Depends(get_current_user)):
-    """Stop an active generation."""
-    gen_key = f"{user_id}_{stop.session_id}"
-    if gen_key in active_generations:
-        active_generations[gen_key]["cancel"].set()
-        return {
-            "success": True,
-            "partial_content": active_generations[gen_key].get("content", "")
-        }
-    return {"success": False, "error": "No active generation"}
 
+class ZipStreamSink(io.RawIOBase):
+    """Write-only, unseekable target for zipfile; output collects until drained."""
 
-@app.post("/api/chat/continue")
-async def api_chat_continue(cont: ContinueRequest, user_id: int = Depends(get_current_user)):
-    """Continue from a partial response via SSE."""
-    session_id = cont.session_id
-
-    # Get the last message (should be partial assistant message)
-    history = load_chat_history(user_id, limit=50, session_id=session_id)
-    if not history:
-        raise HTTPException(status_code=400, detail="No messages to continue from")
-
-    last_msg = history[-1]
-    if last_msg["role"] != "assistant" or not last_msg.get("is_partial"):
-        raise HTTPException(status_code=400, detail="Last message is not a partial response")
-
-    # Build messages with the partial response as context
-    messages = [{"role": m["role"], "content": m["content"]} for m in history]
-    # Add a continue prompt
-    messages.append({"role": "user", "content": "Continue from where you left off."})
-
-    # Track this generation
-    gen_key = f"{user_id}_{session_id}"
-    cancel_event = asyncio.Event()
-    active_generations[gen_key] = {
-        "cancel": cancel_event,
-        "content": last_msg["content"],
-        "msg_id": last_msg["id"]
-    }
+    def __init__(self):
+        super().__init__()
+        self._chunks: List[bytes] = []
 
-    # Determine backend
-    backend, backend_url = get_backend_for_model(cont.model)
+    def writable(self) -> bool:
+        return True
 
-    async def generate_stream():
-        full_response = last_msg["content"]  # Start from partial
-        prompt_tokens = 0
-        completion_tokens = 0
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
 
-        try:
-            system_prompt = get_system_prompt_for_model(user_id, cont.model)
-
-            if backend == "vllm":
-                # Use vLLM OpenAI-compatible API
-                async for content, is_done, usage in vllm_chat_stream(cont.model, messages, system_prompt):
-                    if cancel_event.is_set():
-                        update_message(last_msg["id"], full_response, is_partial=True)
-                        yield f"data: {json.dumps({'type': 'stopped', 'partial': True})}\n\n"
-                        return
+    def drain(self) -> bytes:
+        data, self._chunks = b"".join(self._chunks), []
+        return data
 
-                    if content:
-                        full_response += content
-                        active_generations[gen_key]["content"] = full_response
-                        yield f"data: {json.dumps({'type': 'content', 'content': content})}\n\n"
 
-                    if is_done and usage:
-                        prompt_tokens = usage.get("prompt_tokens", 0)
-                        completion_tokens = usage.get("completion_tokens", 0)
-            else:
-                # Use Ollama API
-                payload = {"model": cont.model, "messages": messages, "stream": True}
-                if system_prompt:
-                    payload["system"] = system_prompt
-
-                async with httpx.AsyncClient(timeout=600) as client:
-                    async with client.stream("POST", f"{backend_url}/api/chat", json=payload) as response:
-                        if response.status_code == 200:
-                            async for line in response.aiter_lines():
-                                if cancel_event.is_set():
-                                    update_message(last_msg["id"], full_response, is_partial=True)
-                                    yield f"data: {json.dumps({'type': 'stopped', 'partial': True})}\n\n"
-                                    return
-
-                                if line:
-                                    chunk = json.loads(line)
-                                    content = chunk.get("message", {}).get("content", "")
-                                    if content:
-                                        full_response += content
-                                        active_generations[gen_key]["content"] = full_response
-                                        yield f"data: {json.dumps({'type': 'content', 'content': content})}\n\n"
-                                    if chunk.get("done"):
-                                        prompt_tokens = chunk.get("prompt_eval_count", 0)
-                                        completion_tokens = chunk.get("eval_count", 0)
-                        else:
-                            yield f"data: {json.dumps({'type': 'error', 'error': f'HTTP {response.status_code}'})}\n\n"
-                            return
-        except Exception as e:
-            yield f"data: {json.dumps({'type': 'error', 'error': str(e)})}\n\n"
-            return
-        finally:
-            if gen_key in active_generations:
-                del active_generations[gen_key]
-
-        # Update message to complete (not partial)
-        if full_response:
-            update_message(last_msg["id"], full_response, is_partial=False)
-            log_usage(user_id, cont.model, prompt_tokens, completion_tokens)
-
-            # Extract and save new artifacts
-            artifacts = extract_artifacts_from_response(full_response)
-            artifact_counts = {"code": 0, "thought": 0, "document": 0}
-            for artifact in artifacts:
-                save_artifact(
-                    session_id, user_id, artifact["type"],
-                    artifact["content"], artifact["language"], artifact["title"]
-                )
-                artifact_counts[artifact["type"]] += 1
+class ArtifactZipStream:
+    """
+    A ZIP of artifacts, produced while it is sent.
+
+    The manifest (names, sizes, hashes, no content) is read up front; the
+    content then follows ARTIFACT_ZIP_BATCH_SIZE artifacts at a time, and
+    each batch is compressed on the ZIP pool into an unseekable sink
+    (zipfile then writes data descriptors instead of seeking back), so
+    memory stays at one batch. Entry timestamps come from the artifacts,
+    making the bytes a function of the manifest alone: the ETag names
+    them, and a Range request is served by regenerating and skipping. That
+    needs the total length up front, which store mode computes from the
+    manifest and deflate mode knows once the archive has been sent whole.
+    """
 
-            yield f"data: {json.dumps({'type': 'done', 'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens}, 'artifacts': artifact_counts})}\n\n"
+    def __init__(self, user_id: int, manifest: List[dict], extensions: Dict[str, str],
+                 compression: str, user_level: bool):
+        self.user_id = user_id
+        self.user_level = user_level
+        self.compression = ZIP_COMPRESSION[compression]
+        self.entries = self._layout(manifest, extensions)
+        digest = hashlib.sha1(json.dumps([compression, self.entries], sort_keys=True).encode()).hexdigest()
+        self.etag = f'"{digest}"'
+        if self.compression == zipfile.ZIP_STORED:
+            self.length = self._stored_length()
         else:
-            yield f"data: {json.dumps({'type': 'done', 'usage': {'prompt_tokens': 0, 'completion_tokens': 0}})}\n\n"
+            self.length = archive_lengths.get(self.etag)
+
+    @staticmethod
+    def _layout(manifest: List[dict], extensions: Dict[str, str]) -> List[dict]:
+        """Entry names as before: <type>s/<n>_<title>.<ext>, numbered per type."""
+        counts: Dict[str, int] = {}
+        entries = []
+        for row in manifest:
+            artifact_type = "document" if row["type"] == "explanation" else row["type"]
+            if artifact_type not in ("code", "thought", "document"):
+                continue
+            folder = artifact_type + "s"  # code -> codes, thought -> thoughts, document -> documents
+            counts[folder] = counts.get(folder, 0) + 1
+            ext = row["language"] or "txt"
+            ext = extensions.get(ext, ext)
+            title = (row["title"] or "artifact")[:30].replace(" ", "_")
+            entries.append({
+                "id": row["id"],
+                "name": f"{folder}/{counts[folder]}_{title}.{ext}",
+                "size": row["size"] or 0,
+                "hash": row["content_hash"],
+                "created_at": row["created_at"]
+            })
+        return entries
+
+    def _stored_length(self) -> Optional[int]:
+        total = 22  # End of central directory
+        for entry in self.entries:
+            name = len(entry["name"].encode("utf-8"))
+            # Local header + data + data descriptor, then its central directory record
+            total += 30 + name + entry["size"] + 16 + 46 + name
+        if total * 1.05 > zipfile.ZIP64_LIMIT or len(self.entries) > zipfile.ZIP_FILECOUNT_LIMIT:
+            return None  # Zip64 records; not worth predicting
+        return total
+
+    @staticmethod
+    def _date_time(created_at: str) -> tuple:
+        try:
+            stamp = datetime.fromisoformat(created_at)
+        except (TypeError, ValueError):
+            return (1980, 1, 1, 0, 0, 0)
+        return max(stamp.timetuple()[:6], (1980, 1, 1, 0, 0, 0))
+
+    def _write(self, zf: zipfile.ZipFile, sink: ZipStreamSink, batch: List[dict], contents: Dict[int, str]) -> bytes:
+        for entry in batch:
+            if entry["id"] not in contents:
+                raise RuntimeError(f"Artifact {entry['id']} was deleted during export")
+            data = contents[entry["id"]].encode("utf-8")
+            info = zipfile.ZipInfo(entry["name"], self._date_time(entry["created_at"]))
+            info.compress_type = self.compression
+            info.file_size = len(data)
+            info.external_attr = 0o644 << 16
+            with zf.open(info, "w") as dest:
+                for offset in range(0, len(data), ZIP_WRITE_CHUNK_BYTES):
+                    dest.write(data[offset:offset + ZIP_WRITE_CHUNK_BYTES])
+        return sink.drain()
+
+    @staticmethod
+    def _close(zf: zipfile.ZipFile, sink: ZipStreamSink) -> bytes:
+        zf.close()
+        return sink.drain()
+
+    async def _produce(self):
+        sink = ZipStreamSink()
+        zf = zipfile.ZipFile(sink, "w", self.compression)
+        for start in range(0, len(self.entries), ARTIFACT_ZIP_BATCH_SIZE):
+            batch = self.entries[start:start + ARTIFACT_ZIP_BATCH_SIZE]
+            contents = await adb.get_artifact_contents([e["id"] for e in batch], self.user_id, self.user_level)
+            yield await run_zip(self._write, zf, sink, batch, contents)
+        yield await run_zip(self._close, zf, sink)
+
+    async def chunks(self, start: int = 0, end: Optional[int] = None):
+        """Yield bytes start..end of the archive (end inclusive; None for all of it)."""
+        position = 0
+        async with aclosing(self._produce()) as produced:
+            async for data in produced:
+                begin, position = position, position + len(data)
+                if position > start and data:
+                    stop = None if end is None else end + 1 - begin
+                    yield data[max(start - begin, 0):stop]
+                if end is not None and position > end:
+                    return
+        if start == 0 and end is None and self.compression != zipfile.ZIP_STORED:
+            archive_lengths.set(self.etag, position)
 
-    return StreamingResponse(
-        generate_stream(),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no"
-        }
-    )
+
+def parse_byte_range(header: Optional[str], length: int) -> Optional[tuple]:
+    """
+    (start, end) for a single "bytes=" Range, clamped to `length`. None if
+    there is no usable range (serve the whole body); ValueError if the
+    range cannot be satisfied.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[len("bytes="):].strip().partition("-")
+    try:
+        if not first:
+            start, end = max(length - int(last), 0), length - 1  # Suffix: the last N bytes
+        else:
+            start, end = int(first), min(int(last), length - 1) if last else length - 1
+    except ValueError:
+        return None
+    if start >= length or start > end:
+        raise ValueError(f"Unsatisfiable range: {header}")
+    return start, end
+
+
+def artifact_zip_response(archive: ArtifactZipStream, request: Request, filename: str) -> StreamingResponse:
+    """Stream `archive`, honouring Range/If-Range when its length is known."""
+    headers = {"Content-Disposition": f"attachment; filename={filename}", "ETag": archive.etag}
+    if archive.length is None:
+        headers["Accept-Ranges"] = "none"
+        return StreamingResponse(archive.chunks(), media_type="application/zip", headers=headers)
+
+    headers["Accept-Ranges"] = "bytes"
+    span = None
+    if request.headers.get("if-range", archive.etag) == archive.etag:
+        try:
+            span = parse_byte_range(request.headers.get("range"), archive.length)
+        except ValueError:
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{archive.length}"})
+    if span is None:
+        headers["Content-Length"] = str(archive.length)
+        return StreamingResponse(archive.chunks(), media_type="application/zip", headers=headers)
+    start, end = span
+    headers["Content-Range"] = f"bytes {start}-{end}/{archive.length}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(archive.chunks(start, end), status_code=206, media_type="application/zip", headers=headers)
 
 
 # =============================================================================
@@ -2075,46 +5845,32 @@ async def api_chat_continue(cont: ContinueRequest, user_id: int = Depends(get_cu
 @app.get("/api/sessions/{session_id}/artifacts")
 async def api_get_artifacts(session_id: int, user_id: int = Depends(get_current_user)):
     """Get artifacts for a session, grouped by type."""
-    artifacts = get_artifacts(session_id, user_id)
+    artifacts = await adb.get_artifacts(session_id, user_id)
     return artifacts
 
 
 @app.get("/api/artifacts/{artifact_id}")
 async def api_get_artifact(artifact_id: int, user_id: int = Depends(get_current_user)):
     """Get a single artifact."""
-    artifact = get_artifact(artifact_id, user_id)
+    artifact = await adb.get_artifact(artifact_id, user_id)
     if not artifact:
         raise HTTPException(status_code=404, detail="Artifact not found")
     return artifact
 
 
 @app.get("/api/sessions/{session_id}/artifacts/download")
-async def api_download_artifacts(session_id: int, user_id: int = Depends(get_current_user)):
-    """Download all artifacts for a session as a ZIP file."""
-    artifacts = get_artifacts(session_id, user_id)
-
-    # Create ZIP in memory
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
-        for artifact_type, items in artifacts.items():
-            folder = artifact_type + "s"  # code -> codes, thought -> thoughts
-            for i, item in enumerate(items):
-                ext = item.get("language", "txt") or "txt"
-                ext_map = {
-                    "python": "py", "javascript": "js", "typescript": "ts",
-                    "html": "html", "css": "css", "json": "json", "yaml": "yaml",
-                    "java": "java", "cpp": "cpp", "c": "c", "go": "go", "rust": "rs"
-                }
-                ext = ext_map.get(ext, ext)
-                filename = f"{folder}/{i+1}_{item.get('title', 'artifact')[:30].replace(' ', '_')}.{ext}"
-                zf.writestr(filename, item["content"])
-
-    zip_buffer.seek(0)
-    return StreamingResponse(
-        iter([zip_buffer.read()]),
-        media_type="application/zip",
-        headers={"Content-Disposition": f"attachment; filename=session_{session_id}_artifacts.zip"}
-    )
+async def api_download_artifacts(
+    session_id: int,
+    request: Request,
+    compression: str = "deflate",
+    user_id: int = Depends(get_current_user)
+):
+    """Download all artifacts for a session as a ZIP file (compression=store skips compressing)."""
+    if compression not in ZIP_COMPRESSION:
+        raise HTTPException(status_code=400, detail=f"compression must be one of: {', '.join(ZIP_COMPRESSION)}")
+    manifest = await adb.get_artifact_manifest(user_id, session_id)
+    archive = ArtifactZipStream(user_id, manifest, SESSION_ZIP_EXTENSIONS, compression, user_level=False)
+    return artifact_zip_response(archive, request, f"session_{session_id}_artifacts.zip")
 
 
 # =============================================================================
@@ -2127,45 +5883,31 @@ async def api_get_user_artifacts(
     user_id: int = Depends(get_current_user)
 ):
     """Get all persistent artifacts for a user, optionally filtered by type."""
-    artifacts = get_user_artifacts(user_id, artifact_type)
+    artifacts = await adb.get_user_artifacts(user_id, artifact_type)
     return artifacts
 
 
 @app.delete("/api/user/artifacts/{artifact_id}")
 async def api_delete_user_artifact(artifact_id: int, user_id: int = Depends(get_current_user)):
     """Delete a persistent user artifact."""
-    deleted = delete_user_artifact(artifact_id, user_id)
+    deleted = await adb.delete_user_artifact(artifact_id, user_id)
     if not deleted:
         raise HTTPException(status_code=404, detail="Artifact not found")
     return {"success": True}
 
 
 @app.get("/api/user/artifacts/download")
-async def api_download_user_artifacts(user_id: int = Depends(get_current_user)):
-    """Download all user artifacts as a ZIP file."""
-    artifacts = get_user_artifacts(user_id)
-
-    # Create ZIP in memory
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
-        for artifact_type, items in artifacts.items():
-            folder = artifact_type + "s"  # code -> codes, thought -> thoughts, document -> documents
-            for i, item in enumerate(items):
-                ext = item.get("language", "txt") or "txt"
-                ext_map = {
-                    "python": "py", "javascript": "js", "typescript": "ts",
-                    "markdown": "md", "yaml": "yml", "thought": "md", "document": "md"
-                }
-                ext = ext_map.get(ext, ext)
-                filename = f"{folder}/{i+1}_{item.get('title', 'artifact')[:30].replace(' ', '_')}.{ext}"
-                zf.writestr(filename, item["content"])
-
-    zip_buffer.seek(0)
-    return StreamingResponse(
-        iter([zip_buffer.read()]),
-        media_type="application/zip",
-        headers={"Content-Disposition": "attachment; filename=my_artifacts.zip"}
-    )
+async def api_download_user_artifacts(
+    request: Request,
+    compression: str = "deflate",
+    user_id: int = Depends(get_current_user)
+):
+    """Download all user artifacts as a ZIP file (compression=store skips compressing)."""
+    if compression not in ZIP_COMPRESSION:
+        raise HTTPException(status_code=400, detail=f"compression must be one of: {', '.join(ZIP_COMPRESSION)}")
+    manifest = await adb.get_artifact_manifest(user_id)
+    archive = ArtifactZipStream(user_id, manifest, USER_ZIP_EXTENSIONS, compression, user_level=True)
+    return artifact_zip_response(archive, request, "my_artifacts.zip")
 
 
 # =============================================================================
@@ -2175,7 +5917,7 @@ async def api_download_user_artifacts(user_id: int = Depends(get_current_user)):
 @app.get("/api/user/settings")
 async def api_get_user_settings(user_id: int = Depends(get_current_user)):
     """Get user settings including system prompt configuration."""
-    settings = get_user_settings(user_id)
+    settings = await adb.get_user_settings(user_id)
     return settings
 
 
@@ -2185,7 +5927,7 @@ async def api_update_user_settings(
     user_id: int = Depends(get_current_user)
 ):
     """Update user settings."""
-    success = update_user_settings(user_id, {
+    success = await adb.update_user_settings(user_id, {
         "system_prompt": settings.system_prompt,
         "system_prompt_enabled": settings.system_prompt_enabled,
         "model_prompts": settings.model_prompts or {}
@@ -2205,16 +5947,72 @@ async def api_get_prompt_presets(user_id: int = Depends(get_current_user)):
 # Background Generation Routes (for recovery)
 # =============================================================================
 
+def require_generation(generation_id: str, user_id: int) -> str:
+    if generation_owner(generation_id) != user_id:
+        raise HTTPException(status_code=404, detail="Generation not found")
+    return generation_id
+
 @app.get("/api/chat/generation/status")
-async def api_generation_status(user_id: int = Depends(get_current_user)):
-    state = get_generation_state(user_id)
+async def api_generation_status(generation_id: Optional[str] = None, session_id: Optional[int] = None,
+                                user_id: int = Depends(get_current_user)):
+    """State of a generation (by id, the one running in a session, or the user's most recent one)."""
+    if generation_id is not None or session_id is not None:
+        status = await generation_manager.status(user_id, generation_id, session_id)
+        if status:
+            return status
+        if generation_id is None:
+            return {"status": "none"}
+    if generation_id is None:
+        generations = await run_io(list_user_generations, user_id)
+        if not generations:
+            return {"status": "none"}
+        generation_id = generations[0]
+    state = await run_io(get_generation_state, require_generation(generation_id, user_id))
     if not state:
         return {"status": "none"}
+    state.pop("marks", None)
     return state
 
+@app.get("/api/chat/generations")
+async def api_generations_running(user_id: int = Depends(get_current_user)):
+    """Generations currently running for the user, on any worker."""
+    return {"generations": await generation_manager.running(user_id)}
+
+@app.get("/api/chat/generation/{generation_id}/journal")
+async def api_generation_journal(generation_id: str, offset: int = 0, user_id: int = Depends(get_current_user)):
+    """Tail a generation journal from a byte offset."""
+    journal = await run_io(read_generation_journal, require_generation(generation_id, user_id), max(offset, 0))
+    if journal["snapshot"]:
+        journal["snapshot"].pop("marks", None)
+    return journal
+
+@app.get("/api/chat/stream/{generation_id}")
+async def api_chat_stream_resume(generation_id: str, request: Request, last_event_id: int = 0,
+                                 user_id: int = Depends(get_current_user)):
+    """Reattach to a generation's SSE stream, replaying events after Last-Event-ID."""
+    require_generation(generation_id, user_id)
+    header = request.headers.get("last-event-id")
+    if header:
+        try:
+            last_event_id = int(header)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid Last-Event-ID")
+
+    generation = generation_manager.get(generation_id)
+    if generation:
+        return event_stream_response(generation.subscribe(last_event_id), request.headers.get("accept"))
+    # Not running in this process: serve from the journal (finished, or owned by another worker)
+    if not await run_io(get_generation_state, generation_id):
+        raise HTTPException(status_code=404, detail="Generation not found")
+    return event_stream_response(follow_generation_journal(generation_id, last_event_id), request.headers.get("accept"))
+
 @app.delete("/api/chat/generation/clear")
-async def api_generation_clear(user_id: int = Depends(get_current_user)):
-    clear_generation(user_id)
+async def api_generation_clear(generation_id: Optional[str] = None, user_id: int = Depends(get_current_user)):
+    """Clear one generation, or all of the user's finished generations."""
+    if generation_id is not None:
+        await run_io(clear_generation, require_generation(generation_id, user_id))
+    else:
+        await run_io(clear_user_generations, user_id, keep=await generation_manager.running_ids(user_id))
     return {"success": True}
 
 
@@ -2222,10 +6020,38 @@ async def api_generation_clear(user_id: int = Depends(get_current_user)):
 # Attachments API (Time-bound image storage)
 # =============================================================================
 
+@app.post("/api/attachments")
+async def api_upload_attachment(request: Request, user_id: int = Depends(get_current_user)):
+    """
+    Upload an image as multipart/form-data (field "file"), for a later
+    /api/chat/send to reference in attachment_ids. The body is parsed as it
+    arrives and the file hashed and written in chunks, never buffered.
+    """
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    boundary = options.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise HTTPException(status_code=400, detail="Expected multipart/form-data")
+
+    upload = MultipartUpload(boundary)
+    try:
+        async for chunk in request.stream():
+            if chunk:
+                await run_io(upload.feed, chunk)
+        attachment = await run_db(upload.finish, user_id)
+    except AttachmentRejected as e:
+        raise e.to_http()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Malformed upload: {e}")
+    finally:
+        await run_io(upload.close)
+
+    return {**attachment_api_info(attachment), "size": attachment["size"]}
+
+
 @app.get("/api/attachments/{attachment_id}")
 async def api_get_attachment(attachment_id: int, user_id: int = Depends(get_current_user)):
     """Serve an attachment file (image)."""
-    attachment = get_attachment(attachment_id, user_id)
+    attachment = await adb.get_attachment(attachment_id, user_id)
     if not attachment:
         raise HTTPException(status_code=404, detail="Attachment not found or expired")
 
@@ -2246,7 +6072,7 @@ async def api_get_attachment(attachment_id: int, user_id: int = Depends(get_curr
 @app.get("/api/attachments/{attachment_id}/download")
 async def api_download_attachment(attachment_id: int, user_id: int = Depends(get_current_user)):
     """Download an attachment with original filename."""
-    attachment = get_attachment(attachment_id, user_id)
+    attachment = await adb.get_attachment(attachment_id, user_id)
     if not attachment:
         raise HTTPException(status_code=404, detail="Attachment not found or expired")
 
@@ -2269,17 +6095,17 @@ async def api_download_attachment(attachment_id: int, user_id: int = Depends(get
 # =============================================================================
 
 @app.post("/api/execute/python")
-async def api_execute_python(req: ExecutionRequest, user_id: int = Depends(get_current_user)):
-    """Execute Python code in a sandboxed environment and stream results via SSE."""
+async def api_execute_python(req: ExecutionRequest, request: Request, user_id: int = Depends(get_current_user)):
+    """Execute Python code in a sandboxed environment and stream results via SSE (or NDJSON)."""
     # Create execution record
-    execution_id = create_execution(user_id, req.language, req.code, req.artifact_id)
+    execution_id = await adb.create_execution(user_id, req.language, req.code, req.artifact_id)
 
-    async def generate_stream():
+    async def generate_events():
         # Emit started event
-        yield f"data: {json.dumps({'type': 'started', 'execution_id': execution_id})}\n\n"
+        yield None, {"type": "started", "execution_id": execution_id}
 
         # Update status to running
-        update_execution(execution_id, 'running')
+        await adb.update_execution(execution_id, 'running')
 
         try:
             # Run the code in sandbox
@@ -2291,24 +6117,24 @@ async def api_execute_python(req: ExecutionRequest, user_id: int = Depends(get_c
             # Stream stdout line by line for real-time output
             if result.stdout:
                 for line in result.stdout.split('\n'):
-                    yield f"data: {json.dumps({'type': 'stdout', 'content': line + chr(10)})}\n\n"
+                    yield None, {"type": "stdout", "content": line + chr(10)}
 
             # Stream stderr
             if result.stderr:
                 for line in result.stderr.split('\n'):
-                    yield f"data: {json.dumps({'type': 'stderr', 'content': line + chr(10)})}\n\n"
+                    yield None, {"type": "stderr", "content": line + chr(10)}
 
             # Determine final status
             if result.timed_out:
                 status = 'timeout'
-                yield f"data: {json.dumps({'type': 'timeout', 'execution_time_ms': result.execution_time_ms})}\n\n"
+                yield None, {"type": "timeout", "execution_time_ms": result.execution_time_ms}
             elif result.exit_code == 0:
                 status = 'completed'
             else:
                 status = 'failed'
 
             # Update execution record with results
-            update_execution(
+            await adb.update_execution(
                 execution_id,
                 status=status,
                 stdout=result.stdout,
@@ -2318,22 +6144,14 @@ async def api_execute_python(req: ExecutionRequest, user_id: int = Depends(get_c
             )
 
             # Emit completed event
-            yield f"data: {json.dumps({'type': 'completed', 'exit_code': result.exit_code, 'execution_time_ms': result.execution_time_ms})}\n\n"
+            yield None, {"type": "completed", "exit_code": result.exit_code, "execution_time_ms": result.execution_time_ms}
 
         except Exception as e:
             error_msg = str(e)
-            update_execution(execution_id, 'failed', stderr=error_msg, exit_code=-1)
-            yield f"data: {json.dumps({'type': 'error', 'error': error_msg})}\n\n"
+            await adb.update_execution(execution_id, 'failed', stderr=error_msg, exit_code=-1)
+            yield None, {"type": "error", "error": error_msg}
 
-    return StreamingResponse(
-        generate_stream(),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no"
-        }
-    )
+    return event_stream_response(generate_events(), request.headers.get("accept"))
 
 
 @app.post("/api/execute/preview")
@@ -2347,7 +6165,7 @@ async def api_create_preview(req: PreviewRequest, user_id: int = Depends(get_cur
     )
 
     # Create execution record for preview
-    execution_id = create_execution(
+    execution_id = await adb.create_execution(
         user_id,
         language='html',
         code=req.html,
@@ -2355,7 +6173,7 @@ async def api_create_preview(req: PreviewRequest, user_id: int = Depends(get_cur
     )
 
     # Update with preview content
-    update_execution(
+    await adb.update_execution(
         execution_id,
         status='completed',
         preview_html=preview_html,
@@ -2373,7 +6191,7 @@ async def api_create_preview(req: PreviewRequest, user_id: int = Depends(get_cur
 @app.get("/api/executions/{execution_id}/preview")
 async def api_get_preview(execution_id: int, user_id: int = Depends(get_current_user)):
     """Serve the HTML preview for an execution."""
-    execution = get_execution(execution_id, user_id)
+    execution = await adb.get_execution(execution_id, user_id)
     if not execution:
         raise HTTPException(status_code=404, detail="Execution not found")
 
@@ -2393,14 +6211,14 @@ async def api_get_preview(execution_id: int, user_id: int = Depends(get_current_
 @app.get("/api/executions")
 async def api_get_executions(limit: int = 20, user_id: int = Depends(get_current_user)):
     """Get execution history for the user."""
-    executions = get_executions_history(user_id, limit)
+    executions = await adb.get_executions_history(user_id, limit)
     return {"executions": executions}
 
 
 @app.get("/api/executions/{execution_id}")
 async def api_get_execution(execution_id: int, user_id: int = Depends(get_current_user)):
     """Get a specific execution record."""
-    execution = get_execution(execution_id, user_id)
+    execution = await adb.get_execution(execution_id, user_id)
     if not execution:
         raise HTTPException(status_code=404, detail="Execution not found")
     return execution
@@ -2492,8 +6310,8 @@ Response format:
 }
 
 
-async def run_troubleshoot(model: str, stage: str, error_data: Dict, context: Optional[Dict]) -> Dict:
-    """Execute troubleshooting prompt against the appropriate model."""
+def build_troubleshoot_prompt(stage: str, error_data: Dict, context: Optional[Dict]) -> str:
+    """Render the stage's troubleshooting prompt template."""
     from datetime import datetime, timedelta
 
     # Build prompt from template
@@ -2506,7 +6324,7 @@ async def run_troubleshoot(model: str, stage: str, error_data: Dict, context: Op
     template_vars = {
         "url": error_data.get("url", "N/A"),
         "error_message": error_data.get("error", "Unknown error"),
-        "html": str(context.get("raw_html", ""))[:5000] if context else "",
+        "html": str(context.get("raw_html", ""))[:TROUBLESHOOT_CONTEXT_CHARS] if context else "",
         "partial_data": json.dumps(error_data.get("partial_data", {}), indent=2),
         "missing_fields": ", ".join(error_data.get("missing_fields", [])),
         "today": today,
@@ -2521,113 +6339,166 @@ async def run_troubleshoot(model: str, stage: str, error_data: Dict, context: Op
     }
 
     try:
-        prompt = prompt_template.format(**template_vars)
-    except KeyError as e:
-        prompt = prompt_template  # Use raw if format fails
+        return prompt_template.format(**template_vars)
+    except KeyError:
+        return prompt_template  # Use raw if format fails
 
-    # Route to appropriate backend
-    backend, backend_url = get_backend_for_model(model)
+
+def troubleshoot_failure(diagnosis: str, action_taken: str) -> Dict:
+    return {
+        "success": False,
+        "recovered": False,
+        "recovered_data": None,
+        "diagnosis": diagnosis,
+        "action_taken": action_taken,
+        "confidence": 0.0,
+        "needs_manual": True,
+        "parsed": False
+    }
+
+
+def parse_troubleshoot_response(raw_response: Optional[str], stage: str, model: str, backend: str) -> Dict:
+    """
+    Turn a model's raw troubleshooting reply into a TroubleshootResult dict.
+    "parsed" is False when the reply held no usable JSON; such results are
+    not cached.
+    """
+    if not raw_response:
+        return troubleshoot_failure("Model returned an empty response", f"None - empty response from {backend}")
 
     try:
-        raw_response = None
+        json_match = re.search(r'\{[\s\S]*\}', raw_response)
+        if json_match:
+            parsed = json.loads(json_match.group(0))
 
-        if backend == "vllm":
-            # Use vLLM completions API
-            raw_response = await vllm_generate(model, prompt, temperature=0.3, max_tokens=1500)
-            if raw_response is None:
+            # Handle analyze stage differently - scores are at top level
+            if stage == "analyze" and "completeness_score" in parsed:
                 return {
-                    "success": False,
-                    "recovered": False,
-                    "recovered_data": None,
-                    "diagnosis": "vLLM request failed",
-                    "action_taken": "None - vLLM unavailable",
-                    "confidence": 0.0,
-                    "needs_manual": True
+                    "success": True,
+                    "recovered": True,
+                    "recovered_data": {
+                        "completeness_score": parsed.get("completeness_score", 50),
+                        "win_probability": parsed.get("win_probability", 50),
+                        "risk_score": parsed.get("risk_score", 50)
+                    },
+                    "diagnosis": parsed.get("diagnosis", "Fallback analysis complete"),
+                    "action_taken": f"Troubleshoot via {model} ({backend})",
+                    "confidence": 0.7,
+                    "needs_manual": False,
+                    "parsed": True
                 }
-        else:
-            # Use Ollama generate API
-            payload = {
-                "model": model,
-                "prompt": prompt,
-                "stream": False,
-                "options": {
-                    "temperature": 0.3,
-                    "num_predict": 1500
-                }
-            }
-
-            async with httpx.AsyncClient(timeout=120) as client:
-                response = await client.post(f"{backend_url}/api/generate", json=payload)
-
-                if response.status_code == 200:
-                    result = response.json()
-                    raw_response = result.get("response", "{}")
-                else:
-                    return {
-                        "success": False,
-                        "recovered": False,
-                        "recovered_data": None,
-                        "diagnosis": f"Model request failed: HTTP {response.status_code}",
-                        "action_taken": "None - model unavailable",
-                        "confidence": 0.0,
-                        "needs_manual": True
-                    }
-
-        # Parse response (common to both backends)
-        if raw_response:
-            try:
-                json_match = re.search(r'\{[\s\S]*\}', raw_response)
-                if json_match:
-                    parsed = json.loads(json_match.group(0))
-
-                    # Handle analyze stage differently - scores are at top level
-                    if stage == "analyze" and "completeness_score" in parsed:
-                        return {
-                            "success": True,
-                            "recovered": True,
-                            "recovered_data": {
-                                "completeness_score": parsed.get("completeness_score", 50),
-                                "win_probability": parsed.get("win_probability", 50),
-                                "risk_score": parsed.get("risk_score", 50)
-                            },
-                            "diagnosis": parsed.get("diagnosis", "Fallback analysis complete"),
-                            "action_taken": f"Troubleshoot via {model} ({backend})",
-                            "confidence": 0.7,
-                            "needs_manual": False
-                        }
-
-                    return {
-                        "success": True,
-                        "recovered": parsed.get("recoverable", False),
-                        "recovered_data": parsed.get("extracted", parsed.get("suggested_corrections", {})),
-                        "diagnosis": parsed.get("diagnosis", "Analysis complete"),
-                        "action_taken": f"Troubleshoot via {model} ({backend})",
-                        "confidence": parsed.get("confidence", 0.5),
-                        "needs_manual": not parsed.get("recoverable", False)
-                    }
-            except json.JSONDecodeError:
-                pass
 
-            # Fallback if JSON parsing fails
             return {
                 "success": True,
-                "recovered": False,
-                "recovered_data": None,
-                "diagnosis": raw_response[:500],
-                "action_taken": f"Troubleshoot via {model} ({backend}, unparseable response)",
-                "confidence": 0.0,
-                "needs_manual": True
+                "recovered": parsed.get("recoverable", False),
+                "recovered_data": parsed.get("extracted", parsed.get("suggested_corrections", {})),
+                "diagnosis": parsed.get("diagnosis", "Analysis complete"),
+                "action_taken": f"Troubleshoot via {model} ({backend})",
+                "confidence": parsed.get("confidence", 0.5),
+                "needs_manual": not parsed.get("recoverable", False),
+                "parsed": True
             }
+    except json.JSONDecodeError:
+        pass
+
+    # Fallback if JSON parsing fails
+    return {
+        "success": True,
+        "recovered": False,
+        "recovered_data": None,
+        "diagnosis": raw_response[:500],
+        "action_taken": f"Troubleshoot via {model} ({backend}, unparseable response)",
+        "confidence": 0.0,
+        "needs_manual": True,
+        "parsed": False
+    }
+
+
+async def run_troubleshoot(model: str, stage: str, error_data: Dict, context: Optional[Dict]) -> Dict:
+    """Execute troubleshooting prompt against the appropriate model."""
+    prompt = build_troubleshoot_prompt(stage, error_data, context)
+
+    # Route to appropriate backend
+    backend, backend_url = get_backend_for_model(model)
+
+    try:
+        try:
+            raw_response = await get_llm_backend(backend).generate(
+                backend_url, model, prompt, temperature=0.3, max_tokens=1500
+            )
+        except BackendHTTPError as e:
+            return troubleshoot_failure(f"Model request failed: {e}", f"None - {backend} unavailable")
+        return parse_troubleshoot_response(raw_response, stage, model, backend)
     except Exception as e:
-        return {
-            "success": False,
-            "recovered": False,
-            "recovered_data": None,
-            "diagnosis": f"Troubleshoot error: {str(e)}",
-            "action_taken": "None - exception occurred",
-            "confidence": 0.0,
-            "needs_manual": True
-        }
+        return troubleshoot_failure(f"Troubleshoot error: {str(e)}", "None - exception occurred")
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into one execution; the
+    others await its result. The call runs as its own task, so a caller
+    that goes away does not cancel it for the rest.
+    """
+
+    def __init__(self):
+        self.calls: Dict[str, asyncio.Task] = {}
+        self.started = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, fn) -> tuple[Any, bool]:
+        """Returns (result, shared): shared is True if another caller's call was joined."""
+        task = self.calls.get(key)
+        shared = task is not None
+        if shared:
+            self.coalesced += 1
+        else:
+            task = asyncio.create_task(fn())
+            self.calls[key] = task
+            self.started += 1
+            task.add_done_callback(lambda _: self.calls.pop(key, None))
+        return await asyncio.shield(task), shared
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self.calls), "started": self.started, "coalesced": self.coalesced}
+
+
+troubleshoot_cache = TTLCache(TROUBLESHOOT_CACHE_MAX_ENTRIES, TROUBLESHOOT_CACHE_TTL_SECONDS)
+troubleshoot_flight = SingleFlight()
+
+
+def troubleshoot_cache_key(model: str, stage: str, error_data: Dict, context: Optional[Dict]) -> str:
+    """Canonical hash of a troubleshoot request, with context strings cut to what the prompts use."""
+    context = {
+        key: value[:TROUBLESHOOT_CONTEXT_CHARS] if isinstance(value, str) else value
+        for key, value in (context or {}).items()
+    }
+    canonical = json.dumps([model, stage, error_data, context], sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+async def run_troubleshoot_cached(model: str, stage: str, error_data: Dict,
+                                  context: Optional[Dict]) -> tuple[Dict, Dict]:
+    """
+    run_troubleshoot behind a result cache and single-flight coalescing.
+    Returns (result, cache_info). Only parsed results are cached, so
+    retries after a backend failure or an unparseable reply still reach
+    the model.
+    """
+    key = troubleshoot_cache_key(model, stage, error_data, context)
+    if TROUBLESHOOT_CACHE_TTL_SECONDS > 0:
+        cached = troubleshoot_cache.get(key)
+        if cached is not None:
+            result, stored_at = cached
+            return result, {"hit": True, "coalesced": False, "age_seconds": round(time.time() - stored_at, 1)}
+
+    async def call() -> Dict:
+        result = await run_troubleshoot(model, stage, error_data, context)
+        if result["parsed"] and TROUBLESHOOT_CACHE_TTL_SECONDS > 0:
+            troubleshoot_cache.set(key, (result, time.time()))
+        return result
+
+    result, shared = await troubleshoot_flight.do(key, call)
+    return result, {"hit": False, "coalesced": shared}
 
 
 @app.post("/api/troubleshoot")
@@ -2648,13 +6519,17 @@ async def api_troubleshoot(request: TroubleshootRequest):
 
     model = TROUBLESHOOT_MODELS[stage]
 
-    result = await run_troubleshoot(
+    result, cache_info = await run_troubleshoot_cached(
         model=model,
         stage=stage,
         error_data=request.error_data,
         context=request.context
     )
 
+    return troubleshoot_response(stage, model, result, cache_info)
+
+
+def troubleshoot_response(stage: str, model: str, result: Dict, cache_info: Dict) -> Dict:
     return {
         "success": result["success"],
         "stage": stage,
@@ -2664,10 +6539,133 @@ async def api_troubleshoot(request: TroubleshootRequest):
         "action_taken": result["action_taken"],
         "confidence": result["confidence"],
         "needs_manual": result["needs_manual"],
-        "recovered": result["recovered"]
+        "recovered": result["recovered"],
+        "cache": cache_info
     }
 
 
+async def run_troubleshoot_batch(model: str, stage: str, items: List[tuple[int, TroubleshootBatchItem]],
+                                 semaphore: asyncio.Semaphore, emit):
+    """
+    Troubleshoot one (stage, model) group with vLLM batched prompts: cache
+    hits are emitted at once, identical items share a prompt, and the rest
+    go upstream TROUBLESHOOT_BATCH_SIZE prompts per request, each request
+    to the endpoint the backend pool picks for it.
+    """
+    backend = backend_for_model(model)
+    pending: Dict[str, List[tuple[int, TroubleshootBatchItem]]] = {}
+    for index, item in items:
+        key = troubleshoot_cache_key(model, stage, item.error_data, item.context)
+        cached = troubleshoot_cache.get(key) if TROUBLESHOOT_CACHE_TTL_SECONDS > 0 else None
+        if cached is not None:
+            result, stored_at = cached
+            await emit(index, item, stage, model, result,
+                       {"hit": True, "coalesced": False, "age_seconds": round(time.time() - stored_at, 1)})
+        else:
+            pending.setdefault(key, []).append((index, item))
+
+    async def run_chunk(keys: List[str]):
+        prompts = [build_troubleshoot_prompt(stage, pending[k][0][1].error_data, pending[k][0][1].context) for k in keys]
+        async with semaphore:
+            try:
+                texts = await get_llm_backend(backend).generate_batch(
+                    backend_pool.pick(backend, model), model, prompts, temperature=0.3, max_tokens=1500
+                )
+                results = []
+                for text in texts[:len(keys)]:
+                    try:
+                        results.append(parse_troubleshoot_response(text, stage, model, backend))
+                    except Exception as e:
+                        results.append(troubleshoot_failure(f"Troubleshoot error: {str(e)}", "None - exception occurred"))
+                # A short reply must not drop items silently
+                results += [troubleshoot_failure(
+                    f"Model returned {len(texts)} results for {len(keys)} prompts", f"None - incomplete {backend} batch"
+                )] * (len(keys) - len(results))
+            except BackendHTTPError as e:
+                results = [troubleshoot_failure(f"Model request failed: {e}", f"None - {backend} unavailable")] * len(keys)
+            except Exception as e:
+                results = [troubleshoot_failure(f"Troubleshoot error: {str(e)}", "None - exception occurred")] * len(keys)
+        for key, result in zip(keys, results):
+            if result["parsed"] and TROUBLESHOOT_CACHE_TTL_SECONDS > 0:
+                troubleshoot_cache.set(key, (result, time.time()))
+            for position, (index, item) in enumerate(pending[key]):
+                await emit(index, item, stage, model, result, {"hit": False, "coalesced": position > 0, "batched": True})
+
+    keys = list(pending)
+    await asyncio.gather(*(
+        run_chunk(keys[start:start + TROUBLESHOOT_BATCH_SIZE]) for start in range(0, len(keys), TROUBLESHOOT_BATCH_SIZE)
+    ))
+
+
+@app.post("/api/troubleshoot/batch")
+async def api_troubleshoot_batch(request: TroubleshootBatchRequest):
+    """
+    Troubleshoot many pipeline failures in one call.
+
+    Items are grouped by stage (and so by model) and run with bounded
+    concurrency; groups on vLLM are sent as batched prompts. Results stream
+    back as NDJSON in completion order, one line per item with its index,
+    id and status ("ok", "failed" or "invalid"), then a summary line.
+    Cache hits and request coalescing work as for /api/troubleshoot.
+    """
+    if len(request.items) > TROUBLESHOOT_BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Too many items ({len(request.items)}); the limit is {TROUBLESHOOT_BATCH_MAX_ITEMS}"
+        )
+    semaphore = asyncio.Semaphore(max(1, min(request.concurrency or TROUBLESHOOT_BATCH_CONCURRENCY,
+                                             TROUBLESHOOT_BATCH_CONCURRENCY)))
+    lines: asyncio.Queue = asyncio.Queue()
+    counts = {"ok": 0, "failed": 0, "invalid": 0, "cached": 0}
+
+    async def emit(index: int, item: TroubleshootBatchItem, stage: str, model: Optional[str],
+                   result: Optional[Dict], cache_info: Optional[Dict], error: str = None):
+        if result is None:
+            line = {"index": index, "id": item.id, "status": "invalid", "stage": stage, "error": error}
+        else:
+            line = {"index": index, "id": item.id, "status": "ok" if result["success"] else "failed",
+                    **troubleshoot_response(stage, model, result, cache_info)}
+            counts["cached"] += cache_info.get("hit", False)
+        counts[line["status"]] += 1
+        await lines.put(json.dumps(line) + "\n")
+
+    async def run_item(index: int, item: TroubleshootBatchItem, stage: str, model: str):
+        async with semaphore:
+            result, cache_info = await run_troubleshoot_cached(model, stage, item.error_data, item.context)
+        await emit(index, item, stage, model, result, cache_info)
+
+    async def run_all():
+        groups: Dict[tuple, List[tuple[int, TroubleshootBatchItem]]] = {}
+        for index, item in enumerate(request.items):
+            stage = item.stage.lower()
+            if stage not in TROUBLESHOOT_MODELS:
+                await emit(index, item, stage, None, None, None,
+                           error=f"Invalid stage: {stage}. Valid stages: {list(TROUBLESHOOT_MODELS.keys())}")
+                continue
+            groups.setdefault((stage, TROUBLESHOOT_MODELS[stage]), []).append((index, item))
+
+        tasks = []
+        for (stage, model), group in groups.items():
+            if backend_for_model(model) == "vllm" and len(group) > 1:
+                tasks.append(run_troubleshoot_batch(model, stage, group, semaphore, emit))
+            else:
+                tasks.extend(run_item(index, item, stage, model) for index, item in group)
+        await asyncio.gather(*tasks)
+
+    async def stream():
+        runner = asyncio.create_task(run_all())
+        runner.add_done_callback(lambda _: lines.put_nowait(None))
+        try:
+            while (line := await lines.get()) is not None:
+                yield line
+            await runner  # Surface an unexpected failure instead of a silent short stream
+            yield json.dumps({"summary": True, "total": len(request.items), **counts}) + "\n"
+        finally:
+            runner.cancel()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
 @app.get("/api/troubleshoot/models")
 async def api_troubleshoot_models():
     """Get the model assignments for each troubleshooting stage."""
@@ -2702,28 +6700,33 @@ async def health():
     """Health check with backend status."""
     backends = {"ollama": False, "vllm": False}
 
-    # Check Ollama
-    try:
-        async with httpx.AsyncClient(timeout=2) as client:
-            resp = await client.get(f"{OLLAMA_URL}/api/tags")
-            backends["ollama"] = resp.status_code == 200
-    except Exception:
-        pass
-
-    # Check vLLM (if enabled)
-    if VLLM_ENABLED:
+    async def ping(backend: str, url: str) -> bool:
         try:
-            async with httpx.AsyncClient(timeout=2) as client:
-                resp = await client.get(f"{VLLM_URL}/v1/models")
-                backends["vllm"] = resp.status_code == 200
+            return await get_llm_backend(backend).ping(url)
         except Exception:
-            pass
+            return False
+
+    # A backend is up if any of its endpoints answers (vLLM only if enabled)
+    for backend in (["ollama", "vllm"] if VLLM_ENABLED else ["ollama"]):
+        urls = backend_pool.urls(backend)
+        backends[backend] = any(await asyncio.gather(*(ping(backend, url) for url in urls)))
 
     return {
         "status": "ok",
         "chroma": CHROMA_AVAILABLE,
         "backends": backends,
-        "vllm_enabled": VLLM_ENABLED
+        "vllm_enabled": VLLM_ENABLED,
+        "db_pool": db_pool.stats(),
+        "http_pools": backend_http.stats(),
+        "sse_framing": framing_stats,
+        "endpoints": backend_pool.stats(),
+        "model_catalog": model_catalog.stats(),
+        "generations": generation_manager.stats(),
+        "admission": admission.stats(),
+        "prompt_cache": prefix_cache_stats.stats(),
+        "summaries": session_summarizer.stats(),
+        "response_cache": response_cache.stats(),
+        "troubleshoot": {"cache": troubleshoot_cache.stats(), "single_flight": troubleshoot_flight.stats()}
     }
 
 # =============================================================================
@@ -24,13 +24,14 @@ const state = {
     translationModels: [],
     messages: [],
     uploadedImage: null,
+    uploadedImageUrl: null,  // Object URL of the preview; revoked when the image is replaced or cleared
     lastOutput: null,
     isGenerating: false,
     // Session management
     currentSessionId: null,
     sessions: [],
     hasMoreSessions: false,
-    sessionsOffset: 0,
+    sessionsCursor: null,
     // Generation control
     generationController: null,
     canContinue: false,
@@ -258,9 +259,10 @@ async function createSession(name = 'New Chat') {
 async function loadSessions(reset = true) {
     try {
         if (reset) {
-            state.sessionsOffset = 0;
+            state.sessionsCursor = null;
         }
-        const response = await api(`/sessions?limit=20&offset=${state.sessionsOffset}`);
+        const cursorParam = state.sessionsCursor ? `&cursor=${encodeURIComponent(state.sessionsCursor)}` : '';
+        const response = await api(`/sessions?limit=20${cursorParam}`);
         if (response.ok) {
             const data = await response.json();
             if (reset) {
@@ -269,7 +271,7 @@ async function loadSessions(reset = true) {
                 state.sessions = [...state.sessions, ...data.sessions];
             }
             state.hasMoreSessions = data.has_more;
-            state.sessionsOffset += data.sessions.length;
+            state.sessionsCursor = data.next_cursor;
             return state.sessions;
         }
     } catch (e) {
@@ -460,10 +462,27 @@ async function stopGeneration() {
     return null;
 }
 
+async function uploadAttachment(file) {
+    const form = new FormData();
+    form.append('file', file);
+
+    const response = await fetch(`${API_BASE}/attachments`, {
+        method: 'POST',
+        credentials: 'include',
+        body: form
+    });
+    if (!response.ok) {
+        throw new Error(`Upload failed: HTTP ${response.status}`);
+    }
+    return response.json();
+}
+
 async function sendMessage(message, model, sessionId = null, images = null) {
     const payload = { message, model, session_id: sessionId };
     if (images) {
-        payload.images = images;
+        // Images go up as multipart first; the message references the stored attachments
+        const uploaded = await Promise.all(images.map(uploadAttachment));
+        payload.attachment_ids = uploaded.map(attachment => attachment.id);
     }
 
     const response = await fetch(`${API_BASE}/chat/send`, {
@@ -492,6 +511,87 @@ async function continueGeneration() {
     return response;
 }
 
+function resumeGenerationStream(generationId, lastEventId) {
+    return fetch(`${API_BASE}/chat/stream/${encodeURIComponent(generationId)}`, {
+        credentials: 'include',
+        headers: { 'Last-Event-ID': String(lastEventId) }
+    });
+}
+
+// Parse SSE events from a chat generation response. The generation keeps
+// running server-side if the connection drops, so reattach with the last
+// event id seen and continue from there instead of giving up.
+async function* generationEvents(response) {
+    const terminal = new Set(['done', 'stopped', 'error']);
+    const maxAttempts = 5;
+    let generationId = null;
+    let lastEventId = 0;
+    let attempts = 0;
+
+    while (true) {
+        if (response) {
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            try {
+                while (true) {
+                    const { done, value } = await reader.read();
+                    if (done) break;
+                    buffer += decoder.decode(value, { stream: true });
+
+                    let boundary;
+                    while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                        const block = buffer.slice(0, boundary);
+                        buffer = buffer.slice(boundary + 2);
+
+                        let jsonStr = null;
+                        for (const line of block.split('\n')) {
+                            if (line.startsWith('id: ')) {
+                                lastEventId = parseInt(line.slice(4), 10);
+                            } else if (line.startsWith('data: ')) {
+                                jsonStr = line.slice(6);
+                            }
+                        }
+                        if (!jsonStr) continue;
+
+                        let data;
+                        try {
+                            data = JSON.parse(jsonStr);
+                        } catch (e) {
+                            console.error('Parse error:', e);
+                            continue;
+                        }
+                        if (data.type === 'session' && data.generation_id) {
+                            generationId = data.generation_id;
+                        }
+                        attempts = 0;
+                        yield data;
+                        if (terminal.has(data.type)) return;
+                    }
+                }
+            } catch (e) {
+                if (!generationId) throw e;
+                console.warn('Stream interrupted, reattaching:', e);
+            }
+        }
+
+        if (!generationId || attempts >= maxAttempts) {
+            throw new Error('Connection lost');
+        }
+        attempts++;
+        await new Promise(resolve => setTimeout(resolve, 500 * attempts));
+        try {
+            response = await resumeGenerationStream(generationId, lastEventId);
+        } catch (e) {
+            response = null;
+            continue;
+        }
+        if (!response.ok) {
+            throw new Error(`HTTP ${response.status}`);
+        }
+    }
+}
+
 // =============================================================================
 // UI Functions
 // =============================================================================
@@ -980,20 +1080,19 @@ function selectArtifact(artifact, type) {
     elements.previewContent.appendChild(pre);
 }
 
-function extractArtifactsRealtime(content) {
-    // Extract counts for real-time display during streaming
-    const codeCount = (content.match(/```(\w+)?\n[\s\S]*?```/g) || []).length;
-    const thoughtCount = (content.match(/&lt;think&gt;[\s\S]*?&lt;\/think&gt;/g) || []).length;
-    const sectionCount = (content.match(/^##\s+.+?\n[\s\S]{50,}?(?=^##|\Z)/gm) || []).length;
+function countStreamedArtifact(streamed, event) {
+    // The server announces each artifact as it completes; tally them for real-time display
+    if (event.discarded || !(event.artifact_type in streamed)) return;
+    streamed[event.artifact_type] += 1;
 
     // Add to existing counts from user artifacts
     const existingCode = (state.artifacts.code || []).length;
     const existingThought = (state.artifacts.thought || []).length;
     const existingDocs = (state.artifacts.document || []).length;
 
-    elements.codeCount.textContent = `(${existingCode + codeCount})`;
-    elements.thoughtCount.textContent = `(${existingThought + thoughtCount})`;
-    elements.documentCount.textContent = `(${existingDocs + sectionCount})`;
+    elements.codeCount.textContent = `(${existingCode + streamed.code})`;
+    elements.thoughtCount.textContent = `(${existingThought + streamed.thought})`;
+    elements.documentCount.textContent = `(${existingDocs + streamed.document})`;
 }
 
 // =============================================================================
@@ -1178,26 +1277,25 @@ if (elements.inlineImageInput) {
     elements.inlineImageInput.addEventListener('change', (e) => {
         const file = e.target.files[0];
         if (file) {
-            const reader = new FileReader();
-            reader.onload = (event) => {
-                const base64 = event.target.result.split(',')[1];
-                state.uploadedImage = base64;
-                // Update both previews for consistency
-                if (elements.inlinePreviewImg) {
-                    elements.inlinePreviewImg.src = event.target.result;
-                    elements.inlineImagePreview.classList.remove('hidden');
-                }
-                if (elements.attachBtn) {
-                    elements.attachBtn.classList.add('has-image');
-                }
-                // Also update sidebar preview if it exists
-                if (elements.previewImg) {
-                    elements.previewImg.src = event.target.result;
-                    elements.imagePreview.classList.remove('hidden');
-                    elements.fileUpload.classList.add('hidden');
-                }
-            };
-            reader.readAsDataURL(file);
+            // Keep the File itself; it is uploaded as multipart on send
+            state.uploadedImage = file;
+            if (state.uploadedImageUrl) URL.revokeObjectURL(state.uploadedImageUrl);
+            const previewUrl = URL.createObjectURL(file);
+            state.uploadedImageUrl = previewUrl;
+            // Update both previews for consistency
+            if (elements.inlinePreviewImg) {
+                elements.inlinePreviewImg.src = previewUrl;
+                elements.inlineImagePreview.classList.remove('hidden');
+            }
+            if (elements.attachBtn) {
+                elements.attachBtn.classList.add('has-image');
+            }
+            // Also update sidebar preview if it exists
+            if (elements.previewImg) {
+                elements.previewImg.src = previewUrl;
+                elements.imagePreview.classList.remove('hidden');
+                elements.fileUpload.classList.add('hidden');
+            }
         }
     });
 }
@@ -1211,6 +1309,10 @@ if (elements.inlineRemoveImage) {
 // Helper to clear uploaded image from all locations
 function clearUploadedImage() {
     state.uploadedImage = null;
+    if (state.uploadedImageUrl) {
+        URL.revokeObjectURL(state.uploadedImageUrl);
+        state.uploadedImageUrl = null;
+    }
     // Clear inline upload
     if (elements.inlineImageInput) elements.inlineImageInput.value = '';
     if (elements.inlineImagePreview) elements.inlineImagePreview.classList.add('hidden');
@@ -1588,6 +1690,7 @@ async function handleSendMessage() {
     scrollToBottom();
 
     let fullResponse = '';
+    const streamedArtifacts = { code: 0, thought: 0, document: 0 };
 
     try {
         const response = await sendMessage(message, state.selectedModel, state.currentSessionId, images);
@@ -1596,79 +1699,64 @@ async function handleSendMessage() {
             throw new Error(`HTTP ${response.status}`);
         }
 
-        const reader = response.body.getReader();
-        const decoder = new TextDecoder();
-
-        while (true) {
-            const { done, value } = await reader.read();
-            if (done) break;
-
-            const text = decoder.decode(value);
-            const lines = text.split('\n');
-
-            for (const line of lines) {
-                if (line.startsWith('data: ')) {
-                    const jsonStr = line.slice(6);
-                    if (!jsonStr) continue;
-
-                    try {
-                        const data = JSON.parse(jsonStr);
-
-                        if (data.type === 'session') {
-                            // Update session ID if auto-created
-                            if (!state.currentSessionId) {
-                                state.currentSessionId = data.session_id;
-                                await loadSessions();
-                                renderSessions();
-                            }
-                        } else if (data.type === 'content') {
-                            fullResponse += data.content;
-                            // Safe: formatContent escapes HTML first
-                            contentDiv.innerHTML = formatContent(fullResponse) + '<span class="streaming-cursor">|</span>';
-                            scrollToBottom();
-
-                            // Update artifact counts in real-time
-                            extractArtifactsRealtime(fullResponse);
-                        } else if (data.type === 'done') {
-                            contentDiv.innerHTML = formatContent(fullResponse);
-                            contentDiv.querySelectorAll('pre code').forEach(el => {
-                                if (typeof hljs !== 'undefined') {
-                                    hljs.highlightElement(el);
-                                }
-                            });
-                            state.messages.push({
-                                role: 'assistant',
-                                content: fullResponse,
-                                model: state.selectedModel,
-                                is_partial: false
-                            });
-                            state.lastOutput = fullResponse;
-
-                            // Reload artifacts
-                            if (state.currentSessionId) {
-                                await loadArtifacts(state.currentSessionId);
-                                renderArtifacts();
-                            }
-                        } else if (data.type === 'stopped') {
-                            assistantDiv.classList.add('partial');
-                            contentDiv.innerHTML = formatContent(fullResponse);
-                            state.messages.push({
-                                role: 'assistant',
-                                content: fullResponse,
-                                model: state.selectedModel,
-                                is_partial: true
-                            });
-                            state.canContinue = true;
-                        } else if (data.type === 'error') {
-                            const errorMsg = document.createElement('em');
-                            errorMsg.textContent = `Error: ${data.error}`;
-                            contentDiv.innerHTML = '';
-                            contentDiv.appendChild(errorMsg);
+        for await (const data of generationEvents(response)) {
+            try {
+                if (data.type === 'session') {
+                    // Update session ID if auto-created
+                    if (!state.currentSessionId) {
+                        state.currentSessionId = data.session_id;
+                        await loadSessions();
+                        renderSessions();
+                    }
+                } else if (data.type === 'queued') {
+                    // Waiting for a free backend slot
+                    contentDiv.textContent = `Queued (position ${data.position})...`;
+                } else if (data.type === 'content') {
+                    fullResponse += data.content;
+                    // Safe: formatContent escapes HTML first
+                    contentDiv.innerHTML = formatContent(fullResponse) + '<span class="streaming-cursor">|</span>';
+                    scrollToBottom();
+                } else if (data.type === 'artifact_completed') {
+                    // Update artifact counts in real-time
+                    countStreamedArtifact(streamedArtifacts, data);
+                } else if (data.type === 'done') {
+                    contentDiv.innerHTML = formatContent(fullResponse);
+                    contentDiv.querySelectorAll('pre code').forEach(el => {
+                        if (typeof hljs !== 'undefined') {
+                            hljs.highlightElement(el);
                         }
-                    } catch (e) {
-                        console.error('Parse error:', e);
+                    });
+                    state.messages.push({
+                        role: 'assistant',
+                        content: fullResponse,
+                        model: state.selectedModel,
+                        is_partial: false
+                    });
+                    state.lastOutput = fullResponse;
+
+                    // Reload artifacts
+                    if (state.currentSessionId) {
+                        await loadArtifacts(state.currentSessionId);
+                        renderArtifacts();
                     }
+                } else if (data.type === 'stopped') {
+                    assistantDiv.classList.add('partial');
+                    contentDiv.innerHTML = formatContent(fullResponse);
+                    state.messages.push({
+                        role: 'assistant',
+                        content: fullResponse,
+                        model: state.selectedModel,
+                        is_partial: true
+                    });
+                    state.canContinue = true;
+                } else if (data.type === 'error') {
+                    const errorMsg = document.createElement('em');
+                    errorMsg.textContent = `Error: ${data.error}`;
+                    contentDiv.innerHTML = '';
+                    contentDiv.appendChild(errorMsg);
                 }
+            } catch (e) {
+                console.error('Event handling error:', e);
             }
         }
     } catch (error) {
@@ -1703,6 +1791,7 @@ async function handleContinue() {
     }
 
     let fullResponse = state.messages[state.messages.length - 1]?.content || '';
+    const streamedArtifacts = { code: 0, thought: 0, document: 0 };
 
     try {
         const response = await continueGeneration();
@@ -1711,77 +1800,60 @@ async function handleContinue() {
             throw new Error(`HTTP ${response.status}`);
         }
 
-        const reader = response.body.getReader();
-        const decoder = new TextDecoder();
-
-        while (true) {
-            const { done, value } = await reader.read();
-            if (done) break;
-
-            const text = decoder.decode(value);
-            const lines = text.split('\n');
-
-            for (const line of lines) {
-                if (line.startsWith('data: ')) {
-                    const jsonStr = line.slice(6);
-                    if (!jsonStr) continue;
-
-                    try {
-                        const data = JSON.parse(jsonStr);
-
-                        if (data.type === 'content') {
-                            fullResponse += data.content;
-                            if (contentDiv) {
-                                contentDiv.innerHTML = formatContent(fullResponse) + '<span class="streaming-cursor">|</span>';
-                            }
-                            scrollToBottom();
-                            extractArtifactsRealtime(fullResponse);
-                        } else if (data.type === 'done') {
-                            if (contentDiv) {
-                                contentDiv.innerHTML = formatContent(fullResponse);
-                                contentDiv.querySelectorAll('pre code').forEach(el => {
-                                    if (typeof hljs !== 'undefined') {
-                                        hljs.highlightElement(el);
-                                    }
-                                });
-                            }
-                            // Update the message in state
-                            if (state.messages.length > 0) {
-                                state.messages[state.messages.length - 1].content = fullResponse;
-                                state.messages[state.messages.length - 1].is_partial = false;
+        for await (const data of generationEvents(response)) {
+            try {
+                if (data.type === 'content') {
+                    fullResponse += data.content;
+                    if (contentDiv) {
+                        contentDiv.innerHTML = formatContent(fullResponse) + '<span class="streaming-cursor">|</span>';
+                    }
+                    scrollToBottom();
+                } else if (data.type === 'artifact_completed') {
+                    countStreamedArtifact(streamedArtifacts, data);
+                } else if (data.type === 'done') {
+                    if (contentDiv) {
+                        contentDiv.innerHTML = formatContent(fullResponse);
+                        contentDiv.querySelectorAll('pre code').forEach(el => {
+                            if (typeof hljs !== 'undefined') {
+                                hljs.highlightElement(el);
                             }
-                            state.lastOutput = fullResponse;
-                            state.canContinue = false;
+                        });
+                    }
+                    // Update the message in state
+                    if (state.messages.length > 0) {
+                        state.messages[state.messages.length - 1].content = fullResponse;
+                        state.messages[state.messages.length - 1].is_partial = false;
+                    }
+                    state.lastOutput = fullResponse;
+                    state.canContinue = false;
 
-                            // Reload artifacts
-                            if (state.currentSessionId) {
-                                await loadArtifacts(state.currentSessionId);
-                                renderArtifacts();
-                            }
-                        } else if (data.type === 'stopped') {
-                            if (lastMessageEl) {
-                                lastMessageEl.classList.add('partial');
-                            }
-                            if (contentDiv) {
-                                contentDiv.innerHTML = formatContent(fullResponse);
-                            }
-                            if (state.messages.length > 0) {
-                                state.messages[state.messages.length - 1].content = fullResponse;
-                                state.messages[state.messages.length - 1].is_partial = true;
-                            }
-                            state.canContinue = true;
-                        } else if (data.type === 'error') {
-                            if (contentDiv) {
-                                const errorMsg = document.createElement('em');
-                                errorMsg.textContent = `Error: ${data.error}`;
-                                contentDiv.appendChild(document.createElement('br'));
-                                contentDiv.appendChild(errorMsg);
-                            }
-                        }
-                    } catch (e) {
-                        console.error('Parse error:', e);
+                    // Reload artifacts
+                    if (state.currentSessionId) {
+                        await loadArtifacts(state.currentSessionId);
+                        renderArtifacts();
+                    }
+                } else if (data.type === 'stopped') {
+                    if (lastMessageEl) {
+                        lastMessageEl.classList.add('partial');
+                    }
+                    if (contentDiv) {
+                        contentDiv.innerHTML = formatContent(fullResponse);
+                    }
+                    if (state.messages.length > 0) {
+                        state.messages[state.messages.length - 1].content = fullResponse;
+                        state.messages[state.messages.length - 1].is_partial = true;
+                    }
+                    state.canContinue = true;
+                } else if (data.type === 'error') {
+                    if (contentDiv) {
+                        const errorMsg = document.createElement('em');
+                        errorMsg.textContent = `Error: ${data.error}`;
+                        contentDiv.appendChild(document.createElement('br'));
+                        contentDiv.appendChild(errorMsg);
                     }
                 }
+            } catch (e) {
+                console.error('Event handling error:', e);
             }
         }
     } catch (error) {
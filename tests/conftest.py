@@ -0,0 +1,42 @@
+"""
+Shared fixtures for the main.py tests.
+
+The app reads its configuration at import time, so the environment points
+it at a throwaway DATA_DIR (and at no reachable model backend) before
+main is imported.
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="borak-tests-")
+os.environ.setdefault("SECRET_KEY", "test-secret")
+os.environ.setdefault("OLLAMA_URL", "http://127.0.0.1:9")
+os.environ.setdefault("VLLM_ENABLED", "false")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+main.init_db()
+
+
+@pytest.fixture
+def client():
+    """A TestClient with the app's lifespan running and a fresh user logged in."""
+    username = f"user{os.urandom(4).hex()}"
+    with TestClient(main.app) as client:
+        client.post("/api/auth/register", json={"username": username, "password": "secret1"})
+        response = client.post("/api/auth/login", json={"username": username, "password": "secret1"})
+        assert response.status_code == 200
+        client.cookies.set("access_token", response.cookies["access_token"])
+        client.user_id = main.verify_user(username, "secret1")
+        yield client
+
+
+@pytest.fixture
+def session_id(client):
+    return client.post("/api/sessions", json={"name": "Test"}).json()["session_id"]
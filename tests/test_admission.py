@@ -0,0 +1,77 @@
+"""
+Admission control: streams per lane are capped, waiters are served fairly
+across users, and a full queue is rejected with a Retry-After estimate.
+"""
+
+import asyncio
+
+import pytest
+
+import main
+
+
+def scheduler(limit: int = 1, max_queue: int = 8) -> main.AdmissionScheduler:
+    return main.AdmissionScheduler(backend_limits={"ollama": limit}, model_limits={}, max_queue=max_queue)
+
+
+def test_waiters_are_served_fairly_across_users():
+    async def scenario():
+        admission = scheduler()
+        first = admission.enqueue("ollama", "m", user_id=1)
+        assert first.granted
+        heavy = [admission.enqueue("ollama", "m", user_id=1) for _ in range(3)]
+        light = admission.enqueue("ollama", "m", user_id=2)
+
+        # User 2 queued last but holds no stream, so goes first
+        assert [t.position for t in heavy] == [2, 3, 4] and light.position == 1
+        positions = light.wait()
+        assert await anext(positions) == 1
+
+        order = []
+        current = first
+        for _ in range(4):
+            admission.release(current)
+            current = next(t for t in heavy + [light] if t.granted and not t.released)
+            order.append((current.user_id, heavy.index(current) if current in heavy else None))
+        assert order == [(2, None), (1, 0), (1, 1), (1, 2)]
+        with pytest.raises(StopAsyncIteration):
+            await anext(positions)  # Granted: the wait loop ends
+        admission.release(current)
+        assert admission.stats()["ollama/m"]["active"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_leaving_the_queue_moves_later_waiters_up():
+    async def scenario():
+        admission = scheduler()
+        running = admission.enqueue("ollama", "m", user_id=1)
+        leaving = admission.enqueue("ollama", "m", user_id=2)
+        staying = admission.enqueue("ollama", "m", user_id=3)
+        assert staying.position == 2
+
+        admission.release(leaving)
+        assert staying.position == 1
+        admission.release(running)
+        assert staying.granted and not leaving.granted
+        assert admission.stats()["ollama/m"]["queued"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_full_queue_is_rejected_with_retry_after():
+    async def scenario():
+        admission = scheduler(limit=2, max_queue=1)
+        assert admission.enqueue("ollama", "m", user_id=1).granted
+        assert admission.enqueue("ollama", "m", user_id=2).granted
+        admission.enqueue("ollama", "m", user_id=3)
+        with pytest.raises(main.AdmissionRejected) as rejected:
+            admission.enqueue("ollama", "m", user_id=4)
+        # Two waiters' worth of the initial stream estimate, over two slots
+        assert rejected.value.retry_after == 30
+        assert admission.stats()["ollama/m"]["rejected"] == 1
+
+        # Another model has a lane of its own
+        assert admission.enqueue("ollama", "other", user_id=4).granted
+
+    asyncio.run(scenario())
@@ -0,0 +1,61 @@
+"""
+Artifact extraction while streaming (ArtifactTokenizer).
+"""
+
+import main
+
+REPLY = (
+    "<think>The user wants a helper.\nKeep it short.</think>\n"
+    "Here you go:\n"
+    "```python\n"
+    "def add(a, b):\n"
+    "    return a + b\n"
+    "```\n"
+    "## Notes\n"
+    "The helper adds two numbers and returns the result without side effects.\n"
+    "## Tiny\n"
+    "too short\n"
+)
+
+
+def extract(chunks) -> tuple:
+    tokenizer = main.ArtifactTokenizer()
+    events = []
+    for chunk in chunks:
+        events.extend(tokenizer.feed(chunk))
+    events.extend(tokenizer.finish())
+    return tokenizer.artifacts, events
+
+
+def test_tokenizer_finds_code_thoughts_and_sections():
+    artifacts, events = extract([REPLY])
+    assert [(a["type"], a["language"], a["title"]) for a in artifacts] == [
+        ("thought", None, "Reasoning"),
+        ("code", "python", "add (function)"),
+        ("document", None, "Notes"),
+    ]
+    assert artifacts[0]["content"] == "The user wants a helper.\nKeep it short."
+    assert artifacts[1]["content"] == "def add(a, b):\n    return a + b"
+    # Every started artifact completes, kept or discarded
+    started = [e["index"] for e in events if e["type"] == "artifact_started"]
+    completed = [e["index"] for e in events if e["type"] == "artifact_completed"]
+    assert sorted(started) == sorted(completed)
+    assert any(e.get("discarded") for e in events)  # The "Tiny" section
+
+
+def test_tokenizer_result_does_not_depend_on_chunking():
+    whole = extract([REPLY])
+    assert extract(list(REPLY)) == whole
+    assert extract([REPLY[i:i + 7] for i in range(0, len(REPLY), 7)]) == whole
+
+
+def test_tokenizer_drops_unterminated_code():
+    artifacts, events = extract(["Start:\n```js\nconsole.log(1)\n"])
+    assert artifacts == []
+    assert events[-1] == {"type": "artifact_completed", "index": 0, "discarded": True}
+
+
+def test_tokenizer_needs_a_fence_at_line_end_to_open_code():
+    reply = "Wrap code in ``` fences like this:\n```sh\nls -la```\nthen `more` text\n```\nplain = True\n```\n"
+    artifacts, _ = extract([reply])
+    assert [(a["language"], a["content"]) for a in artifacts] == [("sh", "ls -la"), ("text", "plain = True")]
@@ -0,0 +1,96 @@
+"""
+Streamed artifact ZIP downloads: Range/If-Range support, predicted
+lengths for stored archives, and compression off the bcrypt pool.
+"""
+
+import io
+import zipfile
+
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize("header, expected", [
+    (None, None),
+    ("bytes=0-9", (0, 9)),
+    ("bytes=90-", (90, 99)),
+    ("bytes=-10", (90, 99)),
+    ("bytes=50-500", (50, 99)),
+    ("bytes=0-1,5-6", None),
+    ("items=0-9", None),
+    ("bytes=a-b", None),
+])
+def test_parse_byte_range(header, expected):
+    assert main.parse_byte_range(header, 100) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=100-", "bytes=20-10"])
+def test_parse_byte_range_unsatisfiable(header):
+    with pytest.raises(ValueError):
+        main.parse_byte_range(header, 100)
+
+
+@pytest.fixture
+def artifact_session(client, session_id):
+    main.save_artifacts(session_id, client.user_id, [
+        {"type": "code", "language": "python", "title": "add (function)", "content": "def add(a, b):\n    return a + b"},
+        {"type": "document", "language": None, "title": "Notes", "content": "Notes " * 200},
+        {"type": "thought", "language": None, "title": "Reasoning", "content": "Thinking it through."},
+    ])
+    return session_id
+
+
+def test_stored_zip_length_is_predicted_and_ranges_served(client, artifact_session):
+    url = f"/api/sessions/{artifact_session}/artifacts/download?compression=store"
+    full = client.get(url)
+    assert full.status_code == 200
+    assert full.headers["accept-ranges"] == "bytes"
+    assert int(full.headers["content-length"]) == len(full.content)
+    with zipfile.ZipFile(io.BytesIO(full.content)) as zf:
+        assert zf.testzip() is None
+        assert zf.read("codes/1_add_(function).py").decode() == "def add(a, b):\n    return a + b"
+        assert zf.read("documents/1_Notes.txt").decode() == "Notes " * 200
+
+    etag = full.headers["etag"]
+    part = client.get(url, headers={"Range": "bytes=100-299", "If-Range": etag})
+    assert part.status_code == 206
+    assert part.headers["content-range"] == f"bytes 100-299/{len(full.content)}"
+    assert part.content == full.content[100:300]
+
+    tail = client.get(url, headers={"Range": "bytes=-50"})
+    assert tail.status_code == 206
+    assert tail.content == full.content[-50:]
+
+    # A stale validator gets the whole (new) archive instead of a mismatched slice
+    stale = client.get(url, headers={"Range": "bytes=100-299", "If-Range": '"old"'})
+    assert stale.status_code == 200
+    assert stale.content == full.content
+
+    beyond = client.get(url, headers={"Range": f"bytes={len(full.content)}-"})
+    assert beyond.status_code == 416
+    assert beyond.headers["content-range"] == f"bytes */{len(full.content)}"
+
+
+def test_deflate_zip_serves_ranges_once_length_is_known(client, artifact_session):
+    url = f"/api/sessions/{artifact_session}/artifacts/download"
+    first = client.get(url, headers={"Range": "bytes=0-9"})
+    assert first.status_code == 200
+    assert first.headers["accept-ranges"] == "none"
+    with zipfile.ZipFile(io.BytesIO(first.content)) as zf:
+        assert zf.testzip() is None
+
+    part = client.get(url, headers={"Range": "bytes=10-59"})
+    assert part.status_code == 206
+    assert part.headers["etag"] == first.headers["etag"]
+    assert part.content == first.content[10:60]
+
+
+def test_compression_does_not_use_the_login_pool(client, artifact_session, monkeypatch):
+    def unavailable():
+        raise AssertionError("ZIP export ran on the bcrypt pool")
+    monkeypatch.setattr(main.cpu_executor, "get", unavailable)
+    response = client.get(f"/api/sessions/{artifact_session}/artifacts/download")
+    assert response.status_code == 200
+    with zipfile.ZipFile(io.BytesIO(response.content)) as zf:
+        assert zf.testzip() is None
@@ -0,0 +1,113 @@
+"""
+Content-addressed attachment store: streamed multipart uploads, dedup by
+hash, and refcounted cleanup of expired attachments.
+"""
+
+import hashlib
+import os
+import struct
+import zlib
+from datetime import datetime, timedelta
+
+import pytest
+
+import main
+
+
+def png(seed: int) -> bytes:
+    """A valid 1x1 PNG whose pixel depends on `seed`."""
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    pixel = zlib.compress(bytes([0, seed % 256, 0, 0]))
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", 1, 1, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", pixel) + chunk(b"IEND", b""))
+
+
+def upload(client, data: bytes, name: str = "image.png"):
+    return client.post("/api/attachments", files={"file": (name, data, "application/octet-stream")})
+
+
+def blob(digest: str):
+    with main.get_db() as conn:
+        row = conn.execute("SELECT filename, refcount FROM attachment_blobs WHERE hash = ?", (digest,)).fetchone()
+    return dict(row) if row else None
+
+
+def expire(*attachment_ids: int):
+    past = (datetime.now() - timedelta(minutes=1)).isoformat()
+    with main.get_db() as conn:
+        conn.executemany("UPDATE message_attachments SET expires_at = ? WHERE id = ?",
+                         [(past, attachment_id) for attachment_id in attachment_ids])
+
+
+def test_identical_uploads_share_one_blob_until_the_last_expires(client):
+    data = png(1)
+    first, second = upload(client, data).json(), upload(client, data).json()
+    assert first["id"] != second["id"]
+
+    digest = hashlib.sha256(data).hexdigest()
+    stored = blob(digest)
+    assert stored["refcount"] == 2
+    path = os.path.join(main.UPLOADS_DIR, stored["filename"])
+    with open(path, "rb") as f:
+        assert f.read() == data
+    assert client.get(f"/api/attachments/{second['id']}/download").content == data
+
+    expire(first["id"])
+    main.cleanup_expired_attachments()
+    assert blob(digest)["refcount"] == 1
+    assert os.path.exists(path)
+    assert client.get(f"/api/attachments/{second['id']}/download").content == data
+
+    expire(second["id"])
+    main.cleanup_expired_attachments()
+    assert blob(digest) is None
+    assert not os.path.exists(path)
+
+
+def test_distinct_uploads_get_their_own_blobs(client):
+    a, b = png(2), png(3)
+    upload(client, a)
+    upload(client, b)
+    assert blob(hashlib.sha256(a).hexdigest())["refcount"] == 1
+    assert blob(hashlib.sha256(b).hexdigest())["refcount"] == 1
+
+
+def test_rejected_uploads_leave_no_temp_files(client):
+    before = set(os.listdir(main.ATTACHMENT_TEMP_DIR))
+    assert upload(client, b"plain text, not an image").status_code == 415
+
+    body = (b"--xyz\r\nContent-Disposition: form-data; name=\"file\"; filename=\"big.png\"\r\n\r\n"
+            + png(4) + b"\0" * 128 + b"\r\n--xyz--\r\n")
+    multipart = main.MultipartUpload(b"xyz", max_bytes=64)
+    try:
+        with pytest.raises(main.AttachmentRejected) as rejected:
+            multipart.feed(body)
+        assert rejected.value.status_code == 413
+    finally:
+        multipart.close()
+    assert set(os.listdir(main.ATTACHMENT_TEMP_DIR)) == before
+
+
+def test_uploads_do_not_use_the_login_pool(client, monkeypatch):
+    def unavailable():
+        raise AssertionError("Upload ran on the bcrypt pool")
+    monkeypatch.setattr(main.cpu_executor, "get", unavailable)
+    assert upload(client, png(5)).status_code == 200
+
+
+def test_attachment_can_only_be_sent_with_one_message(client, session_id):
+    attachment = upload(client, png(6)).json()
+    first = main.save_message(client.user_id, "user", "first", "m", session_id, attachment_ids=[attachment["id"]])
+
+    # A concurrent send that passed the "not yet on a message" check loses the race
+    with pytest.raises(main.AttachmentRejected) as rejected:
+        main.save_message(client.user_id, "user", "second", "m", session_id, attachment_ids=[attachment["id"]])
+    assert rejected.value.status_code == 409
+    assert main.get_attachment(attachment["id"])["message_id"] == first
+    history = main.load_chat_history(client.user_id, 10, session_id)
+    assert [m["content"] for m in history] == ["first"]
+
+    # Nor can another user claim it
+    with pytest.raises(main.AttachmentRejected):
+        main.save_message(client.user_id + 1, "user", "mine", "m", attachment_ids=[attachment["id"]])
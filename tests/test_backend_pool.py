@@ -0,0 +1,64 @@
+"""
+Routing across several endpoints of a backend: serving and warm endpoints
+first, then the fewest requests in flight, skipping ejected endpoints.
+"""
+
+import pytest
+
+import main
+
+A, B, C = "http://gpu-a", "http://gpu-b", "http://gpu-c"
+
+
+@pytest.fixture
+def in_flight(monkeypatch):
+    counts = {}
+    monkeypatch.setattr(main.backend_http, "in_flight", lambda url: counts.get(url, 0))
+    return counts
+
+
+def pool(eject_failures: int = 2, eject_seconds: float = 60) -> main.BackendPool:
+    backends = main.BackendPool({"ollama": [A, B, C]}, eject_failures, eject_seconds)
+    for endpoint in backends.endpoints["ollama"]:
+        endpoint.models = {"llama3:8b"} if endpoint.url != C else {"qwen:7b"}
+    return backends
+
+
+def test_pick_prefers_warm_then_least_loaded(in_flight):
+    backends = pool()
+    in_flight.update({A: 3, B: 1})
+    assert backends.pick("ollama", "llama3:8b") == B
+    assert backends.pick("ollama", "qwen:7b") == C  # Only C serves it
+
+    backends.endpoints["ollama"][0].warm = {"llama3:8b"}
+    assert backends.pick("ollama", "llama3:8b") == A  # Loaded beats less busy
+
+    # Ties rotate instead of always landing on the first endpoint
+    in_flight.clear()
+    backends.endpoints["ollama"][0].warm = set()
+    assert {backends.pick("ollama", "llama3:8b") for _ in range(4)} == {A, B}
+
+
+def test_failing_endpoint_is_ejected_until_it_succeeds(in_flight):
+    backends = pool(eject_failures=2)
+    in_flight.update({B: 5})
+    backends.report_failure(A, "connection refused")
+    assert backends.pick("ollama", "llama3:8b") == A  # One failure is not enough
+
+    backends.report_failure(A, "connection refused")
+    assert backends.pick("ollama", "llama3:8b") == B
+    assert backends.stats()["ollama"][0]["ejected"] is True
+    assert [endpoint.url for endpoint in backends.available("ollama", "llama3:8b")] == [B]
+
+    backends.report_success(A)
+    assert backends.pick("ollama", "llama3:8b") == A
+    assert backends.stats()["ollama"][0]["healthy"] is True
+
+
+def test_all_ejected_still_routes_somewhere(in_flight):
+    backends = pool(eject_failures=1)
+    for url in (A, B, C):
+        backends.report_failure(url)
+    assert backends.pick("ollama", "llama3:8b") in (A, B, C)
+    with pytest.raises(ValueError):
+        backends.pick("vllm", "llama3:8b")
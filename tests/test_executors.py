@@ -0,0 +1,47 @@
+"""
+Blocking work runs off the event loop on its own pools, and those pools
+survive the app's lifespan running more than once in a process.
+"""
+
+import os
+import threading
+
+from fastapi.testclient import TestClient
+
+import main
+
+
+def test_login_hashes_and_queries_on_separate_pools(client, monkeypatch):
+    threads = {}
+
+    def recording(name, fn):
+        def call(*args, **kwargs):
+            threads[name] = threading.current_thread().name
+            return fn(*args, **kwargs)
+        return call
+    monkeypatch.setattr(main, "get_user_credentials", recording("query", main.get_user_credentials))
+    monkeypatch.setattr(main, "check_password", recording("hash", main.check_password))
+
+    response = client.post("/api/auth/login", json={"username": "wrong-user-or-password", "password": "secret1"})
+    assert response.status_code == 401
+    assert threads["query"].startswith("borak-db")
+
+    username = f"pools{os.urandom(3).hex()}"
+    assert client.post("/api/auth/register", json={"username": username, "password": "secret1"}).status_code == 200
+    assert client.post("/api/auth/login", json={"username": username, "password": "secret1"}).status_code == 200
+    assert threads["query"].startswith("borak-db")
+    assert threads["hash"].startswith("borak-cpu")
+
+
+def test_lifespan_can_run_again():
+    # Shutdown closes the thread pools; the next lifespan must get working ones
+    for attempt in range(3):
+        username = f"lifespan{attempt}{os.urandom(3).hex()}"
+        with TestClient(main.app) as client:
+            assert client.post("/api/auth/register", json={"username": username, "password": "secret1"}).status_code == 200
+            response = client.post("/api/auth/login", json={"username": username, "password": "secret1"})
+            assert response.status_code == 200
+            client.cookies.set("access_token", response.cookies["access_token"])
+            session_id = client.post("/api/sessions", json={"name": "Test"}).json()["session_id"]
+            assert client.get(f"/api/chat/history?session_id={session_id}").status_code == 200
+            assert client.delete(f"/api/chat/clear?session_id={session_id}").status_code == 200
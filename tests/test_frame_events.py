@@ -0,0 +1,69 @@
+"""
+Wire framing of streamed events (frame_events): runs of deltas are merged
+into one frame carrying the last delta's id, flushed by size, time or the
+next non-delta event.
+"""
+
+import asyncio
+import json
+
+import main
+
+
+def parse_sse(chunks) -> list:
+    events = []
+    for block in "".join(chunks).split("\n\n"):
+        if block:
+            fields = dict(line.split(": ", 1) for line in block.split("\n"))
+            events.append((int(fields["id"]) if "id" in fields else None, json.loads(fields["data"])))
+    return events
+
+
+def frame(events, ndjson: bool = False, pause: float = 0) -> list:
+    async def source():
+        for seq, event in events:
+            if pause and event.get("type") == "done":
+                await asyncio.sleep(pause)
+            yield seq, event
+
+    async def scenario():
+        return [chunk async for chunk in main.frame_events(source(), ndjson)]
+    return asyncio.run(scenario())
+
+
+DELTAS = [(1, {"type": "content", "content": "Hé "}), (2, {"type": "content", "content": '"quoted"\n'}),
+          (3, {"type": "stdout", "content": "out"}), (4, {"type": "done", "usage": {"tokens": 3}})]
+
+
+def test_deltas_are_merged_until_the_next_event():
+    chunks = frame(DELTAS)
+    assert parse_sse(chunks) == [
+        (2, {"type": "content", "content": 'Hé "quoted"\n'}),
+        (3, {"type": "stdout", "content": "out"}),
+        (4, {"type": "done", "usage": {"tokens": 3}}),
+    ]
+    assert len(chunks) == 1  # Nothing was waiting on the clock
+
+
+def test_window_flushes_while_the_source_is_idle(monkeypatch):
+    monkeypatch.setattr(main, "SSE_COALESCE_MS", 10)
+    chunks = frame(DELTAS, pause=0.2)
+    assert len(chunks) == 2
+    assert [seq for seq, _ in parse_sse(chunks[:1])] == [2, 3]
+
+
+def test_size_limit_and_zero_window(monkeypatch):
+    long_deltas = [(n, {"type": "content", "content": "x" * 6}) for n in range(1, 6)]
+    monkeypatch.setattr(main, "SSE_COALESCE_BYTES", 10)
+    assert [seq for seq, _ in parse_sse(frame(long_deltas))] == [2, 4, 5]
+
+    monkeypatch.setattr(main, "SSE_COALESCE_MS", 0)
+    assert [seq for seq, _ in parse_sse(frame(long_deltas))] == [1, 2, 3, 4, 5]
+
+
+def test_ndjson_lines_carry_the_id():
+    lines = "".join(frame(DELTAS[:2] + [(None, {"type": "error", "error": "stopped"})], ndjson=True)).splitlines()
+    assert [json.loads(line) for line in lines] == [
+        {"id": 2, "type": "content", "content": 'Hé "quoted"\n'},
+        {"type": "error", "error": "stopped"},
+    ]
@@ -0,0 +1,153 @@
+"""
+Shared generation registry: session exclusivity, the per-user limit,
+heartbeats and stale entries, and stop signals between workers.
+
+Two registry instances over the same store stand in for two workers. The
+SQLite registry always runs; the Redis one runs when fakeredis is
+installed.
+"""
+
+import asyncio
+import time
+import uuid
+from datetime import datetime
+
+import pytest
+
+import main
+
+
+def make_registry(kind: str, stale_after: float, store=None):
+    if kind == "sqlite":
+        return main.SQLiteGenerationRegistry(stale_after=stale_after, poll_interval=0.01)
+    return main.RedisGenerationRegistry(store, stale_after=stale_after)
+
+
+@pytest.fixture(params=["sqlite", "redis"])
+def workers(request):
+    """factory(stale_after) -> (worker_a, worker_b), two registries sharing one store."""
+    store = None
+    if request.param == "redis":
+        fakeredis = pytest.importorskip("fakeredis")
+        store = fakeredis.FakeAsyncRedis()
+
+    def factory(stale_after: float = 30):
+        return make_registry(request.param, stale_after, store), make_registry(request.param, stale_after, store)
+    return factory
+
+
+def entry(worker_id: str, user_id: int = None, session_id: int = 1) -> dict:
+    user_id = user_id or int(uuid.uuid4().int % 10**9)
+    return {
+        "generation_id": main.new_generation_id(user_id),
+        "user_id": user_id,
+        "session_id": session_id,
+        "worker_id": worker_id,
+        "model": "test-model",
+        "backend": "ollama",
+        "started_at": datetime.now().isoformat()
+    }
+
+
+def test_session_is_exclusive_across_workers(workers):
+    async def scenario():
+        a, b = workers()
+        first = entry("worker-a")
+        assert await a.register(first, max_per_user=4) is None
+        same_session = entry("worker-b", first["user_id"], first["session_id"])
+        assert await b.register(same_session, max_per_user=4) == "session_busy"
+        found = await b.find(first["user_id"], first["session_id"])
+        assert found["generation_id"] == first["generation_id"]
+        assert found["worker_id"] == "worker-a"
+
+        await a.finish(first)
+        assert await b.find(first["user_id"], first["session_id"]) is None
+        assert await b.register(same_session, max_per_user=4) is None
+        await b.finish(same_session)
+
+    asyncio.run(scenario())
+
+
+def test_per_user_limit_counts_every_worker(workers):
+    async def scenario():
+        a, b = workers()
+        first = entry("worker-a", session_id=1)
+        second = entry("worker-b", first["user_id"], session_id=2)
+        assert await a.register(first, max_per_user=1) is None
+        assert await b.register(second, max_per_user=1) == "limit"
+        assert [e["generation_id"] for e in await b.running(first["user_id"])] == [first["generation_id"]]
+        await a.finish(first)
+        assert await b.register(second, max_per_user=1) is None
+        await b.finish(second)
+
+    asyncio.run(scenario())
+
+
+def test_stop_request_reaches_owning_worker(workers):
+    async def scenario():
+        a, b = workers()
+        owned = entry("worker-a")
+        await a.register(owned, max_per_user=4)
+        stops = a.stop_requests("worker-a")
+        listening = asyncio.ensure_future(anext(stops))
+        await asyncio.sleep(0.05)  # Subscribed before the signal is sent
+
+        stopped = await b.request_stop(owned["generation_id"])
+        assert stopped["worker_id"] == "worker-a"
+        assert await asyncio.wait_for(listening, timeout=2) == owned["generation_id"]
+
+        # A finished generation can no longer be stopped
+        await a.finish(owned)
+        assert await b.request_stop(owned["generation_id"]) is None
+        await stops.aclose()
+
+    asyncio.run(scenario())
+
+
+def test_entry_without_heartbeat_goes_stale(workers):
+    async def scenario():
+        a, b = workers(stale_after=1)
+        kept, crashed = entry("worker-a", session_id=1), entry("worker-b", session_id=2)
+        await a.register(kept, max_per_user=4)
+        await b.register(crashed, max_per_user=4)
+
+        deadline = time.monotonic() + 2.5
+        while time.monotonic() < deadline:
+            await a.heartbeat([kept])  # worker-b has died and stopped heartbeating
+            await asyncio.sleep(0.2)
+
+        assert await b.get(kept["generation_id"]) is not None
+        assert await a.get(crashed["generation_id"]) is None
+        # The dead worker's session is free again
+        retry = entry("worker-a", crashed["user_id"], crashed["session_id"])
+        assert await a.register(retry, max_per_user=4) is None
+        await a.finish(kept)
+        await a.finish(retry)
+
+    asyncio.run(scenario())
+
+
+def test_stop_from_another_worker_reports_journal_content():
+    async def scenario():
+        owner = main.GenerationManager(main.SQLiteGenerationRegistry(30, 0.01), max_per_user=4, worker_id="worker-a")
+        other = main.GenerationManager(main.SQLiteGenerationRegistry(30, 0.01), max_per_user=4, worker_id="worker-b")
+        running = entry("worker-a")
+        await owner.registry.register(running, max_per_user=4)
+        journal = main.StreamJournal(running["generation_id"])
+        journal.delta("partial reply")
+        await journal.drain()
+
+        status = await other.status(running["user_id"], session_id=running["session_id"])
+        assert status["worker_id"] == "worker-a"
+        assert status["content"] == "partial reply"
+
+        stopped = await other.stop(running["user_id"], session_id=running["session_id"])
+        assert stopped == {"generation_id": running["generation_id"], "partial_content": "partial reply"}
+        # Another user cannot stop it
+        assert await other.stop(running["user_id"] + 1, generation_id=running["generation_id"]) is None
+
+        journal.close()
+        await owner.registry.finish(running)
+        main.clear_generation(running["generation_id"])
+
+    asyncio.run(scenario())
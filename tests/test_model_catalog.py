@@ -0,0 +1,25 @@
+"""
+The cached /api/models payload and its ETag.
+"""
+
+import main
+
+
+def test_payload_does_not_pick_endpoints(monkeypatch):
+    def pick(backend, model=None):
+        raise AssertionError("building the catalog payload must not route requests")
+    monkeypatch.setattr(main.backend_pool, "pick", pick)
+
+    catalog = main.ModelCatalog(ttl=60, refresh_interval=60)
+    payload = catalog._build_payload({"ollama": ["llama3:8b"], "vllm": [], "all": ["llama3:8b"]})
+    assert payload["models"] == ["llama3:8b"]
+    assert payload["models_meta"][0]["backend"] == "ollama"
+
+
+def test_models_endpoint_revalidates_with_etag(client):
+    response = client.get("/api/models")
+    assert response.status_code == 200
+    assert response.json()["default"] == main.DEFAULT_MODEL
+
+    again = client.get("/api/models", headers={"If-None-Match": response.headers["etag"]})
+    assert again.status_code == 304
@@ -0,0 +1,57 @@
+"""
+Packing chat history into a model's context budget (pack_messages) and the
+token estimates stored with each message.
+"""
+
+import pytest
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def small_context(monkeypatch):
+    # 1000 tokens: 250 held back for the reply leaves a budget of 750, 375 per older message
+    monkeypatch.setattr(main, "context_length_for", lambda model: 1000)
+
+
+def message(n: int, tokens: int = None, content: str = None) -> dict:
+    return {"id": n, "role": "user" if n % 2 else "assistant", "content": content or f"message {n}", "tokens": tokens}
+
+
+def test_newest_messages_fill_the_budget():
+    history = [message(n, tokens=200) for n in range(1, 6)]
+    plan = main.pack_messages(history, "any-model")
+    assert plan.budget == 750
+    assert [m["content"] for m in plan.messages] == ["message 3", "message 4", "message 5"]
+    assert (plan.included, plan.dropped, plan.truncated, plan.window_start) == (3, 2, 0, 3)
+    assert plan.prompt_tokens == 3 * (200 + main.PROMPT_MESSAGE_OVERHEAD_TOKENS)
+
+    # The system prompt comes out of the same budget
+    plan = main.pack_messages(history, "any-model", system_prompt="word " * 200)
+    assert plan.included == 2
+
+
+def test_oversized_messages_are_truncated_not_dropped():
+    essay = " ".join(f"word{n}" for n in range(2000))
+
+    # The newest message always goes in, cut to fit the budget if need be
+    plan = main.pack_messages([message(1), message(2, content=essay)], "any-model")
+    newest = plan.messages[-1]["content"]
+    assert "tokens omitted" in newest and newest.startswith("word0 ") and newest.endswith(" word1999")
+    assert plan.truncated == 1 and plan.messages[0]["content"] == "message 1"
+    assert plan.prompt_tokens <= plan.budget
+
+    # An older one is cut to its share, leaving room for the rest of the conversation
+    plan = main.pack_messages([message(1), message(2, content=essay), message(3)], "any-model")
+    assert [m["content"] for m in plan.messages][::2] == ["message 1", "message 3"]
+    assert main.estimate_tokens(plan.messages[1]["content"]) <= 375
+    assert (plan.included, plan.truncated, plan.dropped) == (3, 1, 0)
+
+
+def test_stored_token_counts_are_used(client, session_id):
+    main.save_message(client.user_id, "user", "def f(x):\n    return x", "m", session_id)
+    page, _ = main.load_chat_history_page(client.user_id, 10, session_id)
+    assert page[-1]["tokens"] == main.estimate_tokens("def f(x):\n    return x")
+
+    # message_tokens trusts the stored count rather than re-estimating
+    assert main.message_tokens({"content": "short", "tokens": 900}) == 900 + main.PROMPT_MESSAGE_OVERHEAD_TOKENS
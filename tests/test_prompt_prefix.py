@@ -0,0 +1,57 @@
+"""
+Stable prompt assembly: each turn's prompt extends the previous one
+byte-for-byte (so the backend's KV cache is reused) until the window
+overflows and is compacted once.
+"""
+
+import pytest
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def stable_prompts(monkeypatch):
+    monkeypatch.setattr(main, "PROMPT_ASSEMBLY", "stable")
+    monkeypatch.setattr(main, "PROMPT_PINNED_MESSAGES", 2)
+    monkeypatch.setattr(main, "context_length_for", lambda model: 1000)  # A budget of 750 tokens
+    monkeypatch.setattr(main.session_summarizer, "model", "")
+
+
+def turn(client, session_id: int, n: int) -> main.PromptPlan:
+    # About 100 tokens per message with framing
+    main.save_message(client.user_id, "user" if n % 2 else "assistant", f"m{n} " + "word " * 95, "m", session_id)
+    plan, _ = client.portal.call(main.build_chat_prompt, client.user_id, session_id, "m")
+    return plan
+
+
+def test_prompt_prefix_stays_stable_until_compaction(client, session_id):
+    previous = []
+    for n in range(1, 8):
+        plan = turn(client, session_id, n)
+        assert plan.messages[:len(previous)] == previous
+        assert not plan.compacted
+        previous = plan.messages
+    assert main.get_prompt_window(session_id) is None
+
+    # The eighth message overflows: keep the pinned turns, restart the window at half the budget
+    plan = turn(client, session_id, 8)
+    assert plan.compacted
+    assert [m["content"].split()[0] for m in plan.messages] == ["m1", "m2", "m7", "m8"]
+    window_start = main.get_prompt_window(session_id)
+    assert window_start == plan.window_start
+
+    # Later turns append to the compacted prompt again
+    previous = plan.messages
+    plan = turn(client, session_id, 9)
+    assert not plan.compacted and plan.messages[:len(previous)] == previous
+    assert main.get_prompt_window(session_id) == window_start
+
+
+def test_sliding_window_moves_every_turn(client, session_id, monkeypatch):
+    monkeypatch.setattr(main, "PROMPT_ASSEMBLY", "sliding")
+    for n in range(1, 9):
+        plan = turn(client, session_id, n)
+    assert [m["content"].split()[0] for m in plan.messages] == [f"m{n}" for n in range(2, 9)]
+    plan = turn(client, session_id, 9)
+    assert plan.messages[0]["content"].startswith("m3 ")
+    assert main.get_prompt_window(session_id) is None
@@ -0,0 +1,63 @@
+"""
+Response cache keys: the model, system prompt, earlier conversation and
+normalised last message, per user unless the scope is global.
+"""
+
+import asyncio
+
+import main
+
+
+def cache(scope: str = "user", max_entries: int = 10) -> main.ResponseCache:
+    return main.ResponseCache({"cached-model"}, max_entries, ttl_seconds=60, similarity=1.0,
+                              tail_messages=1, scope=scope)
+
+
+def conversation(*contents: str) -> list:
+    return [{"role": "user" if n % 2 == 0 else "assistant", "content": c} for n, c in enumerate(contents)]
+
+
+def test_repeat_in_same_context_hits():
+    async def scenario():
+        responses = cache()
+        await responses.store(1, "cached-model", "Be brief.", conversation("What is WAL?"), "Write-ahead logging.")
+        hit = await responses.lookup(1, "cached-model", "Be brief.", conversation("  what is   WAL? "))
+        assert (hit.content, hit.match) == ("Write-ahead logging.", "exact")
+
+        # Each part of the key matters
+        assert await responses.lookup(1, "cached-model", "Be verbose.", conversation("What is WAL?")) is None
+        assert await responses.lookup(2, "cached-model", "Be brief.", conversation("What is WAL?")) is None
+        assert await responses.lookup(1, "other-model", "Be brief.", conversation("What is WAL?")) is None
+        assert responses.counters["cached-model"] == {"exact_hits": 1, "semantic_hits": 0, "misses": 2, "stores": 1}
+
+    asyncio.run(scenario())
+
+
+def test_follow_up_only_matches_its_own_conversation():
+    async def scenario():
+        responses = cache()
+        await responses.store(1, "cached-model", None, conversation("Explain SQLite", "It is...", "Why?"), "Because A.")
+        assert await responses.lookup(1, "cached-model", None, conversation("Explain Redis", "It is...", "Why?")) is None
+        hit = await responses.lookup(1, "cached-model", None, conversation("Explain SQLite", "It is...", "why?"))
+        assert hit.content == "Because A."
+
+    asyncio.run(scenario())
+
+
+def test_global_scope_shares_across_users_but_not_images():
+    async def scenario():
+        responses = cache(scope="global", max_entries=1)
+        await responses.store(1, "cached-model", None, conversation("hi"), "Hello!")
+        assert (await responses.lookup(2, "cached-model", None, conversation("hi"))).content == "Hello!"
+
+        with_image = [{"role": "user", "content": "hi", "images": ["aGk="]}]
+        assert await responses.lookup(2, "cached-model", None, with_image) is None
+        await responses.store(2, "cached-model", None, with_image, "A picture.")
+        assert len(responses.entries) == 1
+
+        # LRU bound: a new entry evicts the old one
+        await responses.store(1, "cached-model", None, conversation("bye"), "Goodbye!")
+        assert await responses.lookup(1, "cached-model", None, conversation("hi")) is None
+        assert responses.stats()["evictions"] == 1
+
+    asyncio.run(scenario())
@@ -0,0 +1,77 @@
+"""
+Rolling session summaries: turns that fell out of the prompt window are
+condensed once they reach the threshold, and come back in the system
+prompt.
+"""
+
+import asyncio
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def summarizer(monkeypatch):
+    summarizer = main.SessionSummarizer("summary-model", threshold_tokens=250, max_sessions=2)
+    condensed = []
+
+    async def condense(user_id, summary, lines):
+        condensed.append(lines)
+        return f"{summary} | {len(lines)} turns".strip(" |")
+    monkeypatch.setattr(summarizer, "_condense", condense)
+    monkeypatch.setattr(main, "session_summarizer", summarizer)
+    monkeypatch.setattr(main, "PROMPT_ASSEMBLY", "sliding")
+    summarizer.condensed = condensed
+    return summarizer
+
+
+def save_turns(client, session_id: int, count: int) -> list:
+    # About 100 tokens each with framing
+    return [main.save_message(client.user_id, "user" if n % 2 else "assistant", f"m{n} " + "word " * 95, "m", session_id)
+            for n in range(1, count + 1)]
+
+
+def test_gap_is_summarised_once_over_threshold(client, session_id, summarizer, monkeypatch):
+    ids = save_turns(client, session_id, 6)
+
+    assert client.portal.call(summarizer.summarize, client.user_id, session_id, ids[3]) is True
+    summary = main.get_session_summary(session_id)
+    assert (summary["through_id"], summary["content"]) == (ids[2], "3 turns")
+    assert summarizer.condensed[0][0].startswith("USER: m1 ")
+
+    # One more dropped turn is below the threshold; nothing changes
+    assert client.portal.call(summarizer.summarize, client.user_id, session_id, ids[4]) is False
+    assert main.get_session_summary(session_id)["through_id"] == ids[2]
+
+    # The prompt builder puts the summary ahead of the turns it kept
+    monkeypatch.setattr(main, "context_length_for", lambda model: 500)
+    plan, system_prompt = client.portal.call(main.build_chat_prompt, client.user_id, session_id, "m")
+    assert plan.window_start > ids[2]
+    assert plan.summary_through == ids[2]
+    assert system_prompt.endswith("Summary of the earlier conversation:\n3 turns")
+
+
+def test_sessions_below_threshold_are_not_rechecked(client, session_id, summarizer):
+    ids = save_turns(client, session_id, 3)
+
+    async def scenario():
+        summarizer.schedule(client.user_id, session_id, ids[2])
+        await asyncio.gather(*summarizer.tasks.values())
+        summarizer.schedule(client.user_id, session_id, ids[2])  # Same window: skipped
+        assert not summarizer.tasks
+        summarizer.schedule(client.user_id, session_id, ids[1])  # The window moved: checked again
+        assert session_id in summarizer.tasks
+        await asyncio.gather(*summarizer.tasks.values())
+
+    asyncio.run(scenario())
+    assert summarizer.runs == 0 and summarizer.condensed == []
+    assert main.get_session_summary(session_id) is None
+
+
+def test_checked_sessions_are_bounded(summarizer):
+    for session_id in (1, 2, 3):
+        summarizer._mark_checked(session_id, 10)
+    assert list(summarizer._checked) == [2, 3]
+    summarizer.forget(3)
+    assert list(summarizer._checked) == [2]
@@ -0,0 +1,129 @@
+"""
+Generation journals: batched writes on the I/O pool, compaction into a
+snapshot, ending cleanly when a write fails, and clearing them with a
+session's history.
+"""
+
+import asyncio
+import os
+from datetime import datetime
+
+import main
+
+
+def test_journal_compacts_into_snapshot():
+    async def scenario():
+        journal = main.StreamJournal(main.new_generation_id(1), {"session_id": 7})
+        for part in ("Hel", "lo", "!"):
+            journal.delta(part)
+        await journal.drain()
+        log_path, snapshot_path = main.get_generation_paths(journal.generation_id)
+        assert os.path.exists(log_path)
+        running = main.get_generation_state(journal.generation_id)
+        assert (running["status"], running["content"], running["meta"]) == ("running", "Hello!", {"session_id": 7})
+
+        journal.finish("complete", usage={"prompt_tokens": 3, "completion_tokens": 3})
+        await journal.drain()
+        assert not os.path.exists(log_path) and os.path.exists(snapshot_path)
+        state = main.get_generation_state(journal.generation_id)
+        assert (state["status"], state["content"], state["seq"]) == ("complete", "Hello!", 5)
+        main.clear_generation(journal.generation_id)
+
+    asyncio.run(scenario())
+
+
+def test_failed_write_ends_journal_with_error_snapshot():
+    async def scenario():
+        journal = main.StreamJournal(main.new_generation_id(1))
+        journal.delta("kept ")
+        await journal.drain()
+
+        def broken(batch):
+            raise OSError("No space left on device")
+        journal._write = broken
+        journal.delta("in memory")
+        await journal.drain()
+
+        assert journal.failed and journal._file.closed
+        log_path, snapshot_path = main.get_generation_paths(journal.generation_id)
+        assert not os.path.exists(log_path)
+        state = main.get_generation_state(journal.generation_id)
+        assert state["status"] == "error"
+        assert state["content"] == "kept in memory"
+        assert "No space left" in state["error"]
+
+        # Later records are dropped rather than written to the closed file
+        journal.delta("late")
+        await journal.drain()
+        assert journal.finish("complete")["status"] == "error"
+        main.clear_generation(journal.generation_id)
+
+    asyncio.run(scenario())
+
+
+def test_failed_compaction_keeps_terminal_status():
+    async def scenario():
+        journal = main.StreamJournal(main.new_generation_id(1))
+        journal.delta("done")
+        compact = journal._compact
+        calls = []
+
+        def flaky(snapshot):
+            calls.append(snapshot["status"])
+            if len(calls) == 1:
+                raise OSError("EIO")
+            compact(snapshot)
+        journal._compact = flaky
+        journal.finish("complete")
+        await journal.drain()
+        assert calls == ["complete", "complete"]
+        assert main.get_generation_state(journal.generation_id)["status"] == "complete"
+        main.clear_generation(journal.generation_id)
+
+    asyncio.run(scenario())
+
+
+def journal_for(user_id: int, session_id: int) -> str:
+    journal = main.StreamJournal(main.new_generation_id(user_id), {"session_id": session_id})
+    journal.delta("hello")
+    journal.close()
+    return journal.generation_id
+
+
+def exists(generation_id: str) -> bool:
+    return any(os.path.exists(path) for path in main.get_generation_paths(generation_id))
+
+
+def test_clear_chat_removes_only_that_sessions_journals(client, session_id):
+    other_session = client.post("/api/sessions", json={"name": "Other"}).json()["session_id"]
+    cleared, kept = journal_for(client.user_id, session_id), journal_for(client.user_id, other_session)
+
+    response = client.delete(f"/api/chat/clear?session_id={session_id}")
+    assert response.status_code == 200
+    assert response.json() == {"success": True}
+    assert not exists(cleared)
+    assert exists(kept)
+
+    assert client.delete("/api/chat/clear").status_code == 200
+    assert main.list_user_generations(client.user_id) == []
+
+
+def test_clear_chat_keeps_running_generations(client, session_id):
+    running = main.StreamJournal(main.new_generation_id(client.user_id), {"session_id": session_id})
+    running.delta("still streaming")
+    entry = {
+        "generation_id": running.generation_id, "user_id": client.user_id, "session_id": session_id,
+        "worker_id": "another-worker", "model": "test-model", "backend": "ollama",
+        "started_at": datetime.now().isoformat()
+    }
+    registry = main.generation_manager.registry
+    assert client.portal.call(registry.register, entry, 4) is None
+    try:
+        assert client.delete(f"/api/chat/clear?session_id={session_id}").status_code == 200
+        assert client.delete("/api/chat/generation/clear").status_code == 200
+        assert main.get_generation_state(running.generation_id)["content"] == "still streaming"
+    finally:
+        client.portal.call(registry.finish, entry)
+        running.close()
+    assert client.delete(f"/api/chat/clear?session_id={session_id}").status_code == 200
+    assert not exists(running.generation_id)
@@ -0,0 +1,95 @@
+"""
+POST /api/troubleshoot/batch: NDJSON lines per item plus a summary,
+per-item calls on Ollama, and batched prompts on vLLM with one endpoint
+pick per request.
+"""
+
+import json
+
+import pytest
+
+import main
+
+REPLY = '{"recoverable": true, "extracted": {"title": "Tender"}, "diagnosis": "Selector moved", "confidence": 0.9}'
+
+
+@pytest.fixture(autouse=True)
+def fresh_cache(monkeypatch):
+    monkeypatch.setattr(main, "troubleshoot_cache", main.TTLCache(100, 60))
+
+
+def batch(client, items, **options) -> tuple:
+    response = client.post("/api/troubleshoot/batch", json={"items": items, **options})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    return sorted(lines[:-1], key=lambda line: line["index"]), lines[-1]
+
+
+def test_items_stream_back_with_a_summary(client, monkeypatch):
+    calls = []
+
+    async def troubleshoot(model, stage, error_data, context):
+        calls.append(error_data["n"])
+        return main.parse_troubleshoot_response(REPLY if error_data["n"] else "no json", stage, model, "ollama")
+    monkeypatch.setattr(main, "run_troubleshoot", troubleshoot)
+
+    items = [
+        {"id": "a", "stage": "extract", "error_data": {"n": 1}},
+        {"id": "b", "stage": "extract", "error_data": {"n": 1}},  # Same request as "a"
+        {"id": "c", "stage": "extract", "error_data": {"n": 0}},
+        {"id": "d", "stage": "bogus", "error_data": {"n": 2}},
+    ]
+    lines, summary = batch(client, items)
+    assert [(line["id"], line["status"]) for line in lines] == [("a", "ok"), ("b", "ok"), ("c", "ok"), ("d", "invalid")]
+    assert lines[0]["data"] == {"title": "Tender"}
+    assert lines[2]["needs_manual"] is True
+    assert sorted(calls) == [0, 1]  # "a" and "b" were coalesced or served from the cache
+    assert summary == {"summary": True, "total": 4, "ok": 3, "failed": 0, "invalid": 1,
+                       "cached": summary["cached"]}
+
+    # Repeating the batch is served from the cache, except the unparseable reply
+    lines, summary = batch(client, items[:3])
+    assert summary["cached"] == 2
+    assert sorted(calls) == [0, 0, 1]
+
+
+def test_too_many_items_is_rejected(client, monkeypatch):
+    monkeypatch.setattr(main, "TROUBLESHOOT_BATCH_MAX_ITEMS", 2)
+    items = [{"stage": "extract", "error_data": {"n": n}} for n in range(3)]
+    assert client.post("/api/troubleshoot/batch", json={"items": items}).status_code == 413
+
+
+@pytest.fixture
+def vllm_batches(monkeypatch):
+    """Route troubleshoot models to a fake vLLM backend; returns (picked endpoints, prompts per request)."""
+    picked, requests = [], []
+    urls = iter(["http://vllm-a", "http://vllm-b"] * 10)
+
+    def pick(backend, model=None):
+        picked.append(next(urls))
+        return picked[-1]
+
+    async def generate_batch(base_url, model, prompts, **options):
+        requests.append((base_url, len(prompts)))
+        return [REPLY] * min(len(prompts), 2)  # Never more than two results back
+
+    monkeypatch.setattr(main, "backend_for_model", lambda model: "vllm")
+    monkeypatch.setattr(main.backend_pool, "pick", pick)
+    monkeypatch.setattr(main.get_llm_backend("vllm"), "generate_batch", generate_batch)
+    monkeypatch.setattr(main, "TROUBLESHOOT_BATCH_SIZE", 3)
+    return picked, requests
+
+
+def test_vllm_batches_pick_an_endpoint_per_request(client, vllm_batches):
+    picked, requests = vllm_batches
+    items = [{"id": str(n), "stage": "extract", "error_data": {"n": n}} for n in range(6)]
+    lines, summary = batch(client, items)
+    assert len(requests) == 2
+    assert sorted(url for url, _ in requests) == ["http://vllm-a", "http://vllm-b"]
+
+    # Each request of three prompts got two results: the third item is reported, not dropped
+    assert len(lines) == summary["total"] == 6
+    assert summary["ok"] == 4 and summary["failed"] == 2
+    failed = [line for line in lines if line["status"] == "failed"]
+    assert all("2 results for 3 prompts" in line["diagnosis"] for line in failed)
@@ -0,0 +1,76 @@
+"""
+/api/troubleshoot result caching and single-flight coalescing of
+identical in-flight requests.
+"""
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+REPLY = '{"recoverable": true, "extracted": {"title": "Tender"}, "diagnosis": "Selector moved", "confidence": 0.9}'
+
+
+@pytest.fixture
+def model(monkeypatch):
+    """Fake model calls: records each, replies once `release` is set (already set by default)."""
+    model = SimpleNamespace(calls=[], release=asyncio.Event())
+    model.release.set()
+
+    async def troubleshoot(name, stage, error_data, context):
+        model.calls.append(error_data)
+        await model.release.wait()
+        return main.parse_troubleshoot_response(error_data.get("reply", REPLY), stage, name, "ollama")
+    monkeypatch.setattr(main, "run_troubleshoot", troubleshoot)
+    monkeypatch.setattr(main, "troubleshoot_cache", main.TTLCache(100, 60))
+    monkeypatch.setattr(main, "troubleshoot_flight", main.SingleFlight())
+    return model
+
+
+def test_identical_requests_share_one_model_call(model):
+    async def scenario():
+        model.release.clear()
+        callers = [asyncio.create_task(main.run_troubleshoot_cached("m", "extract", {"url": "x"}, None))
+                   for _ in range(3)]
+        await asyncio.sleep(0)
+        callers[0].cancel()  # A caller going away does not cancel the call for the others
+        model.release.set()
+        results = await asyncio.gather(*callers[1:])
+        assert len(model.calls) == 1
+        assert [info["coalesced"] for _, info in results] == [True, True]
+        assert results[0][0]["recovered_data"] == {"title": "Tender"}
+
+        result, info = await main.run_troubleshoot_cached("m", "extract", {"url": "x"}, None)
+        assert info["hit"] is True and len(model.calls) == 1
+        assert main.troubleshoot_flight.stats() == {"in_flight": 0, "started": 1, "coalesced": 2}
+
+    asyncio.run(scenario())
+
+
+def test_unparseable_replies_are_not_cached(model):
+    async def scenario():
+        for _ in range(2):
+            result, info = await main.run_troubleshoot_cached("m", "extract", {"reply": "no idea"}, None)
+            assert info["hit"] is False and result["needs_manual"]
+        assert len(model.calls) == 2
+
+    asyncio.run(scenario())
+
+
+def test_key_ignores_order_and_unused_context():
+    html = "<html>" + "x" * main.TROUBLESHOOT_CONTEXT_CHARS
+    key = main.troubleshoot_cache_key("m", "scrape", {"a": 1, "b": 2}, {"raw_html": html + "<p>1</p>"})
+    assert key == main.troubleshoot_cache_key("m", "scrape", {"b": 2, "a": 1}, {"raw_html": html + "<p>2</p>"})
+    assert key != main.troubleshoot_cache_key("m", "extract", {"a": 1, "b": 2}, {"raw_html": html})
+
+
+def test_endpoint_reports_cache_hits(client, model):
+    body = {"stage": "extract", "error_data": {"url": "https://example.com/tender/1"}}
+    first = client.post("/api/troubleshoot", json=body).json()
+    second = client.post("/api/troubleshoot", json=body).json()
+    assert first["cache"] == {"hit": False, "coalesced": False}
+    assert second["cache"]["hit"] is True
+    assert second["data"] == first["data"] == {"title": "Tender"}
+    assert len(model.calls) == 1